@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 吞吐量与延迟压测, 只使用本机回环地址
+#
+#   StandIn(echo/sink/banner)与每个被测的转发各自运行在独立的进程中, 客户端在本进程中用线程发起.
+#   每一项测试都会重新启动被测的转发, 互不影响.
+#
+#   targets:
+#       direct      直接连接StandIn, 作为对比的基准
+#       local       TcpLocalRedirection
+#       rrd         RRDServer + RRDClient
+#       rrd-mux     RRDServer + RRDClient(多路复用tunnel)
+#
+#   tests:
+#       bulk        多个连接同时向sink发送大量数据, MB/s
+#       latency     多个连接同时与echo一问一答(小消息), 往返时间的p50/p99
+#       latency_bulk  与latency相同, 但同时有--bulk-conns个连接经过同一个转发不停地向echo发送大量数据
+#                   (在独立的进程中), 用于观察Scheduler(--quantum)对交互式连接的影响
+#       connrate    不停地新建连接, 与echo交换一个字节后关闭, 每秒新建连接数
+#       first_byte  连接banner(服务端先发送数据), 从connect到收到banner的时间
+#       idle        保持1k/10k个空闲连接, 转发进程的RSS与峰值RSS
+#
+#   结果写成JSON, --compare指定之前的结果时逐项对比, 变差超过--threshold时返回1.
+#
+#   python Benchmark.py --out base.json
+#   python Benchmark.py --compare base.json
+#
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import logging
+import platform
+import argparse
+import threading
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+from TcpLocalRedirection import TcpLocalRedirection
+from TcpRemoteRedirection import RRDServer, RRDClient
+from StandIn import StandIn, BANNER, SINK_HEAD
+
+
+TARGETS = ("direct", "local", "rrd", "rrd-mux")
+TESTS = ("bulk", "latency", "latency_bulk", "connrate", "first_byte", "idle")
+
+HIGHER_IS_BETTER = ("mb_per_s", "msgs_per_s", "conns_per_s")
+LOWER_IS_BETTER = ("p50_ms", "p99_ms", "rss_kb", "peak_rss_kb")
+
+
+# ----- 进程 -----
+
+def spawn(func):
+    def run():
+        logging.getLogger().setLevel(logging.WARNING)   # 转发进程每个连接都有INFO日志
+        func()
+    proc = multiprocessing.Process(target=run)
+    proc.daemon = True
+    proc.start()
+    return proc
+
+
+def start_standin():
+    """
+    @return: (Process, {kind: addr})
+    """
+    parent, child = multiprocessing.Pipe()
+
+    def run():
+        standin = StandIn()
+        child.send(standin.addrs)
+        standin.main_loop()
+    proc = spawn(run)
+    return proc, parent.recv()
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_listening(addr, timeout=5):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(addr, timeout=1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def start_target(target, remote, opts):
+    """启动被测的转发
+    @return: (client连接的地址, {名称: Process})
+    """
+    if target == "direct":
+        return remote, {}
+    port = free_port()
+    addr = ("127.0.0.1", port)
+    kwargs = {"poller": opts.poller}
+    if opts.quantum is not None:
+        kwargs["io_quantum"] = opts.quantum
+    if target == "local":
+        proc = spawn(lambda: TcpLocalRedirection(addr, remote, **kwargs).main_loop())
+        wait_listening(addr)
+        return addr, {"local": proc}
+    server = spawn(lambda: RRDServer(addr, **kwargs).main_loop())
+    wait_listening(addr)
+    mux = opts.mux if target == "rrd-mux" else 0
+    client = spawn(lambda: RRDClient(addr, remote, mux_tunnels=mux, **kwargs).main_loop())
+    time.sleep(0.5)     # 等待private连接池(或tunnel)建立
+    return addr, {"rrd_server": server, "rrd_client": client}
+
+
+def stop(procs):
+    for proc in procs.itervalues():
+        proc.terminate()
+    for proc in procs.itervalues():
+        proc.join()
+
+
+def read_rss(pid):
+    """
+    @return: (VmRSS, VmHWM), 单位KB. 不是Linux时返回(None, None)
+    """
+    values = {}
+    try:
+        with open("/proc/%d/status" % pid) as fp:
+            for line in fp:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    values[line[:5]] = int(line.split()[1])
+    except IOError:
+        pass
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+# ----- 客户端 -----
+
+def run_threads(count, func):
+    """并发运行count个func(idx)
+    @return: ([返回值], 耗时)
+    """
+    results = [None] * count
+
+    def run(idx):
+        try:
+            results[idx] = func(idx)
+        except socket.error, e:
+            results[idx] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in xrange(count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+
+def recv_exactly(sock, size):
+    data = ""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error("connection closed")
+        data += chunk
+    return data
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def bench_bulk(addrs, opts):
+    size = opts.bulk_mb * 1024 * 1024
+    chunk = os.urandom(64 * 1024)
+
+    def run(idx):
+        sock = socket.create_connection(addrs["sink"], timeout=opts.timeout)
+        sock.sendall(SINK_HEAD.pack(size))
+        left = size
+        while left > 0:
+            data = chunk if left >= len(chunk) else chunk[:left]
+            sock.sendall(data)
+            left -= len(data)
+        recv_exactly(sock, 1)
+        sock.close()
+        return size
+    results, elapsed = run_threads(opts.conns, run)
+    done = sum(r for r in results if isinstance(r, int))
+    return {
+        "connections": opts.conns,
+        "bytes": done,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(done / elapsed / 1024 / 1024, 2),
+        "errors": len([r for r in results if not isinstance(r, int)]),
+    }
+
+
+def bench_latency(addrs, opts):
+    message = "x" * opts.msg_size
+
+    def run(idx):
+        sock = socket.create_connection(addrs["echo"], timeout=opts.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        rtts = []
+        for i in xrange(opts.messages):
+            start = time.time()
+            sock.sendall(message)
+            recv_exactly(sock, len(message))
+            rtts.append(time.time() - start)
+        sock.close()
+        return rtts
+    results, elapsed = run_threads(opts.conns, run)
+    rtts = [rtt for r in results if isinstance(r, list) for rtt in r]
+    errors = len([r for r in results if not isinstance(r, list)])
+    if not rtts:
+        return {"errors": errors}
+    return {
+        "connections": opts.conns,
+        "messages": len(rtts),
+        "message_size": opts.msg_size,
+        "p50_ms": round(percentile(rtts, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(rtts, 0.99) * 1000, 3),
+        "msgs_per_s": round(len(rtts) / elapsed, 1),
+        "errors": errors,
+    }
+
+
+def bench_latency_bulk(addrs, opts):
+    """大流量的连接在独立的进程中运行, 不与测量延迟的线程争用GIL
+    """
+    chunk = os.urandom(64 * 1024)
+
+    def flood():
+        def drain(sock):
+            try:
+                while sock.recv(256 * 1024):
+                    pass
+            except socket.error:
+                pass
+        socks = []
+        for i in xrange(opts.bulk_conns):
+            sock = socket.create_connection(addrs["echo"], timeout=opts.timeout)
+            thread = threading.Thread(target=drain, args=(sock,))
+            thread.daemon = True
+            thread.start()
+            socks.append(sock)
+        while True:
+            for sock in socks:
+                sock.sendall(chunk)
+    flooder = spawn(flood)
+    time.sleep(0.5)     # 等待大流量的连接达到稳定
+    try:
+        result = bench_latency(addrs, opts)
+    finally:
+        stop({"flooder": flooder})
+    result["bulk_connections"] = opts.bulk_conns
+    return result
+
+
+def bench_connrate(addrs, opts):
+    deadline = time.time() + opts.duration
+
+    def run(idx):
+        done = errors = 0
+        while time.time() < deadline:
+            try:
+                sock = socket.create_connection(addrs["echo"], timeout=opts.timeout)
+                sock.sendall("x")
+                recv_exactly(sock, 1)
+                sock.close()
+                done += 1
+            except socket.error:
+                errors += 1
+        return done, errors
+    results, elapsed = run_threads(opts.conns, run)
+    done = sum(r[0] for r in results if isinstance(r, tuple))
+    return {
+        "connections": done,
+        "conns_per_s": round(done / elapsed, 1),
+        "errors": sum(r[1] for r in results if isinstance(r, tuple)),
+    }
+
+
+def bench_first_byte(addrs, opts):
+    times, errors = [], 0
+    for i in xrange(opts.first_byte_conns):
+        start = time.time()
+        try:
+            sock = socket.create_connection(addrs["banner"], timeout=opts.first_byte_timeout)
+            try:
+                recv_exactly(sock, len(BANNER))
+            finally:
+                sock.close()
+            times.append(time.time() - start)
+        except socket.error:
+            errors += 1
+            if errors >= 3:
+                break   # 多半是转发不支持服务端先发送数据, 不必一直等超时
+    result = {"connections": len(times), "errors": errors}
+    if times:
+        result["p50_ms"] = round(percentile(times, 0.5) * 1000, 3)
+        result["p99_ms"] = round(percentile(times, 0.99) * 1000, 3)
+    return result
+
+
+def bench_idle(addrs, opts, procs, count):
+    """保持count个已经开始转发(交换过一个字节)的空闲连接
+    """
+    before = dict((name, read_rss(proc.pid)[0]) for name, proc in procs.iteritems())
+    socks, errors = [], 0
+    batch = 100
+    for i in xrange(0, count, batch):
+        opened = []
+        for j in xrange(min(batch, count - i)):
+            try:
+                sock = socket.create_connection(addrs["echo"], timeout=opts.timeout)
+                sock.sendall("x")
+                opened.append(sock)
+            except socket.error:
+                errors += 1
+        for sock in opened:
+            try:
+                recv_exactly(sock, 1)
+                socks.append(sock)
+            except socket.error:
+                errors += 1
+                sock.close()
+    time.sleep(0.5)
+    result = {"connections": len(socks), "errors": errors}
+    for name, proc in procs.iteritems():
+        rss, peak = read_rss(proc.pid)
+        result[name] = {"rss_kb_before": before[name], "rss_kb": rss, "peak_rss_kb": peak}
+    for sock in socks:
+        sock.close()
+    return result
+
+
+# ----- 运行与对比 -----
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    return soft
+
+
+def run(opts):
+    fd_limit = raise_fd_limit()
+    standin, addrs = start_standin()
+    results = {}
+    try:
+        for target in opts.targets:
+            results[target] = result = {}
+            for test in opts.tests:
+                if test == "idle":
+                    if target == "direct":
+                        continue    # 没有转发进程
+                    for count in opts.idle:
+                        key = "idle_%d" % count
+                        # 转发进程中每个连接占用两个fd
+                        if count * 2 + 64 > fd_limit:
+                            result[key] = {"skipped": "RLIMIT_NOFILE(%d) is too low" % fd_limit}
+                            continue
+                        logging.info("%s %s ...", target, key)
+                        procs = {}
+                        try:
+                            entry, procs = start_target(target, addrs["echo"], opts)
+                            result[key] = bench_idle({"echo": entry}, opts, procs, count)
+                        finally:
+                            stop(procs)
+                    continue
+                kind = {"bulk": "sink", "first_byte": "banner"}.get(test, "echo")
+                logging.info("%s %s ...", target, test)
+                procs = {}
+                try:
+                    entry, procs = start_target(target, addrs[kind], opts)
+                    result[test] = globals()["bench_" + test]({kind: entry}, opts)
+                finally:
+                    stop(procs)
+                logging.info("%s %s: %s", target, test, result[test])
+    finally:
+        stop({"standin": standin})
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(),
+            "poller": opts.poller or "auto",
+            "options": dict((k, v) for k, v in vars(opts).iteritems() if k not in ("out", "compare")),
+        },
+        "results": results,
+    }
+
+
+def flatten(results, prefix=""):
+    """{"local": {"bulk": {"mb_per_s": 1}}} -> {"local.bulk.mb_per_s": 1}
+    """
+    items = {}
+    for key, value in results.iteritems():
+        if isinstance(value, dict):
+            items.update(flatten(value, prefix + key + "."))
+        else:
+            items[prefix + key] = value
+    return items
+
+
+def compare(base, current, threshold):
+    """逐项对比, 输出变化
+    @return: 变差超过threshold的项数
+    """
+    base, current = flatten(base["results"]), flatten(current["results"])
+    regressions = 0
+    for key in sorted(current):
+        metric = key.rsplit(".", 1)[-1]
+        if metric in HIGHER_IS_BETTER:
+            sign = 1
+        elif metric in LOWER_IS_BETTER:
+            sign = -1
+        else:
+            continue
+        old, new = base.get(key), current[key]
+        if not old or new is None:
+            continue
+        change = float(new - old) / old
+        mark = ""
+        if change * sign < -threshold:
+            mark = "  <-- REGRESSION"
+            regressions += 1
+        print "%-45s %12s %12s %+7.1f%%%s" % (key, old, new, change * 100, mark)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TcpRedirection loopback benchmark")
+    parser.add_argument("--targets", default=",".join(TARGETS))
+    parser.add_argument("--tests", default=",".join(TESTS))
+    parser.add_argument("--poller", default=None, help="epoll/poll/select, default: auto")
+    parser.add_argument("--mux", type=int, default=2, help="tunnels for rrd-mux")
+    parser.add_argument("--conns", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--bulk-mb", type=int, default=32, help="MB sent by each bulk client")
+    parser.add_argument("--messages", type=int, default=2000, help="messages per latency client")
+    parser.add_argument("--bulk-conns", type=int, default=2, help="bulk flows beside latency_bulk clients")
+    parser.add_argument("--quantum", type=int, default=None,
+                        help="io_quantum of the redirections (0 disables the scheduler), default: Scheduler.QUANTUM")
+    parser.add_argument("--msg-size", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=3, help="seconds of connrate")
+    parser.add_argument("--first-byte-conns", type=int, default=200)
+    parser.add_argument("--first-byte-timeout", type=float, default=2)
+    parser.add_argument("--idle", default="1000,10000", help="idle connection counts")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--quick", action="store_true", help="small sizes, for a smoke run")
+    parser.add_argument("--out", help="write JSON results to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="regression threshold (0.1 = 10%%)")
+    opts = parser.parse_args()
+    opts.targets = [t for t in opts.targets.split(",") if t]
+    opts.tests = [t for t in opts.tests.split(",") if t]
+    opts.idle = [int(n) for n in opts.idle.split(",") if n]
+    for name, valid in (("target", TARGETS), ("test", TESTS)):
+        for item in getattr(opts, name + "s"):
+            if item not in valid:
+                parser.error("unknown %s: %s" % (name, item))
+    if opts.quick:
+        opts.bulk_mb, opts.messages, opts.duration = 4, 200, 1
+        opts.first_byte_conns, opts.idle = 20, [min(opts.idle)]
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s", datefmt="%H:%M:%S")
+    report = run(opts)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if opts.out:
+        with open(opts.out, "w") as fp:
+            fp.write(text + "\n")
+    else:
+        print text
+    if opts.compare:
+        with open(opts.compare) as fp:
+            base = json.load(fp)
+        if compare(base, report, opts.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 压测用的本地服务, 全部在一个事件循环中运行
+#
+#   echo    原样返回收到的数据
+#   sink    先收8字节的长度(网络字节序), 收够这么多数据后返回一个字节"\x01"
+#   banner  连接建立后先发送BANNER(类似ssh/smtp, 由服务端先说话), 之后与echo相同
+#
+
+import os
+import sys
+import errno
+import socket
+import struct
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+from Poller import create_poller
+
+
+BANNER = "SSH-2.0-StandIn\r\n"
+SINK_HEAD = struct.Struct("!Q")
+MAX_PENDING = 1024 * 1024   # 待发送的数据超过这么多时暂停读取
+
+
+class Peer(object):
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+        self.out = ""
+        self.head = ""          # sink: 还没收全的长度头
+        self.remaining = None   # sink: 还要接收的字节数
+
+
+class StandIn(object):
+    KINDS = ("echo", "sink", "banner")
+
+    def __init__(self, host="127.0.0.1"):
+        # 连接大多是空闲的, 用水平触发的poll, 每次只需处理一次就绪事件
+        self.poller = create_poller("poll")
+        self.r_list = self.poller.r_list
+        self.w_list = self.poller.w_list
+        self.listeners = {}     # listen sock -> kind
+        self.peers = {}         # sock -> Peer
+        self.addrs = {}         # kind -> (host, port)
+        for kind in self.KINDS:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, 0))
+            sock.listen(1024)
+            sock.setblocking(0)
+            self.listeners[sock] = kind
+            self.addrs[kind] = sock.getsockname()
+            self.r_list.add(sock)
+
+    def accept(self, lsock):
+        kind = self.listeners[lsock]
+        while True:
+            try:
+                sock, addr = lsock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            sock.setblocking(0)
+            peer = self.peers[sock] = Peer(sock, kind)
+            self.r_list.add(sock)
+            if kind == "banner":
+                peer.out = BANNER
+                self.w_list.add(sock)
+
+    def on_recv(self, peer):
+        try:
+            data = peer.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            data = ""
+        if not data:
+            self.close(peer)
+            return
+        if peer.kind != "sink":
+            peer.out += data
+            self.w_list.add(peer.sock)
+            if len(peer.out) > MAX_PENDING:
+                self.r_list.discard(peer.sock)
+            return
+        if peer.remaining is None:
+            peer.head += data
+            if len(peer.head) < SINK_HEAD.size:
+                return
+            peer.remaining = SINK_HEAD.unpack(peer.head[:SINK_HEAD.size])[0]
+            data = peer.head[SINK_HEAD.size:]
+        peer.remaining -= len(data)
+        if peer.remaining <= 0:
+            peer.out, peer.head, peer.remaining = "\x01", "", None
+            self.w_list.add(peer.sock)
+
+    def on_send(self, peer):
+        try:
+            peer.out = peer.out[peer.sock.send(peer.out):]
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            self.close(peer)
+            return
+        if not peer.out:
+            self.w_list.discard(peer.sock)
+        if len(peer.out) <= MAX_PENDING:
+            self.r_list.add(peer.sock)
+
+    def close(self, peer):
+        del self.peers[peer.sock]
+        self.r_list.discard(peer.sock)
+        self.w_list.discard(peer.sock)
+        peer.sock.close()
+
+    def main_loop(self):
+        while True:
+            r_list, w_list, e_list = self.poller.poll(None)
+            for sock in r_list:
+                if sock in self.listeners:
+                    self.accept(sock)
+                else:
+                    peer = self.peers.get(sock)
+                    if peer:
+                        self.on_recv(peer)
+            for sock in w_list:
+                peer = self.peers.get(sock)
+                if peer:
+                    self.on_send(peer)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    standin = StandIn()
+    for kind in StandIn.KINDS:
+        logging.info("%s: %s:%s", kind, *standin.addrs[kind])
+    standin.main_loop()
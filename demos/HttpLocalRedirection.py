@@ -3,64 +3,176 @@
 
 import sys
 sys.path.append("../src/")
-from TcpLocalRedirection import TcpLocalRedirection, Forward
+if sys.version_info[0] >= 3:
+    # HttpForward不需要修改, 由asyncio引擎运行
+    from AsyncRedirection import AsyncLocalRedirection as TcpLocalRedirection, Forward
+else:
+    from TcpLocalRedirection import TcpLocalRedirection, Forward
+from Filters import Pipeline, HttpStage, FileRegion, response_body_length
+import os
+import time
 import mimetypes
+import threading
+from collections import deque, OrderedDict
 from wsgiref.handlers import format_date_time
-from datetime import datetime
-from time import mktime
 import logging
 
 
+SENDFILE_MIN = 64 * 1024    # 不小于这么大的文件用sendfile发送, 不读入内存
+
+_date = (0, "")
+
+
+def http_date():
+    """
+    @return: Date头部的值, 每秒只生成一次
+    """
+    global _date
+    now = int(time.time())
+    stamp, value = _date    # 整体替换tuple, hook_pool="thread"时多个线程同时调用也不会读到不一致的值
+    if now != stamp:
+        value = format_date_time(now)
+        _date = (now, value)
+    return value
+
+
+class StaticEntry(object):
+    """一个文件预先生成的响应头(不含状态行和Date)与响应体
+    """
+    def __init__(self, filename):
+        fp = open(filename, "rb")
+        st = os.fstat(fp.fileno())
+        self.stamp = (st.st_mtime, st.st_size)
+        self.checked = time.time()
+        if st.st_size < SENDFILE_MIN:
+            self.body = fp.read()
+            fp.close()
+            self.fileobj = None
+            length = len(self.body)
+        else:
+            self.body = None
+            self.fileobj = fp   # 发送中的FileRegion引用着它, 被淘汰后由最后一个引用者关闭
+            length = st.st_size
+        tp = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        self.headers = ("Server: HttpRedirectionServer\r\n"
+                        "Last-Modified: %s\r\n"
+                        "Content-Length: %d\r\n"
+                        "Content-Type: %s\r\n"
+                        "Connection: keep-alive\r\n\r\n") % (format_date_time(st.st_mtime), length, tp)
+        self.length = length
+        self.size = len(self.headers) + (len(self.body) if self.body is not None else 0)
+
+    def content(self):
+        return self.body if self.fileobj is None else FileRegion(self.fileobj, 0, self.length)
+
+
+class StaticCache(object):
+    """filename -> StaticEntry, 按占用内存的字节数淘汰的LRU.
+    距上次检查超过revalidate秒时重新stat, mtime或大小变化后重新生成.
+    所有forward共用, hook_pool="thread"时在多个线程中调用, 由lock保护
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024, revalidate=1.0):
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.entries = OrderedDict()    # 最近使用的在最后
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        @return: StaticEntry, 文件不存在时抛出IOError/OSError
+        """
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.size -= entry.size
+        # stat与读文件时不持有lock
+        if entry is not None:
+            now = time.time()
+            if now - entry.checked >= self.revalidate:
+                entry.checked = now
+                st = os.stat(filename)
+                if (st.st_mtime, st.st_size) != entry.stamp:
+                    entry = None
+        if entry is None:
+            entry = StaticEntry(filename)
+        with self.lock:
+            old = self.entries.pop(filename, None)  # 其它线程同时放入的
+            if old is not None:
+                self.size -= old.size
+            self.entries[filename] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old.size
+        return entry
+
+
 class HttpForward(Forward):
     MAPPING = {
         "/HttpRedirection.py": "./HttpRedirection.py",
     }
+    cache = StaticCache()
 
     def __init__(self, proxy, client, client_addr):
+        # 按请求的顺序: 已转发给Remote的请求的方法(等待响应), 或排在它们之后的本地响应
+        self.expected = deque()
         Forward.__init__(self, proxy, client, client_addr)
 
-    def http_response(self, path):
-        now = datetime.now()
-        stamp = mktime(now.timetuple())
-        dt = format_date_time(stamp)
-
-        tp = mimetypes.guess_type(path)[0]
-        if tp is None:
-            tp = "application/octet-stream"
-
-        with open(self.MAPPING[path], "rb") as fp:
-            body = fp.read()
-
-        http_response_tpl = [
-            "HTTP/1.1 200 OK",
-            "Date: %s" % dt,
-            "Server: HttpRedirectionServer",
-            "Content-Length: %s" % len(body),
-            "Content-Type: %s" % tp,
-            "Connection: keep-alive",
-            "",
-            body
-        ]
-
-        return "\r\n".join(http_response_tpl)
-
-    def process_down_recv(self, data):
-        """处理从Client接收到的数据
-        @param data: 从Client接收到的数据
-        @return: (processed_recv_data, response_data)
-                processed_recv_data: 对接收到的数据进行处理, 处理完之后再转发到远程
-                response_data: 返回给Client的数据
+    def create_down_pipeline(self):
+        return Pipeline(HttpStage(self.on_request))
+
+    def create_up_pipeline(self):
+        return Pipeline(HttpStage(None, self.on_response_end, self.response_body_length))
+
+    def local_response(self, method, path):
         """
-        for path in self.MAPPING:
-            if data.startswith("GET %s" % path):
-                return ("", self.http_response(path))
-        else:
-            data = data.replace("%s:%d" % self.proxy.bind_addr, "%s:%d" % self.proxy.remote_addr)
+        @return: 响应的数据块list, None表示不在本地处理
+        """
+        filename = self.MAPPING.get(path)
+        if filename is None or method not in ("GET", "HEAD"):
+            return None
+        try:
+            entry = self.cache.get(filename)
+        except (IOError, OSError) as e:
+            logging.warning("Can not serve %s: %s", path, e)
+            return None
+        chunks = ["HTTP/1.1 200 OK\r\nDate: %s\r\n" % http_date(), entry.headers]
+        if method == "GET":
+            chunks.append(entry.content())
+        return chunks
+
+    def on_request(self, head):
+        """处理从Client接收到的请求头
+        @return: (processed_head, response_data)
+        """
+        method, _, rest = head.partition(" ")
+        path = rest.split(" ", 1)[0].split("?", 1)[0]
+        chunks = self.local_response(method, path)
+        if chunks is None:
+            self.expected.append(method)
+            return (head.replace("%s:%d" % self.proxy.bind_addr, "%s:%d" % self.proxy.remote_addr), None)
+        if self.expected:   # 之前的请求还没有响应完, 本地响应排在它们之后
+            self.expected.append(chunks)
+            return ("", None)
+        return ("", chunks)
 
-        return (data, None)
+    def response_body_length(self, head):
+        return response_body_length(head, self.expected[0] if self.expected else "GET")
+
+    def on_response_end(self, head):
+        """Remote的一个响应结束, 发送排在它之后的本地响应
+        """
+        if head[9:10] == "1":   # 1xx是中间响应, 之后还有最终的响应
+            return None
+        if self.expected:
+            self.expected.popleft()
+        chunks = []
+        while self.expected and isinstance(self.expected[0], list):
+            chunks.extend(self.expected.popleft())
+        return chunks
 
 def main():
-    import os
     logging.basicConfig(level=logging.DEBUG)
     work_dir = os.path.dirname(__file__)
     if work_dir:
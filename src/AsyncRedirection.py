@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 基于asyncio(Protocol/Transport)的转发引擎, 需要Python 3.5+, 安装了uvloop时可以使用uvloop
+#
+#   AsyncLocalRedirection   与TcpLocalRedirection相同(单个remote)
+#   AsyncRRDServer          与RRDServer相同, 兼容RRDClient(private连接与FLAG_ADAPTIVE/FLAG_PAIRED的控制头),
+#                           不支持多路复用tunnel, 不压缩(对FLAG_ZLIB回复"{[(Z000)]}", RRDClient不压缩传输)
+#   AsyncRRDClient          与RRDClient相同, 使用固定大小的private连接池
+#
+#   写缓冲与流量控制由transport完成: 一端的写缓冲超过max_buf_size时(pause_writing)暂停读取另一端.
+#   一端发送EOF时对另一端write_eof(半关闭), 两个方向都结束后关闭.
+#
+#   Forward的拦截方法process_down_recv/process_up_recv的参数与返回值与TcpLocalRedirection.Forward相同,
+#   text_mode为真时data按latin-1解码成str(与Python 2的str一样逐字节对应), 返回的str再按latin-1编码.
+#   拦截方法对每次收到的数据块调用一次, data只是这一块, 可能是不完整的一行或报文头, 之前的数据已经转发.
+#   (TcpLocalRedirection传入的是接收缓冲中还没有发出的数据, 多数时候也只是最近收到的一块.)
+#   所以只处理单个数据块的Forward子类(记录, 块内的替换)不需要修改; 需要完整的行或报文头的,
+#   改用create_down_pipeline/create_up_pipeline返回的Filters.Pipeline(HeadStage, HttpStage等自己缓存不完整的部分),
+#   Pipeline同样按text_mode处理.
+#
+#   嵌入已有的asyncio服务:
+#       lrd = AsyncLocalRedirection(bind_addr, remote_addr)
+#       await lrd.start()
+#       ...
+#       lrd.close()
+#       await lrd.wait_closed()
+#   单独运行: lrd.main_loop(), 或run([lrd, ...])
+#
+
+import re
+import random
+import logging
+import asyncio
+from collections import OrderedDict
+
+from Filters import FileRegion
+
+
+PRIVATE_HEAD_SIZE = 10
+PRIVATE_HEAD_REGEX = re.compile(r"^\{\[\((\d{4}|X\d{3})\)\]\}$".encode("ascii"))
+FLAG_MUX = 1
+FLAG_ADAPTIVE = 2
+FLAG_ZLIB = 4
+FLAG_PAIRED = 8
+CONTROL_HEAD_REGEX = re.compile(r"^\{\[\(([A-Z])(\d{3})\)\]\}$".encode("ascii"))
+RETRY_DELAY = 1     # RRDClient连接失败后, 这么久(秒)之后再补充连接
+
+
+def new_event_loop(use_uvloop=True):
+    """
+    @param use_uvloop: 安装了uvloop时使用uvloop
+    """
+    if use_uvloop:
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            pass
+    return asyncio.new_event_loop()
+
+
+def run(redirections, use_uvloop=True):
+    """在新的事件循环中运行一个或多个Redirection, 直到被中断
+    """
+    loop = new_event_loop(use_uvloop)
+    asyncio.set_event_loop(loop)
+    try:
+        for redirection in redirections:
+            redirection.loop = loop
+            loop.run_until_complete(redirection.start())
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for redirection in redirections:
+            redirection.close()
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+
+class _Side(asyncio.Protocol):
+    """一个连接. 事件交给handler(Forward, 或者还没有配对时交给Redirection)处理
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.transport = None
+        self.addr = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        self.handler.on_made(self)
+
+    def data_received(self, data):
+        self.handler.on_recv(self, data)
+
+    def eof_received(self):
+        return self.handler.on_eof(self)
+
+    def connection_lost(self, exc):
+        self.handler.on_lost(self)
+
+    def pause_writing(self):
+        self.handler.pause_writing(self)
+
+    def resume_writing(self):
+        self.handler.resume_writing(self)
+
+    def write(self, data):
+        if data and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def close(self):
+        if self.transport:
+            self.transport.close()  # 写缓冲中的数据发送完后关闭
+
+
+class Forward(object):
+    text_mode = True    # 拦截方法收发latin-1解码的str, 为假时收发bytes
+
+    def __init__(self, proxy, client, client_addr):
+        """
+        @param client: 已建立的down一端(_Side)
+        """
+        self.proxy = proxy
+        self.down = client
+        self.up = None
+        self.client_addr = client_addr
+        self.pending = []       # up建立之前down发来的数据
+        self.pending_size = 0
+        self.eof = set()        # 已经发送EOF的一端
+        self.closed = False
+        self.intercept_down = _overrides(self, "process_down_recv")
+        self.intercept_up = _overrides(self, "process_up_recv")
+        self.down_pipeline = self.create_down_pipeline()
+        self.up_pipeline = self.create_up_pipeline()
+        client.handler = self
+        client.transport.set_write_buffer_limits(proxy.max_buf_size)
+
+    def other(self, side):
+        return self.up if side is self.down else self.down
+
+    def attach_up(self, side):
+        """up一端已建立
+        """
+        if self.closed:
+            side.close()
+            return
+        self.up = side
+        side.handler = self
+        side.transport.set_write_buffer_limits(self.proxy.max_buf_size)
+        for data in self.pending:
+            side.write(data)
+        self.pending = []
+        self.pending_size = 0
+        if self.down in self.eof:
+            self._write_eof(side)
+        else:
+            self.down.transport.resume_reading()
+
+    def on_made(self, side):
+        pass
+
+    def on_recv(self, side, data):
+        if side is self.down:
+            intercept, process, pipeline = self.intercept_down, self.process_down_recv, self.down_pipeline
+        else:
+            intercept, process, pipeline = self.intercept_up, self.process_up_recv, self.up_pipeline
+        if pipeline:
+            for chunk in pipeline.feed(data.decode("latin-1") if self.text_mode else data):
+                self._forward(side, _to_bytes(chunk))
+            for response in pipeline.take_responses():
+                side.write(_to_bytes(response))
+            return
+        if intercept:
+            rdata, sdata = process(data.decode("latin-1") if self.text_mode else data)
+            if sdata is not None:
+                side.write(_to_bytes(sdata))
+            if rdata is not None:
+                data = _to_bytes(rdata)
+        self._forward(side, data)
+
+    def _forward(self, side, data):
+        """把从side收到的数据发送到另一端, 另一端还没有建立时暂存
+        """
+        other = self.other(side)
+        if other:
+            other.write(data)
+        elif data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size >= self.proxy.max_buf_size:
+                side.transport.pause_reading()
+
+    def on_eof(self, side):
+        self.eof.add(side)
+        pipeline = self.down_pipeline if side is self.down else self.up_pipeline
+        if pipeline:
+            for chunk in pipeline.flush():
+                self._forward(side, _to_bytes(chunk))
+        other = self.other(side)
+        if other:
+            self._write_eof(other)
+        if len(self.eof) == 2:
+            self.close()
+            return False
+        return True     # 保持半关闭, 另一个方向继续转发
+
+    def _write_eof(self, side):
+        if side.transport.can_write_eof():
+            side.transport.write_eof()
+        else:
+            self.close()
+
+    def on_lost(self, side):
+        self.close()
+
+    def pause_writing(self, side):
+        other = self.other(side)
+        if other:
+            other.transport.pause_reading()
+
+    def resume_writing(self, side):
+        other = self.other(side)
+        if other and other not in self.eof:
+            other.transport.resume_reading()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for side in (self.up, self.down):
+            if side:
+                side.close()
+        self.proxy.on_forward_closed(self)
+
+    # ----- 对转发进行拦截 -----
+
+    def create_down_pipeline(self):
+        """
+        @return: 流式处理从Client接收到的数据的Filters.Pipeline, 使用时不再调用process_down_recv. None表示不使用
+        """
+        return None
+
+    def create_up_pipeline(self):
+        """
+        @return: 流式处理从Remote接收到的数据的Filters.Pipeline, 使用时不再调用process_up_recv. None表示不使用
+        """
+        return None
+
+    def process_down_recv(self, data):
+        """处理从Client接收到的数据
+        @param data: 从Client接收到的一个数据块, 不一定是完整的报文(见模块说明)
+        @return: (processed_recv_data, response_data)
+                processed_recv_data: 对接收到的数据进行处理, 处理完之后再转发到远程
+                response_data: 返回给Client的数据
+                (None表示不处理)
+        """
+        return (None, None)
+
+    def process_up_recv(self, data):
+        """处理从Remote接收到的数据
+        @param data: 从Remote接收到的一个数据块, 不一定是完整的报文(见模块说明)
+        @return: (processed_recv_data, response_data)
+                processed_recv_data: 对接收到的数据进行处理, 处理完之后再转发到Client
+                response_data: 返回给Remote的数据
+                (None表示不处理)
+        """
+        return (None, None)
+
+
+def _overrides(forward, name):
+    return getattr(type(forward), name) is not getattr(Forward, name)
+
+
+def _to_bytes(data):
+    if isinstance(data, FileRegion):
+        return data.tobytes()   # transport的写缓冲与sendfile不能混用, 读出后写入
+    return data if isinstance(data, bytes) else data.encode("latin-1")
+
+
+class AsyncRedirection(object):
+    def __init__(self, max_buf_size, forward=None, connect_timeout=10, loop=None):
+        """
+        @param loop: 事件循环, None表示start()时的当前事件循环
+        """
+        self.max_buf_size = max_buf_size
+        self.Forward = forward if forward else Forward
+        self.connect_timeout = connect_timeout
+        self.loop = loop
+        self.forwards = set()
+        self.servers = []
+        self.closed = False
+
+    def start(self):
+        """
+        @return: awaitable, 开始监听后完成
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        future = self.loop.create_future()
+        future.set_result(None)
+        return future
+
+    def listen(self, bind_addr):
+        """
+        @return: Task, 开始监听后完成
+        """
+        coro = self.loop.create_server(lambda: _Side(self), bind_addr[0], bind_addr[1], reuse_address=True)
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        task.add_done_callback(lambda t: t.cancelled() or t.exception() or self.servers.append(t.result()))
+        return task
+
+    def connect(self, addr, handler, callback):
+        """非阻塞地连接addr, 完成后调用callback(side), 失败时side为None
+        """
+        side = _Side(handler)
+        coro = self.loop.create_connection(lambda: side, addr[0], addr[1])
+        task = asyncio.ensure_future(asyncio.wait_for(coro, self.connect_timeout), loop=self.loop)
+
+        def done(task):
+            if task.cancelled() or task.exception():
+                error = "cancelled" if task.cancelled() else task.exception()
+                logging.warning("Connect to [%s:%s] fail: %s", addr[0], addr[1], error)
+                callback(None)
+            else:
+                callback(side)
+        task.add_done_callback(done)
+        return task
+
+    def add_forward(self, side):
+        fw = self.Forward(self, side, side.addr)
+        self.forwards.add(fw)
+        return fw
+
+    def connect_up(self, fw, addr):
+        """为fw连接up一端
+        """
+        def done(side):
+            if side is None:
+                fw.close()
+            else:
+                fw.attach_up(side)
+        self.connect(addr, fw, done)    # attach_up之前up发来的数据同样交给fw
+
+    def on_forward_closed(self, fw):
+        self.forwards.discard(fw)
+
+    # 尚未属于任何Forward的连接(见_Side.handler)
+
+    def on_made(self, side):
+        pass
+
+    def on_recv(self, side, data):
+        pass
+
+    def on_eof(self, side):
+        return False
+
+    def on_lost(self, side):
+        pass
+
+    def pause_writing(self, side):
+        pass
+
+    def resume_writing(self, side):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for server in self.servers:
+            server.close()
+        for fw in list(self.forwards):
+            fw.close()
+
+    def wait_closed(self):
+        """
+        @return: awaitable
+        """
+        return asyncio.gather(*[server.wait_closed() for server in self.servers])
+
+    def main_loop(self, use_uvloop=True):
+        """与TcpLocalRedirection.main_loop相同, 单独运行(阻塞)
+        """
+        run([self], use_uvloop)
+
+
+class AsyncLocalRedirection(AsyncRedirection):
+    def __init__(self, bind_addr, remote_addr, max_buf_size=1024*64, forward=None, connect_timeout=10, loop=None):
+        AsyncRedirection.__init__(self, max_buf_size, forward, connect_timeout, loop)
+        self.bind_addr = bind_addr
+        self.remote_addr = remote_addr
+
+    def start(self):
+        AsyncRedirection.start(self)
+        return self.listen(self.bind_addr)
+
+    def on_made(self, side):
+        logging.info("Accept conn[%s:%s]" % side.addr[:2])
+        fw = self.add_forward(side)
+        self.connect_up(fw, self.remote_addr)
+
+
+class AsyncRRDServer(AsyncRedirection):
+    def __init__(self, bind_addr, max_buf_size=1024*64, forward=None, loop=None):
+        AsyncRedirection.__init__(self, max_buf_size, forward, loop=loop)
+        self.bind_addr = bind_addr
+        self.idle_tunnels = OrderedDict()       # 空闲的private连接(_Side) -> flags
+        self.waiting_clients = OrderedDict()    # 等待配对的open连接的forward
+        self.buffers = {}                       # 尚未确定类型的连接(_Side) -> 已收到的数据
+
+    def start(self):
+        AsyncRedirection.start(self)
+        return self.listen(self.bind_addr)
+
+    def on_made(self, side):
+        self.buffers[side] = b""
+
+    def on_recv(self, side, data):
+        if side in self.idle_tunnels:
+            logging.error("Unexpected data from idle [private-connection], close it.")
+            side.close()
+            return
+        head = self.buffers[side] + data
+        tp = classify(head)
+        if tp is None:
+            self.buffers[side] = head   # 还不能确定类型
+            return
+        del self.buffers[side]
+        if tp == "open":
+            logging.info("Accept [open-connection]")
+            fw = self.add_forward(side)
+            self.waiting_clients[fw] = None
+            fw.on_recv(side, head)
+        else:
+            flags = int(head[4:7]) if head[3:4] == b"X" else 0
+            if flags & FLAG_MUX:
+                logging.warning("Reject [mux-tunnel]: not supported by %s.", type(self).__name__)
+                side.close()
+                return
+            logging.info("Accept [private-connection]")
+            self.idle_tunnels[side] = flags
+        self.pair_forwards()
+
+    def pair_forwards(self):
+        while self.idle_tunnels and self.waiting_clients:
+            side, flags = self.idle_tunnels.popitem(last=False)
+            fw, _ = self.waiting_clients.popitem(last=False)
+            # 控制头的顺序与RRDServer.pair_forwards相同
+            if flags & FLAG_ADAPTIVE:
+                grow = len(self.waiting_clients) + 1 if self.waiting_clients else 0
+                side.write(("{[(G%03d)]}" % min(grow, 999)).encode("ascii"))
+            if flags & FLAG_ZLIB:
+                side.write(b"{[(Z000)]}")  # 拒绝压缩
+            if flags & FLAG_PAIRED:
+                side.write(b"{[(P000)]}")
+            fw.attach_up(side)
+
+    def on_eof(self, side):
+        self.on_lost(side)
+        return False
+
+    def on_lost(self, side):
+        self.buffers.pop(side, None)
+        self.idle_tunnels.pop(side, None)
+        side.close()
+
+    def on_forward_closed(self, fw):
+        AsyncRedirection.on_forward_closed(self, fw)
+        self.waiting_clients.pop(fw, None)
+
+    def close(self):
+        AsyncRedirection.close(self)
+        for side in list(self.idle_tunnels) + list(self.buffers):
+            side.close()
+
+
+def classify(head):
+    """
+    @return: "private", "open", None表示数据还不够确定类型
+    """
+    if len(head) >= PRIVATE_HEAD_SIZE:
+        return "private" if PRIVATE_HEAD_REGEX.match(head[:PRIVATE_HEAD_SIZE]) else "open"
+    for idx, c in enumerate(head.decode("latin-1")):
+        if idx == 3 and c == "X":
+            continue
+        if 3 <= idx < 7:
+            if not "0" <= c <= "9":
+                return "open"
+        elif "{[(0000)]}"[idx] != c:
+            return "open"
+    return None
+
+
+class AsyncRRDClient(AsyncRedirection):
+    def __init__(self, rrd_server_addr, server_addr, max_buf_size=1024*64, forward=None, connect_timeout=10,
+                 pool_size=2, paired=False, loop=None):
+        """
+        @param pool_size: 空闲private连接的数量
+        @param paired: 请求FLAG_PAIRED控制头, 配对后立即连接Server(由服务端先发送数据的协议也可以转发).
+                需要RRDServer认识"{[(Xnnn)]}"标识头, 默认False时只发送旧版的"{[(nnnn)]}"
+        """
+        AsyncRedirection.__init__(self, max_buf_size, forward, connect_timeout, loop)
+        self.rrd_server_addr = rrd_server_addr
+        self.server_addr = server_addr
+        self.pool_size = pool_size
+        self.paired = paired
+        self.pool = {}          # 空闲的private连接(_Side) -> 已收到的控制头
+        self.connecting = 0
+        self.retry_handle = None
+
+    def start(self):
+        future = AsyncRedirection.start(self)
+        self.fill_pool()
+        return future
+
+    def fill_pool(self):
+        self.retry_handle = None
+        while not self.closed and len(self.pool) + self.connecting < self.pool_size:
+            self.connecting += 1
+            self.connect(self.rrd_server_addr, self, self.on_private_connected)
+
+    def on_private_connected(self, side):
+        self.connecting -= 1
+        if side is None:
+            if self.retry_handle is None and not self.closed:
+                self.retry_handle = self.loop.call_later(RETRY_DELAY, self.fill_pool)
+            return
+        if self.closed:
+            side.close()
+            return
+        if self.paired:
+            side.write(("{[(X%03d)]}" % FLAG_PAIRED).encode("ascii"))
+        else:
+            side.write(("{[(%04d)]}" % random.randint(1, 9999)).encode("ascii"))
+        self.pool[side] = b""
+
+        logging.info("Create [private-connection] to RRDServer[%s:%s]." % self.rrd_server_addr)
+
+    def on_recv(self, side, data):
+        """RRDServer已经把这个private连接与open连接配对
+        """
+        if self.paired:
+            data = self.pool[side] + data
+            if len(data) < PRIVATE_HEAD_SIZE:
+                self.pool[side] = data  # 控制头还不完整
+                return
+            match = CONTROL_HEAD_REGEX.match(data[:PRIVATE_HEAD_SIZE])
+            if not match or match.group(1) != b"P":
+                logging.error("Invalid control head from RRDServer.")
+                self.on_lost(side)
+                return
+            data = data[PRIVATE_HEAD_SIZE:]
+        del self.pool[side]
+        self.fill_pool()
+        fw = self.add_forward(side)
+        self.connect_up(fw, self.server_addr)
+        if data:
+            fw.on_recv(side, data)
+
+    def on_eof(self, side):
+        self.on_lost(side)
+        return False
+
+    def on_lost(self, side):
+        if side in self.pool:
+            del self.pool[side]
+            side.close()
+            self.fill_pool()
+
+    def close(self):
+        AsyncRedirection.close(self)
+        if self.retry_handle:
+            self.retry_handle.cancel()
+        for side in list(self.pool):
+            side.close()
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.DEBUG)
+    if sys.argv[1:] == ["server"]:
+        AsyncRRDServer(("127.0.0.1", 1234)).main_loop()
+    elif sys.argv[1:] == ["client"]:
+        AsyncRRDClient(("127.0.0.1", 1234), ("127.0.0.1", 22)).main_loop()
+    else:
+        AsyncLocalRedirection(("127.0.0.1", 1234), ("127.0.0.1", 22)).main_loop()
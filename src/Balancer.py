@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 多个后端之间的负载均衡与健康检查
+#
+#   策略:
+#       round_robin     平滑加权轮询
+#       least_active    当前转发数/权重 最小的后端
+#       hash            按client ip做一致性hash, 同一个client总是落在同一个后端(后端不可用时顺延)
+#
+#   HealthChecker由proxy.timers定期对每个后端做非阻塞connect, 连续fall次失败标记为不可用,
+#   连续rise次成功恢复. 转发时connect失败同样计入失败次数.
+#
+
+import errno
+import socket
+import struct
+import bisect
+import hashlib
+import logging
+
+
+class Backend(object):
+    def __init__(self, addr, weight=1):
+        self.addr = addr
+        self.weight = weight
+        self.active = 0         # 当前的转发数
+        self.healthy = True
+        self.fails = 0          # 连续失败次数
+        self.successes = 0      # 不可用时的连续成功次数
+        self.current = 0        # 平滑加权轮询的当前权重
+        self.pool = None        # Upstream.UpstreamPool
+
+    def __repr__(self):
+        return "%s:%s" % self.addr
+
+
+class Balancer(object):
+    STRATEGIES = ("round_robin", "least_active", "hash")
+    VNODES = 100    # 一致性hash中每单位权重的虚拟节点数
+
+    def __init__(self, backends, strategy="round_robin", rise=2, fall=3):
+        """
+        @param backends: [Backend, ...]
+        @param rise, fall: 连续成功/失败多少次后改变后端的可用状态
+        """
+        if strategy not in self.STRATEGIES:
+            raise ValueError("Unknown strategy: %s" % strategy)
+        self.backends = backends
+        self.strategy = strategy
+        self.rise = rise
+        self.fall = fall
+        self._ring = []     # [(hash, backend)]
+        if strategy == "hash":
+            for backend in backends:
+                for i in xrange(self.VNODES * backend.weight):
+                    self._ring.append((_hash("%s:%s#%d" % (backend.addr[0], backend.addr[1], i)), backend))
+            self._ring.sort(key=lambda item: item[0])
+
+    def choose(self, client_addr, exclude=()):
+        """
+        @param exclude: 已经尝试过的后端
+        @return: Backend, 没有可用的后端时返回None. 全部后端都不可用时仍然尝试其中之一
+        """
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        healthy = [b for b in candidates if b.healthy]
+        if healthy:
+            candidates = healthy
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.strategy == "least_active":
+            return min(candidates, key=lambda b: float(b.active) / b.weight)
+        if self.strategy == "hash":
+            return self._choose_hash(client_addr[0], candidates)
+        # 平滑加权轮询(与nginx相同): 权重大的后端被选中的次数多, 但不会连续集中
+        total = 0
+        best = None
+        for backend in candidates:
+            backend.current += backend.weight
+            total += backend.weight
+            if best is None or backend.current > best.current:
+                best = backend
+        best.current -= total
+        return best
+
+    def _choose_hash(self, key, candidates):
+        idx = bisect.bisect(self._ring, (_hash(key),))
+        for i in xrange(len(self._ring)):
+            backend = self._ring[(idx + i) % len(self._ring)][1]
+            if backend in candidates:
+                return backend
+
+    def report(self, backend, ok):
+        """记录一次connect(转发或健康检查)的结果
+        """
+        if ok:
+            backend.fails = 0
+            if not backend.healthy:
+                backend.successes += 1
+                if backend.successes >= self.rise:
+                    backend.healthy = True
+                    logging.info("Backend[%s] is up.", backend)
+        else:
+            backend.successes = 0
+            backend.fails += 1
+            if backend.healthy and backend.fails >= self.fall:
+                backend.healthy = False
+                logging.warning("Backend[%s] is down.", backend)
+
+
+class HealthChecker(object):
+    def __init__(self, proxy, balancer, interval=5, timeout=2):
+        """
+        @param proxy: 所属的Redirection, 检查用的socket注册在proxy._forwards中
+        @param interval: 每个后端的检查间隔(秒)
+        @param timeout: connect超时(秒)
+        """
+        self.proxy = proxy
+        self.balancer = balancer
+        self.interval = interval
+        self.timeout = timeout
+        self._probes = {}       # sock -> (backend, 超时定时器)
+        self.stopped = False
+        for backend in balancer.backends:
+            proxy.timers.call_later(0, self._probe, backend)
+
+    def stop(self):
+        """不再开始新的检查
+        """
+        self.stopped = True
+
+    def _probe(self, backend):
+        if self.stopped:
+            return
+        timers = self.proxy.timers
+        timers.call_later(self.interval, self._probe, backend)
+        if any(b is backend for b, _ in self._probes.itervalues()):
+            return  # 上一次检查还没有结束
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            err = sock.connect_ex(self.proxy.resolver.resolve(backend.addr))
+        except socket.error:
+            err = errno.EHOSTUNREACH
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            sock.close()
+            self.balancer.report(backend, False)
+            return
+        self._probes[sock] = (backend, timers.call_later(self.timeout, self._finish, sock, False))
+        self.proxy._forwards[sock] = self
+        self.proxy.w_list.add(sock)
+
+    def _finish(self, sock, ok):
+        backend, timer = self._probes.pop(sock)
+        self.proxy.timers.cancel(timer)
+        self.proxy._forwards.pop(sock, None)
+        self.proxy.r_list.discard(sock)
+        self.proxy.w_list.discard(sock)
+        sock.close()
+        self.balancer.report(backend, ok)
+
+    def on_send(self, sock):
+        self._finish(sock, sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0)
+
+    def on_recv(self, sock):    # never happen
+        self._finish(sock, False)
+
+    def close(self, sock=None):
+        if sock in self._probes:
+            self._finish(sock, False)
+
+
+def _hash(key):
+    return struct.unpack("!I", hashlib.md5(key).digest()[:4])[0]
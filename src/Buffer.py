@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 连接的接收缓冲
+#
+#   数据放在一块bytearray中, recv_into直接写入尾部, send从头部的memoryview切片发送,
+#   避免 rbuf += data / rbuf = rbuf[ssize:] 带来的反复拷贝.
+#   bytearray在有数据时才从共用的pool(BufferPool)取得, 缓冲变空时归还, 空闲连接不占用内存.
+#   write()追加的数据(拦截产生的响应等)放在缓冲之后的队列里, 与缓冲中的数据一起用sendmsg(writev)发送, 不需要拼接.
+#   队列中的Filters.FileRegion(文件的一段)用sendfile发送, 文件内容不经过用户空间.
+#
+#   PipeBuffer以内核pipe作为缓冲, 数据通过splice在socket与pipe之间移动, 完全不经过
+#   用户空间, 用于不需要拦截数据的转发.
+#
+#   所有缓冲中的数据量计入进程内共用的budget(BufferBudget), FileRegion的数据不在内存中, 不计入. 设置了上限时, Connection按
+#   budget.allowance()减少每次接收的数据量, 使进程占用的内存不随慢速连接的数量无限增长.
+#   budget不加锁, 一个进程中只有一个事件循环线程时才准确.
+#
+
+import os
+import sys
+import errno
+import fcntl
+import socket
+import struct
+import termios
+from collections import deque
+
+from Syscalls import splice, sendfile, sendmsg, SPLICE_F_MOVE, SPLICE_F_NONBLOCK
+from Filters import FileRegion
+
+
+PIPE_CAPACITY = 256 * 1024      # PipeBuffer的容量
+SENDFILE_CHUNK = 1024 * 1024    # 每次sendfile最多发送的字节数
+SENDMSG_MAX = 64                # 每次sendmsg最多发送的数据块数
+SHRINK_AFTER = 8                # 连接连续这么多次接收后缓冲占用不到1/4, 缓冲大小减半
+
+
+class BufferBudget(object):
+    """进程内所有缓冲共用的内存预算
+        用量低于low_water时不限制; 超过后每个缓冲最多持有公平的一份(limit / 持有数据的缓冲数),
+        持有得多的连接先停止读取; 达到limit后所有连接都停止读取, 也不再accept新连接.
+    """
+    def __init__(self, limit=0):
+        self.used = 0       # 所有缓冲中的数据量
+        self.holders = 0    # 持有数据的缓冲数
+        self.set_limit(limit)
+
+    def set_limit(self, limit):
+        """
+        @param limit: 字节数, 0表示不限制(仍然统计用量)
+        """
+        self.limit = limit
+        self.low_water = limit * 3 // 4
+
+    def allowance(self, size):
+        """
+        @param size: 缓冲中已有的数据量
+        @return: 这个缓冲现在最多还能接收的字节数
+        """
+        if not self.limit:
+            return sys.maxsize
+        if self.used < self.low_water:
+            return self.limit - self.used
+        return max(0, min(self.limit - self.used, self.limit // (self.holders + 1) - size))
+
+    @property
+    def exhausted(self):
+        return self.limit and self.used >= self.limit
+
+    @property
+    def tight(self):
+        """用量还没有回落到low_water以下
+        """
+        return self.limit and self.used >= self.low_water
+
+budget = BufferBudget()
+
+
+class BufferPool(object):
+    """按2的幂大小分级保存空闲的bytearray, 供所有Buffer复用
+    """
+    MIN_SIZE = 4096
+
+    def __init__(self, max_idle=8 * 1024 * 1024):
+        """
+        @param max_idle: 最多保留的空闲字节数, 超出的部分归还时直接释放
+        """
+        self.max_idle = max_idle
+        self.free = {}      # size -> [bytearray, ...]
+        self.idle = 0       # free中的字节数
+        self.in_use = 0     # 已取出的字节数
+
+    def acquire(self, size):
+        """
+        @return: 长度不小于size的bytearray
+        """
+        cls = self.MIN_SIZE
+        while cls < size:
+            cls <<= 1
+        free = self.free.get(cls)
+        if free:
+            buf = free.pop()
+            self.idle -= cls
+        else:
+            buf = bytearray(cls)
+        self.in_use += cls
+        return buf
+
+    def release(self, buf):
+        size = len(buf)
+        self.in_use -= size
+        if self.idle + size <= self.max_idle:
+            self.free.setdefault(size, []).append(buf)
+            self.idle += size
+
+pool = BufferPool()
+
+
+def _account(before, after):
+    """一个缓冲中的数据量从before变为after
+    """
+    budget.used += after - before
+    if not before:
+        if after:
+            budget.holders += 1
+    elif not after:
+        budget.holders -= 1
+
+
+class Buffer(object):
+    stalled = False     # 缓冲未满但已无法再接收, 见PipeBuffer
+    closed = False
+
+    def __init__(self):
+        self._buf = None        # 从pool取得的bytearray, 没有数据时为None
+        self._view = None
+        self.emptied = False    # 数据曾经被全部发送完(由Connection用于调整缓冲大小)
+        self._start = 0
+        self._end = 0
+        self._queue = deque()   # 排在_buf数据之后的数据块(memoryview或FileRegion)
+        self._queued = 0
+        self._regions = 0       # 队列中FileRegion的字节数
+
+    def __len__(self):
+        return self._end - self._start + self._queued
+
+    @property
+    def memory(self):
+        """在内存中的数据量(不包括FileRegion), 计入budget
+        """
+        return self._end - self._start + self._queued - self._regions
+
+    def _reserve(self, size):
+        """保证_buf尾部至少有size字节可写
+        """
+        buf = self._buf
+        if buf is not None and self._end + size <= len(buf):
+            return
+        used = self._end - self._start
+        if buf is None or used + size > len(buf):
+            new = pool.acquire(used + size)
+            if used:
+                new[:used] = self._view[self._start:self._end]
+            if buf is not None:
+                pool.release(buf)
+            self._buf, self._view = new, memoryview(new)
+        elif used:
+            buf[:used] = self._view[self._start:self._end]
+        self._start, self._end = 0, used
+
+    def _release(self):
+        """_buf中已经没有数据, 归还给pool
+        """
+        if self._buf is not None:
+            pool.release(self._buf)
+            self._buf = self._view = None
+        self._start = self._end = 0
+
+    def recv_from(self, sock, size):
+        """从sock读取最多size字节, socket.error由调用者处理
+        @return: 读到的字节数, 0表示连接断开
+        """
+        before = len(self)
+        if self._queue:     # 保持顺序, 新数据只能排在队列之后
+            data = sock.recv(size)
+            if data:
+                memory = self.memory
+                self._queue.append(memoryview(data))
+                self._queued += len(data)
+                _account(memory, memory + len(data))
+            return len(data)
+        self._reserve(size)
+        end = self._end
+        try:
+            rsize = sock.recv_into(self._view[end:end + size], size)
+        except socket.error:
+            if not before:
+                self._release()
+            raise
+        if rsize:
+            self._end = end + rsize
+            _account(before, before + rsize)    # _queue为空, before就是内存中的数据量
+        elif not before:
+            self._release()
+        return rsize
+
+    def send_to(self, sock):
+        """发送头部的数据, 多段数据(队列中的数据块)用sendmsg一次发送, socket.error由调用者处理
+        @return: 发送的字节数
+        """
+        chunks = []
+        if self._end > self._start:
+            chunks.append(self._view[self._start:self._end])
+        for chunk in self._queue:
+            if isinstance(chunk, FileRegion) or len(chunks) >= SENDMSG_MAX:
+                break
+            chunks.append(chunk)
+        if not chunks:
+            if not self._queue:
+                return 0
+            ssize = _send_region(sock, self._queue[0])
+        elif len(chunks) == 1 or sendmsg is None:
+            ssize = sock.send(chunks[0])
+        else:
+            ssize = sendmsg(sock, chunks)
+        self.consume(ssize)
+        return ssize
+
+    def consume(self, size):
+        """丢弃头部size字节
+        """
+        if not size:
+            return
+        memory = self.memory
+        used = self._end - self._start
+        if size < used:
+            self._start += size
+            _account(memory, memory - size)
+            return
+        self._release()
+        size -= used
+        while size:
+            chunk = self._queue[0]
+            consumed = min(size, len(chunk))
+            if consumed < len(chunk):
+                self._queue[0] = chunk[consumed:]
+            else:
+                self._queue.popleft()
+            if isinstance(chunk, FileRegion):
+                self._regions -= consumed
+            self._queued -= consumed
+            size -= consumed
+        _account(memory, self.memory)
+        if not self._queued:
+            self.emptied = True
+
+    @property
+    def fragmented(self):
+        """数据分成了多段(拦截产生的响应, 文件等), 发送时可以用TCP_CORK合并成完整的报文段
+        """
+        return len(self._queue) > (0 if self._end > self._start else 1)
+
+    def write(self, data):
+        """在尾部追加data
+        """
+        if not data:
+            return
+        if isinstance(data, FileRegion):
+            self._queue.append(data)
+            self._queued += len(data)
+            self._regions += len(data)
+            return
+        _account(self.memory, self.memory + len(data))
+        if not self._queue and self._buf is not None and self._end - self._start + len(data) <= len(self._buf):
+            self._reserve(len(data))
+            self._buf[self._end:self._end + len(data)] = data
+            self._end += len(data)
+        else:
+            self._queue.append(memoryview(data))
+            self._queued += len(data)
+
+    def head(self, size):
+        """
+        @return: 头部最多size字节(str), 不会从缓冲中移除
+        """
+        data = self._view[self._start:min(self._end, self._start + size)].tobytes() if self._end > self._start else ""
+        for chunk in self._queue:
+            if len(data) >= size:
+                break
+            data += chunk[:size - len(data)].tobytes()
+        return data
+
+    def getvalue(self):
+        """
+        @return: 全部数据(str)
+        """
+        data = self._view[self._start:self._end].tobytes() if self._end > self._start else ""
+        if not self._queue:
+            return data
+        chunks = [data]
+        chunks.extend(chunk.tobytes() for chunk in self._queue)
+        return "".join(chunks)
+
+    def set(self, data):
+        """用data替换全部数据
+        """
+        self.clear()
+        self.write(data)
+
+    def clear(self):
+        _account(self.memory, 0)
+        self._release()
+        self._queue.clear()
+        self._queued = self._regions = 0
+
+    def close(self):
+        self.clear()
+        self.closed = True
+
+
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+
+class PipeBuffer(object):
+    """接口与Buffer的收发部分相同, 但数据对Python不可见(不能getvalue/write)
+    """
+    available = splice is not None
+    fragmented = False
+
+    def __init__(self, capacity, data=""):
+        """
+        @param data: 预先放入pipe的数据(例如切换前Buffer中剩余的数据)
+        """
+        self._rfd, self._wfd = os.pipe()
+        try:
+            for fd in (self._rfd, self._wfd):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            while capacity > 4096:
+                try:
+                    fcntl.fcntl(self._wfd, F_SETPIPE_SZ, capacity)
+                    break
+                except IOError:
+                    capacity //= 2  # 超过了/proc/sys/fs/pipe-max-size
+            self.capacity = fcntl.fcntl(self._wfd, F_GETPIPE_SZ)
+            self._size = 0
+            self.stalled = False
+            self.closed = False
+            if data:
+                if len(data) > self.capacity or os.write(self._wfd, data) != len(data):
+                    raise IOError(errno.ENOSPC, "pipe is too small")
+                self._size = len(data)
+                _account(0, self._size)
+        except:
+            self.close()
+            raise
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def memory(self):
+        return self._size
+
+    def recv_from(self, sock, size):
+        """socket -> pipe
+        @return: 读到的字节数, 0表示连接断开
+        """
+        try:
+            rsize = splice(sock.fileno(), self._wfd, size, SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+        except (OSError, IOError), e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) and self._size and _pending(sock):
+                # pipe按页存放数据, 未达到capacity也可能放不下了, 需等send_to腾出空间
+                self.stalled = True
+            raise socket.error(e.errno, e.strerror)
+        _account(self._size, self._size + rsize)
+        self._size += rsize
+        return rsize
+
+    def send_to(self, sock):
+        """pipe -> socket
+        @return: 发送的字节数
+        """
+        if not self._size:
+            return 0
+        try:
+            ssize = splice(self._rfd, sock.fileno(), self._size, SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+        except (OSError, IOError), e:
+            raise socket.error(e.errno, e.strerror)
+        _account(self._size, self._size - ssize)
+        self._size -= ssize
+        if ssize:
+            self.stalled = False
+        return ssize
+
+    def close(self):
+        if getattr(self, "_size", 0):
+            _account(self._size, 0)
+            self._size = 0
+        for fd in (getattr(self, "_rfd", None), getattr(self, "_wfd", None)):
+            if fd is not None:
+                os.close(fd)
+        self._rfd = self._wfd = None
+        self.closed = True
+
+
+def _send_region(sock, region):
+    """用sendfile发送region头部的数据, 文件被截短时抛出socket.error
+    @return: 发送的字节数
+    """
+    size = min(len(region), SENDFILE_CHUNK)
+    if sendfile is None:
+        return sock.send(region[:size].tobytes())
+    try:
+        ssize = sendfile(sock.fileno(), region.fileno(), region.offset, size)
+    except (OSError, IOError), e:
+        raise socket.error(e.errno, e.strerror)
+    if not ssize:
+        raise socket.error(errno.EIO, "file is truncated")
+    return ssize
+
+
+def _pending(sock):
+    """sock中尚未读取的字节数
+    """
+    return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.FIONREAD, "\0" * 4))[0]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RRDServer <-> RRDClient 之间private连接的压缩
+#
+#   RRDClient在private连接的标识头中设置FLAG_ZLIB, RRDServer配对时用控制头"{[(Z001)]}"接受
+#   ("{[(Z000)]}"拒绝). 接受后两端的Forward在Pipeline中加入:
+#       CompressStage       发往tunnel的数据, 每次recv得到的数据压缩后做一次Z_SYNC_FLUSH, 对端可以立即解压
+#       DecompressStage     从tunnel收到的数据
+#   自适应: 压缩前SAMPLE_SIZE字节后, 压缩率不到1 - MAX_RATIO(TLS, 图片视频等)时用Z_FINISH结束zlib流,
+#   之后的数据原样发送. 解压一端在zlib流结束后(unused_data)同样原样通过.
+#
+
+import time
+import errno
+import socket
+import zlib
+
+from Filters import Stage
+
+
+SAMPLE_SIZE = 64 * 1024     # 按压缩前这么多字节的压缩率决定是否继续压缩
+MAX_RATIO = 0.9             # 压缩后超过压缩前的这个比例时停止压缩
+
+
+class CompressionStats(object):
+    """压缩前后的字节数与耗时, direction为send(压缩)或recv(解压)
+    """
+    def __init__(self, stats):
+        self.raw = stats.counter("tunnel_raw_bytes_total",
+                "Tunnel bytes before compression (send) or after decompression (recv).", ("direction",))
+        self.wire = stats.counter("tunnel_wire_bytes_total",
+                "Tunnel bytes on the wire of compressed private connections.", ("direction",))
+        self.seconds = stats.counter("tunnel_codec_seconds_total",
+                "Time spent compressing (send) or decompressing (recv).", ("direction",))
+        self.disabled = stats.counter("tunnel_compression_disabled_total",
+                "Streams whose compression turned off after sampling incompressible data.")
+
+
+class CompressStage(Stage):
+    joins = True
+
+    def __init__(self, level, stats):
+        """
+        @param level: zlib压缩级别(1-9)
+        @param stats: CompressionStats
+        """
+        self.compressor = zlib.compressobj(level)
+        self.stats = stats
+        self.sampled = 0        # 已采样的压缩前字节数
+        self.sampled_out = 0    # 采样部分压缩后的字节数
+
+    def feed(self, data):
+        stats = self.stats
+        stats.raw.inc(len(data), "send")
+        if self.compressor is None:
+            stats.wire.inc(len(data), "send")
+            return [data]
+        start = time.time()
+        compressor = self.compressor
+        out = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.sampled < SAMPLE_SIZE:
+            self.sampled += len(data)
+            self.sampled_out += len(out)
+            if self.sampled >= SAMPLE_SIZE and self.sampled_out > self.sampled * MAX_RATIO:
+                out += compressor.flush(zlib.Z_FINISH)  # 结束zlib流, 之后的数据不再压缩
+                self.compressor = None
+                stats.disabled.inc()
+        stats.seconds.inc(time.time() - start, "send")
+        stats.wire.inc(len(out), "send")
+        return [out]
+
+
+class DecompressStage(Stage):
+    """数据无法解压时抛出socket.error, Connection.recv_through按连接断开处理
+    """
+    def __init__(self, stats):
+        self.decompressor = zlib.decompressobj()
+        self.stats = stats
+
+    def feed(self, data):
+        stats = self.stats
+        stats.wire.inc(len(data), "recv")
+        if self.decompressor is None:
+            stats.raw.inc(len(data), "recv")
+            return [data]
+        start = time.time()
+        decompressor = self.decompressor
+        try:
+            out = decompressor.decompress(data)
+        except zlib.error, e:
+            raise socket.error(errno.EPROTO, "Invalid compressed data: %s" % e)
+        if decompressor.unused_data:    # 对端停止了压缩
+            out += decompressor.unused_data
+            self.decompressor = None
+        stats.seconds.inc(time.time() - start, "recv")
+        stats.raw.inc(len(out), "recv")
+        return [out] if out else []
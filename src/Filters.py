@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 流式拦截: 每个方向一个Pipeline, 由若干Stage组成
+#
+#   与process_down_recv/process_up_recv不同, Stage只看到新收到的数据块, 自己保存状态.
+#   跨越两次recv的匹配由Stage保留的一小段尾部数据(lookbehind)处理, 所以拦截的开销
+#   只与新数据的长度有关, 与缓冲中已有的数据无关. 没有被修改的数据块原样(同一个对象)传给下一级.
+#
+#   Stage.feed(data)返回输出的数据块列表; 需要回复给发送方的数据用Stage.respond(data).
+#   连接断开时Pipeline.flush()取出各级保留的数据.
+#
+#   用法(Forward子类):
+#       def create_down_pipeline(self):
+#           return Pipeline(HeadStage(self.on_request, "\r\n\r\n"), ReplaceStage("Host: a", "Host: b"))
+#
+#   本模块同时用于Python 2(str)和AsyncRedirection(Python 3, 文本模式下为latin-1的str).
+#
+#   输出的数据块和回复也可以是FileRegion(文件的一段), 同步引擎用sendfile直接从文件发送,
+#   数据不经过Python. FileRegion只能由最后一级Stage输出.
+#
+
+import os
+
+
+CHUNKED = -1        # 报文体长度: chunked编码
+UNTIL_CLOSE = -2    # 报文体长度: 直到连接断开(或者不再是HTTP, 例如CONNECT/Upgrade之后)
+
+
+class FileRegion(object):
+    """文件fileobj中从offset开始的size字节. 切片返回新的FileRegion, 接口与memoryview的发送部分相同
+    """
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj  # 引用文件对象, 发送完之前不会被关闭
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(self.size)
+        return FileRegion(self.fileobj, self.offset + start, max(0, stop - start))
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def tobytes(self):
+        """不支持sendfile时读出数据
+        """
+        fd = self.fileobj.fileno()
+        if hasattr(os, "pread"):
+            return os.pread(fd, self.size, self.offset)
+        self.fileobj.seek(self.offset)
+        return self.fileobj.read(self.size)
+
+
+class Stage(object):
+    pipeline = None
+    joins = False   # 为真时上一级输出的多个数据块合并成一块再交给feed(每块有固定开销的Stage, 例如压缩)
+
+    def feed(self, data):
+        """
+        @param data: 新收到的数据块(非空)
+        @return: [输出的数据块, ...]
+        """
+        return [data]
+
+    def flush(self):
+        """连接断开, 输出保留的数据
+        """
+        return []
+
+    def respond(self, data):
+        """回复给发送方(与process_*_recv返回的response_data相同), 也可以是数据块的list
+        """
+        if isinstance(data, list):
+            self.pipeline.responses.extend(chunk for chunk in data if chunk)
+        elif data:
+            self.pipeline.responses.append(data)
+
+
+class Pipeline(object):
+    def __init__(self, *stages):
+        self.stages = stages
+        self.responses = []     # 等待发回给发送方的数据
+        for stage in stages:
+            stage.pipeline = self
+
+    def feed(self, data):
+        """
+        @return: [处理后的数据块, ...]
+        """
+        chunks = [data]
+        for stage in self.stages:
+            if not chunks:
+                break
+            if len(chunks) == 1:
+                chunks = stage.feed(chunks[0])
+            elif stage.joins:
+                chunks = stage.feed(chunks[0][:0].join(chunks))
+            else:
+                out = []
+                for chunk in chunks:
+                    out.extend(stage.feed(chunk))
+                chunks = out
+        return chunks
+
+    def flush(self):
+        chunks = []
+        for stage in self.stages:
+            out = []
+            for chunk in chunks:
+                out.extend(stage.feed(chunk))
+            out.extend(stage.flush())
+            chunks = out
+        return chunks
+
+    def take_responses(self):
+        responses, self.responses = self.responses, []
+        return responses
+
+
+class FunctionStage(Stage):
+    """对每个数据块调用func(data) -> (processed_data, response_data), 与process_*_recv的返回值相同
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def feed(self, data):
+        processed, response = self.func(data)
+        if response is not None:
+            self.respond(response)
+        if processed is None:
+            return [data]
+        return [processed] if processed else []
+
+
+class ReplaceStage(Stage):
+    """把流中所有的old替换成new, 包括跨越两个数据块的
+    """
+    def __init__(self, old, new):
+        if not old:
+            raise ValueError("old must not be empty")
+        self.old = old
+        self.new = new
+        self.tail = None    # 可能是old开头部分的尾部数据, 等下一块数据到达后再判断
+
+    def feed(self, data):
+        if self.tail:
+            data = self.tail + data
+            self.tail = None
+        old = self.old
+        out = []
+        start = 0
+        idx = data.find(old)
+        while idx >= 0:
+            if idx > start:
+                out.append(data[start:idx])
+            if self.new:
+                out.append(self.new)
+            start = idx + len(old)
+            idx = data.find(old, start)
+        end = len(data) - self._partial(data, start)
+        if end > start:
+            out.append(data if start == 0 and end == len(data) else data[start:end])
+        if end < len(data):
+            self.tail = data[end:]
+        return out
+
+    def _partial(self, data, start):
+        """
+        @return: data末尾与old开头相同的最大长度(小于len(old))
+        """
+        old, size = self.old, len(data)
+        pos = data.find(old[:1], max(start, size - len(old) + 1))
+        while pos >= 0:
+            if old.startswith(data[pos:]):
+                return size - pos
+            pos = data.find(old[:1], pos + 1)
+        return 0
+
+    def flush(self):
+        tail, self.tail = self.tail, None
+        return [tail] if tail else []
+
+
+class HeadStage(Stage):
+    """缓存流开头直到delimiter(含)或max_size字节, 交给callback(head) -> (processed_head, response_data)处理一次,
+    之后的数据原样通过. reset()后处理下一个head, 在callback中调用时紧接着的数据就是下一个head
+    """
+    def __init__(self, callback, delimiter="\r\n", max_size=8192):
+        self.callback = callback
+        self.delimiter = delimiter
+        self.max_size = max_size
+        self.head = None
+        self.done = False
+
+    def reset(self):
+        self.done = False
+
+    def feed(self, data):
+        if self.done:
+            return [data]
+        head = self.head + data if self.head else data
+        idx = head.find(self.delimiter, max(0, len(head) - len(data) - len(self.delimiter) + 1))
+        if idx < 0 and len(head) < self.max_size:
+            self.head = head
+            return []
+        end = idx + len(self.delimiter) if idx >= 0 else len(head)
+        self.head = None
+        self.done = True
+        processed, rest = self._process(head[:end]), head[end:]
+        chunks = [processed] if processed else []
+        if rest:
+            chunks.extend(self.feed(rest) if not self.done else [rest])
+        return chunks
+
+    def _process(self, head):
+        processed, response = self.callback(head)
+        if response is not None:
+            self.respond(response)
+        return head if processed is None else processed
+
+    def flush(self):
+        head, self.head = self.head, None
+        if not head:
+            return []
+        self.done = True
+        processed = self._process(head)
+        return [processed] if processed else []
+
+
+class HttpStage(Stage):
+    """把流按HTTP/1.x报文切分, 支持同一连接上的多个(pipelining)请求或响应:
+    每个报文头交给on_head(head) -> (processed_head, response_data)处理(可以为None), processed_head为""时整个报文
+    (包括报文体)都不转发. 报文体原样通过, 报文结束时调用on_end(head), 返回的数据块插入到该报文之后.
+    body_length(head)决定报文体长度, 默认按请求处理; 处理响应时用response_body_length
+    """
+    def __init__(self, on_head, on_end=None, body_length=None, max_size=8192):
+        self.on_head = on_head
+        self.on_end = on_end
+        self.body_length = body_length or request_body_length
+        self.max_size = max_size
+        self.state = "head"     # head, body, chunk_size, chunk_data, trailer, raw
+        self.pending = None     # 未收全的报文头, chunk-size行或trailer行
+        self.message = None     # 当前报文的头
+        self.remaining = 0      # body/chunk_data还剩的字节数
+        self.discard = False    # 当前报文不转发
+
+    def feed(self, data):
+        out = []
+        while data:
+            state = self.state
+            if state == "raw":
+                if not self.discard:
+                    out.append(data)
+                break
+            if state == "head":
+                data = self._feed_head(data, out)
+            elif state in ("body", "chunk_data"):
+                size = min(self.remaining, len(data))
+                if not self.discard:
+                    out.append(data if size == len(data) else data[:size])
+                data = data[size:]
+                self.remaining -= size
+                if not self.remaining:
+                    if state == "body":
+                        self._end(out)
+                    else:
+                        self.state = "chunk_size"
+            else:
+                data = self._feed_line(data, out)
+        return out
+
+    def _feed_head(self, data, out):
+        head = self.pending + data if self.pending else data
+        idx = head.find("\r\n\r\n", max(0, len(head) - len(data) - 3))
+        if idx < 0:
+            if len(head) < self.max_size:
+                self.pending = head
+            else:   # 不是HTTP, 之后的数据原样通过
+                self.pending = None
+                self.state = "raw"
+                out.append(head)
+            return ""
+        self.pending = None
+        end = idx + 4
+        message = self.message = head[:end]
+        processed = None
+        if self.on_head:
+            processed, response = self.on_head(message)
+            if response is not None:
+                self.respond(response)
+        self.discard = processed == ""
+        if not self.discard:
+            out.append(message if processed is None else processed)
+        length = self.body_length(message)
+        if length == UNTIL_CLOSE:
+            self.state = "raw"
+        elif length == CHUNKED:
+            self.state = "chunk_size"
+        elif length > 0:
+            self.state, self.remaining = "body", length
+        else:
+            self._end(out)
+        return head[end:]
+
+    def _feed_line(self, data, out):
+        line = self.pending + data if self.pending else data
+        idx = line.find("\r\n")
+        if idx < 0:
+            if len(line) < self.max_size:
+                self.pending = line
+            else:
+                self.pending = None
+                self.state = "raw"
+                if not self.discard:
+                    out.append(line)
+            return ""
+        self.pending = None
+        end = idx + 2
+        if not self.discard:
+            out.append(line[:end])
+        if self.state == "trailer":
+            if idx == 0:    # 空行, chunked报文结束
+                self._end(out)
+            return line[end:]
+        try:
+            size = int(line[:idx].split(";")[0].strip(), 16)
+        except ValueError:
+            self.state = "raw"
+            return line[end:]
+        if size:
+            self.state, self.remaining = "chunk_data", size + 2  # 包括数据之后的\r\n
+        else:
+            self.state = "trailer"
+        return line[end:]
+
+    def _end(self, out):
+        message, self.message = self.message, None
+        self.state = "head"
+        self.discard = False
+        if self.on_end:
+            chunks = self.on_end(message)
+            if chunks:
+                out.extend(chunks)
+
+    def flush(self):
+        pending, self.pending = self.pending, None
+        return [pending] if pending and not self.discard else []
+
+
+def header_value(head, name):
+    """
+    @param name: 小写的头部名
+    @return: 最后一个名为name的头部的值, 没有时返回None
+    """
+    value = None
+    for line in head.split("\r\n")[1:]:
+        key, sep, rest = line.partition(":")
+        if sep and key.strip().lower() == name:
+            value = rest.strip()
+    return value
+
+
+def _content_length(head):
+    encoding = header_value(head, "transfer-encoding")
+    if encoding is not None:
+        return CHUNKED if encoding.lower().endswith("chunked") else UNTIL_CLOSE
+    length = header_value(head, "content-length")
+    if length is None:
+        return None
+    try:
+        return int(length)
+    except ValueError:
+        return UNTIL_CLOSE
+
+
+def request_body_length(head):
+    """
+    @return: 请求体的长度, 或者CHUNKED/UNTIL_CLOSE
+    """
+    if head.startswith("CONNECT ") or header_value(head, "upgrade") is not None:
+        return UNTIL_CLOSE
+    length = _content_length(head)
+    return 0 if length is None else length
+
+
+def response_body_length(head, method="GET"):
+    """
+    @param method: 对应请求的方法
+    @return: 响应体的长度, 或者CHUNKED/UNTIL_CLOSE
+    """
+    try:
+        status = int(head.split(" ", 2)[1])
+    except (IndexError, ValueError):
+        return UNTIL_CLOSE
+    if status == 101 or (method == "CONNECT" and 200 <= status < 300):
+        return UNTIL_CLOSE
+    if method == "HEAD" or status < 200 or status in (204, 304):
+        return 0
+    length = _content_length(head)
+    return UNTIL_CLOSE if length is None else length
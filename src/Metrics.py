@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 运行指标与Prometheus文本格式的统计接口
+#
+#   每个Redirection有一个Stats(proxy.stats), 转发过程中只做计数(字典取值加一),
+#   连接池深度这类可以直接从proxy读出的值在抓取时才计算.
+#   指定metrics_addr时, MetricsServer在同一个事件循环上提供HTTP接口: GET /metrics
+#   Redirector中每个映射的Stats作为children一起输出, 样本带有mapping标签.
+#
+
+import socket
+import errno
+import bisect
+import logging
+from collections import OrderedDict
+
+from Buffer import budget, pool
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, doc, labelnames=(), func=None):
+        """
+        @param labelnames: 标签名, inc/set时按顺序给出标签值
+        @param func: 值已经由别处统计时使用, 抓取时调用. 没有标签时返回值, 否则返回[(标签值tuple, value), ...]
+        """
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.func = func
+        self.values = {}    # 标签值tuple -> value
+
+    def inc(self, value=1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        """
+        @return: [(name, 标签值tuple, value), ...]
+        """
+        if self.func is None:
+            if not self.labelnames and not self.values:
+                return [(self.name, (), 0)]
+            return [(self.name, labels, value) for labels, value in sorted(self.values.iteritems())]
+        if not self.labelnames:
+            return [(self.name, (), self.func())]
+        return [(self.name, labels, value) for labels, value in self.func()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, value=1, *labels):
+        self.inc(-value, *labels)
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Counter):
+    kind = "histogram"
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, name, doc, labelnames=(), buckets=BUCKETS):
+        Counter.__init__(self, name, doc, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            # [各个桶的计数(不累计), 总和, 次数]
+            data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total, count) in sorted(self.values.iteritems()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                samples.append((self.name + "_bucket", labels + (("le", bound),), cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self, prefix="", labels=()):
+        """
+        @param labels: 所有样本都带的标签((name, value), ...)
+        """
+        self.prefix = prefix
+        self.labels = tuple(labels)
+        self.metrics = []
+        self.children = []  # 一起输出的其它Registry, 同名的指标合并
+
+    def counter(self, name, doc, labelnames=(), func=None):
+        return self.add(Counter(self.prefix + name, doc, labelnames, func))
+
+    def gauge(self, name, doc, labelnames=(), func=None):
+        return self.add(Gauge(self.prefix + name, doc, labelnames, func))
+
+    def histogram(self, name, doc, labelnames=(), buckets=Histogram.BUCKETS):
+        return self.add(Histogram(self.prefix + name, doc, labelnames, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        @return: Prometheus文本格式
+        """
+        groups = OrderedDict()  # name -> [(Registry, metric), ...]
+        for registry in [self] + self.children:
+            for metric in registry.metrics:
+                groups.setdefault(metric.name, []).append((registry, metric))
+        lines = []
+        for name, members in groups.iteritems():
+            first = members[0][1]
+            lines.append("# HELP %s %s" % (name, first.doc))
+            lines.append("# TYPE %s %s" % (name, first.kind))
+            for registry, metric in members:
+                for sample, labels, value in metric.samples():
+                    labels = _format_labels(metric.labelnames, registry.labels + labels)
+                    lines.append("%s%s %s" % (sample, labels, _format_value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _format_labels(labelnames, labels):
+    pairs = []
+    names = iter(labelnames)
+    for value in labels:
+        if isinstance(value, tuple):    # Registry.labels与Histogram的("le", bound)
+            name, value = value
+        else:
+            name = next(names)
+        if not isinstance(value, basestring):
+            value = _format_value(value)
+        value = value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append('%s="%s"' % (name, value))
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Stats(Registry):
+    """所有Redirection共用的指标, 各个Redirection再补充自己的连接池指标
+    """
+    def __init__(self, prefix="tcpredir_"):
+        Registry.__init__(self, prefix)
+        self.accepts = self.counter("accepts_total", "Accepted connections.")
+        self.forwards = self.counter("forwards_total", "Forwards (client paired with remote) created.")
+        self.forwards_active = self.gauge("forwards_active", "Forwards currently open.")
+        self.bytes = self.counter("received_bytes_total", "Bytes received, by the side they came from.", ("side",))
+        self.connect_seconds = self.histogram("connect_seconds", "Latency of non-blocking connects.", ("target",))
+        self.backpressure = self.counter("backpressure_total",
+                "Times reading stopped because a receive buffer was full.", ("side",))
+        self.budget_pauses = self.counter("budget_pauses_total",
+                "Times reading stopped because the process-wide buffer budget was tight.", ("side",))
+        self.accept_pauses = self.counter("accept_pauses_total",
+                "Times accepting stopped because the buffer budget was exhausted.")
+        self.gauge("buffer_bytes", "Bytes held in all connection buffers of the process.",
+                func=lambda: budget.used)
+        self.gauge("buffer_budget_bytes", "Process-wide buffer budget, 0 means unlimited.",
+                func=lambda: budget.limit)
+        self.gauge("buffer_pool_in_use_bytes", "Bytes of buffer arrays held by connections with data.",
+                func=lambda: pool.in_use)
+        self.gauge("buffer_pool_idle_bytes", "Bytes of free buffer arrays kept for reuse.",
+                func=lambda: pool.idle)
+
+
+class MetricsServer(object):
+    MAX_REQUEST_SIZE = 8192
+
+    def __init__(self, proxy, bind_addr):
+        """
+        @param proxy: 所属的Redirection, socket注册在proxy._forwards中, 输出proxy.stats
+        """
+        self.proxy = proxy
+        self.bind_addr = bind_addr
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(bind_addr)
+        sock.listen(16)
+        self.server = sock
+        self._clients = {}  # sock -> [收到的请求, 待发送的响应]
+        proxy._forwards[sock] = self
+        proxy.r_list.add(sock)
+        logging.info("Metrics are served at http://%s:%s/metrics" % bind_addr)
+
+    def on_recv(self, sock):
+        if sock is self.server:
+            self.accept()
+            return
+        request = self._clients[sock]
+        try:
+            data = sock.recv(self.MAX_REQUEST_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            data = ""
+        if not data:
+            self.close(sock)
+            return
+        request[0] += data
+        if "\r\n\r\n" in request[0] or "\n\n" in request[0]:
+            self.proxy.r_list.discard(sock)
+            request[1] = self.respond(request[0])
+            self.proxy.w_list.add(sock)
+        elif len(request[0]) > self.MAX_REQUEST_SIZE:
+            self.close(sock)
+
+    def accept(self):
+        while True:
+            try:
+                client, addr = self.server.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            client.setblocking(0)
+            self._clients[client] = ["", ""]
+            self.proxy._forwards[client] = self
+            self.proxy.r_list.add(client)
+
+    def respond(self, request):
+        parts = request.split(None, 2)
+        path = parts[1].split("?")[0] if len(parts) > 1 else ""
+        if path in ("/", "/metrics"):
+            status, body = "200 OK", self.proxy.stats.render()
+        else:
+            status, body = "404 Not Found", "Not Found\n"
+        return ("HTTP/1.0 %s\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                "Content-Length: %d\r\n"
+                "Connection: close\r\n\r\n%s") % (status, len(body), body)
+
+    def on_send(self, sock):
+        request = self._clients[sock]
+        try:
+            while request[1]:   # epoll边沿触发, 发送到EAGAIN为止
+                request[1] = request[1][sock.send(request[1]):]
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            request[1] = ""
+        if not request[1]:
+            self.close(sock)
+
+    def close(self, sock=None):
+        if sock is self.server:
+            return
+        self._clients.pop(sock, None)
+        self.proxy._forwards.pop(sock, None)
+        self.proxy.r_list.discard(sock)
+        self.proxy.w_list.discard(sock)
+        sock.close()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RRDServer <-> RRDClient 之间的多路复用tunnel
+#
+#   一条长连接上承载多个逻辑stream, 每个stream对应RRDServer上的一个open连接以及
+#   RRDClient到Server的一个连接. 新的open连接只需发送一个OPEN帧, 不必等待新建private连接.
+#
+#   帧格式: type(1B) + stream_id(4B) + length(2B) + payload
+#       OPEN    RRDServer -> RRDClient, 新建stream
+#       DATA    数据
+#       CLOSE   stream的一端已关闭
+#       WINDOW  接收方已把这么多字节(payload: 4B)写给本地连接, 发送方可以继续发送
+#
+#   流量控制: 每个stream的发送窗口初始为WINDOW, 发送DATA时减少, 收到WINDOW帧时增加,
+#   窗口用完时停止读取本地连接(可能超出最多一个BUF_SIZE). stream与tunnel的连接缓冲固定为BUF_SIZE, 不随流量调整.
+#   stream与tunnel的内存已经由窗口限制, 它们的连接不受缓冲预算(Buffer.budget)限制,
+#   否则tunnel停止读取时WINDOW帧也收不到.
+#
+#   保活: tunnel空闲keepalive秒时发送stream_id为0的WINDOW帧(stream_id从1开始, 对端按已关闭的stream忽略),
+#   3 * keepalive秒没有收到任何数据时认为对端已断开(半开连接), 关闭tunnel及其中所有的stream.
+#
+
+import time
+import struct
+import logging
+
+from Buffer import Buffer
+
+
+FRAME_HEAD = struct.Struct("!BIH")
+WINDOW_UPDATE = struct.Struct("!I")
+
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FRAME_CLOSE = 3
+FRAME_WINDOW = 4
+
+MAX_PAYLOAD = 16 * 1024
+WINDOW = 256 * 1024
+BUF_SIZE = 64 * 1024    # stream与tunnel连接的接收缓冲大小
+KEEPALIVE = 30          # tunnel空闲这么久(秒)时发送保活帧
+
+
+class MuxStream(object):
+    def __init__(self, tunnel, stream_id, conn):
+        self.tunnel = tunnel
+        self.proxy = tunnel.proxy
+        self.stream_id = stream_id
+        self.conn = conn                        # 本地一端的连接
+        conn.budgeted = False
+        conn.fix_buf_size(BUF_SIZE)
+        self.out = Buffer()                     # 从tunnel收到, 等待写给conn的数据
+        self.send_window = WINDOW
+        self.consumed = 0                       # 已写给conn但还没有通知对端的字节数
+        self.closing = False                    # 对端已关闭, out中的数据写完后关闭
+        self.closed = False
+        self.proxy.stats.forwards.inc()
+        self.proxy.stats.forwards_active.inc()
+
+    def on_recv(self, sock):
+        conn = self.conn
+        total = 0
+        while True:
+            rsize = conn.recv()
+            if rsize > 0:
+                total += rsize
+                self.proxy.stats.bytes.inc(rsize, self.proxy.stream_side)
+            full = conn.rbuf_full   # 缓冲满时socket中可能还有数据, 边沿触发不会再通知
+            if conn.rbuf:
+                data = conn.rbuf.getvalue()
+                conn.rbuf.clear()
+                self.send_window -= len(data)
+                self.tunnel.send_data(self.stream_id, data)
+            if rsize == -1:
+                self.close()
+                return
+            if self.send_window <= 0 or self.tunnel.congested:
+                self.pause()
+                return
+            if not full:
+                return
+            if self.proxy.scheduler.exhausted(total):
+                self.proxy.scheduler.defer(sock)    # 本轮的配额用完, 让其它stream和forward先处理
+                return
+
+    def on_send(self, sock):
+        conn = self.conn
+        if conn.connecting:
+            self.proxy.timers.cancel(self.proxy._connecting.pop(conn, None))
+            if not conn.finish_connect():
+                self.proxy.on_connect_failed(conn.addr, "connect failed")
+                self.close()
+                return
+            self.proxy.stats.connect_seconds.observe(time.time() - conn.create, "upstream")
+            if not self.closing:
+                self.proxy.r_list.add(sock)
+        if self.out:
+            ssize = conn.send(self.out)
+            if ssize == -1:
+                self.close()
+                return
+            self.consumed += ssize
+            if self.consumed >= WINDOW // 4 and not self.closing:
+                self.tunnel.send_frame(FRAME_WINDOW, self.stream_id, WINDOW_UPDATE.pack(self.consumed))
+                self.consumed = 0
+        if not self.out:
+            self.proxy.w_list.discard(sock)
+            if self.closing:
+                self._close(notify=False)
+
+    def deliver(self, data):
+        """收到对端发来的数据
+        """
+        self.out.write(data)
+        self.proxy.w_list.add(self.conn.sock)
+
+    def window_update(self, size):
+        self.send_window += size
+        self.resume()
+
+    def pause(self):
+        self.proxy.stats.backpressure.inc(1, self.proxy.stream_side)
+        self.proxy.r_list.discard(self.conn.sock)
+        if self.tunnel.congested:
+            self.tunnel.paused.add(self)
+
+    def resume(self):
+        if self.closing or self.closed or self.conn.connecting:
+            return
+        if self.send_window <= 0:
+            return
+        if self.tunnel.congested:
+            self.tunnel.paused.add(self)
+        else:
+            self.tunnel.paused.discard(self)
+            self.proxy.r_list.add(self.conn.sock)
+
+    def remote_closed(self):
+        """对端已关闭, 把剩余的数据写完再关闭
+        """
+        if self.out:
+            self.closing = True
+            self.proxy.r_list.discard(self.conn.sock)
+        else:
+            self._close(notify=False)
+
+    def close(self, sock=None):
+        self._close(notify=True)
+
+    def _close(self, notify):
+        if self.closed:
+            return
+        self.closed = True
+        self.proxy.stats.forwards_active.dec()
+        tunnel, sock = self.tunnel, self.conn.sock
+        tunnel.streams.pop(self.stream_id, None)
+        tunnel.paused.discard(self)
+        if notify and not tunnel.closed:
+            tunnel.send_frame(FRAME_CLOSE, self.stream_id)
+        self.proxy.timers.cancel(self.proxy._connecting.pop(self.conn, None))
+        self.proxy._forwards.pop(sock, None)
+        self.proxy.r_list.discard(sock)
+        self.proxy.w_list.discard(sock)
+        sock.close()
+        self.conn.rbuf.close()
+        self.out.close()
+
+
+class MuxTunnel(object):
+    def __init__(self, proxy, conn, keepalive=KEEPALIVE):
+        """
+        @param keepalive: 保活间隔(秒), 3倍的时间内没有收到数据时关闭tunnel
+        """
+        self.proxy = proxy
+        self.conn = conn
+        # 至少能容纳两个完整的帧
+        conn.fix_buf_size(max(BUF_SIZE, (FRAME_HEAD.size + MAX_PAYLOAD) * 2))
+        conn.budgeted = False
+        self.out = Buffer()
+        self.streams = {}       # stream_id -> MuxStream
+        self.paused = set()     # 因为out积压而暂停读取的stream
+        self.next_id = 1
+        self.closed = False
+        self.keepalive = keepalive
+        self.last_recv = self.last_send = proxy.timers.now
+        self.keepalive_timer = proxy.timers.call_later(keepalive, self.check_alive)
+        proxy._forwards[conn.sock] = self
+
+    @property
+    def congested(self):
+        return len(self.out) >= self.conn.buf_size * 4
+
+    def send_frame(self, tp, stream_id, payload=""):
+        self.last_send = self.proxy.timers.now
+        self.out.write(FRAME_HEAD.pack(tp, stream_id, len(payload)))
+        if payload:
+            self.out.write(payload)
+        if not self.conn.connecting:
+            self.proxy.w_list.add(self.conn.sock)
+
+    def send_data(self, stream_id, data):
+        for i in xrange(0, len(data), MAX_PAYLOAD):
+            self.send_frame(FRAME_DATA, stream_id, data[i:i + MAX_PAYLOAD])
+
+    def add_stream(self, stream_id, conn):
+        stream = MuxStream(self, stream_id, conn)
+        self.streams[stream_id] = stream
+        self.proxy._forwards[conn.sock] = stream
+        return stream
+
+    def open_stream(self, conn):
+        """新建stream(RRDServer端), conn中已收到的数据随后发出
+        """
+        stream_id = self.next_id
+        self.next_id += 1
+        stream = self.add_stream(stream_id, conn)
+        self.send_frame(FRAME_OPEN, stream_id)
+        if conn.rbuf:
+            data = conn.rbuf.getvalue()
+            conn.rbuf.clear()
+            stream.send_window -= len(data)
+            self.send_data(stream_id, data)
+        stream.resume()
+        return stream
+
+    def on_recv(self, sock):
+        while not self.closed:
+            rsize = self.conn.recv()
+            if rsize == -1:
+                self.close()
+                return
+            if rsize > 0:
+                self.last_recv = self.proxy.timers.now
+                self.proxy.stats.bytes.inc(rsize, self.proxy.tunnel_side)
+            full = self.conn.rbuf_full
+            self.process_frames()
+            if not full:
+                break
+
+    def process_frames(self):
+        rbuf = self.conn.rbuf
+        head_size = FRAME_HEAD.size
+        while len(rbuf) >= head_size:
+            tp, stream_id, length = FRAME_HEAD.unpack(rbuf.head(head_size))
+            if len(rbuf) < head_size + length:
+                break
+            rbuf.consume(head_size)
+            payload = rbuf.head(length) if length else ""
+            rbuf.consume(length)
+
+            if tp == FRAME_OPEN:
+                self.proxy.on_stream_open(self, stream_id)
+                continue
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                continue    # 本端已经关闭
+            if tp == FRAME_DATA:
+                stream.deliver(payload)
+            elif tp == FRAME_CLOSE:
+                stream.remote_closed()
+            elif tp == FRAME_WINDOW:
+                stream.window_update(WINDOW_UPDATE.unpack(payload)[0])
+            else:
+                logging.error("Unknown frame type: %d, close tunnel.", tp)
+                self.close()
+                return
+
+    def on_send(self, sock):
+        conn = self.conn
+        if conn.connecting:
+            self.proxy.timers.cancel(self.proxy._connecting.pop(conn, None))
+            if not conn.finish_connect():
+                self.proxy.on_connect_failed(conn.addr, "connect failed")
+                self.close()
+                return
+            self.proxy.stats.connect_seconds.observe(time.time() - conn.create, "tunnel")
+            self.proxy.r_list.add(sock)
+            self.proxy.on_connected(self, conn)
+        if self.out:
+            if conn.send(self.out) == -1:
+                self.close()
+                return
+        if not self.out:
+            self.proxy.w_list.discard(sock)
+        if self.paused and not self.congested:
+            for stream in list(self.paused):
+                stream.resume()
+
+    def check_alive(self):
+        timers = self.proxy.timers
+        if timers.now - self.last_recv >= self.keepalive * 3:
+            logging.warning("Close [mux-tunnel]: nothing received for %d seconds.", timers.now - self.last_recv)
+            self.close()
+            return
+        if timers.now - self.last_send >= self.keepalive and not self.conn.connecting:
+            self.send_frame(FRAME_WINDOW, 0, WINDOW_UPDATE.pack(0))
+        self.keepalive_timer = timers.call_later(self.keepalive, self.check_alive)
+
+    def close(self, sock=None):
+        if self.closed:
+            return
+        self.closed = True
+        logging.info("Close [mux-tunnel] with %d streams.", len(self.streams))
+        self.proxy.timers.cancel(self.keepalive_timer)
+        for stream in self.streams.values():
+            stream._close(notify=False)
+        sock = self.conn.sock
+        self.proxy.timers.cancel(self.proxy._connecting.pop(self.conn, None))
+        self.proxy._forwards.pop(sock, None)
+        self.proxy.r_list.discard(sock)
+        self.proxy.w_list.discard(sock)
+        sock.close()
+        self.conn.rbuf.close()
+        self.out.close()
+        self.proxy.on_tunnel_closed(self)
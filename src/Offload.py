@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 在线程池或进程池中执行拦截(process_down_recv/process_up_recv, Pipeline)
+#
+#   拦截在事件循环中执行时, 一次慢的调用(读文件, 复杂的正则替换, 查询)会让进程内所有的forward停顿.
+#   Redirection的hook_pool参数为"thread"或"process"时, Forward把收到的数据交给HookPool处理,
+#   处理完成之前不再读取这个forward的两端; 工作线程完成后把结果放入队列并写一个字节到self-pipe,
+#   事件循环在self-pipe可读时按完成的顺序调用forward.on_hooked应用结果. 每个forward同时最多一个调用在处理中,
+#   所以同一forward的数据按顺序处理, 拦截方法与Stage也不会被并发调用.
+#
+#   ThreadHookPool: 拦截在工作线程中执行, 可以访问forward的状态. 适合阻塞的I/O, 纯计算受GIL限制.
+#       不同forward的拦截会同时执行, 它们共用的状态(类属性, 模块的全局变量)需要加锁.
+#   ProcessHookPool: 只执行process_*_recv, 在子进程中新建的Forward实例(没有调用__init__)上调用,
+#       不能访问forward的状态(self.proxy等), 只能依赖data; 使用了self的拦截方法在创建时被拒绝(ValueError).
+#       Pipeline仍在事件循环中执行.
+#
+
+import dis
+import time
+import errno
+import socket
+import logging
+import threading
+import traceback
+import Queue
+from collections import deque
+
+
+def run_hook(func, args):
+    """
+    @return: (result, error, seconds), error为异常的traceback, 没有异常时为None
+    """
+    start = time.time()
+    try:
+        return func(*args), None, time.time() - start
+    except Exception:
+        return None, traceback.format_exc(), time.time() - start
+
+
+def feed_pipeline(pipeline, data, closed):
+    """
+    @param closed: 连接已断开, 取出pipeline保留的数据
+    @return: (处理后的数据块list, 回复给发送方的数据块list)
+    """
+    chunks = pipeline.feed(data) if data else []
+    if closed:
+        chunks.extend(pipeline.flush())
+    return chunks, pipeline.take_responses()
+
+
+def _uses_self(func):
+    """
+    @return: 方法func的代码是否引用了self(第一个参数)
+    """
+    code = func.func_code
+    if not code.co_argcount:
+        return False
+    if code.co_varnames[0] in code.co_cellvars:     # 被嵌套的函数引用
+        return True
+    fast = set(dis.opmap[name] for name in ("LOAD_FAST", "STORE_FAST", "DELETE_FAST"))
+    co, i = code.co_code, 0
+    while i < len(co):
+        op = ord(co[i])
+        if op < dis.HAVE_ARGUMENT:
+            i += 1
+            continue
+        if op in fast and ord(co[i + 1]) | ord(co[i + 2]) << 8 == 0:
+            return True
+        i += 3
+    return False
+
+
+def check_process_hooks(cls):
+    """ProcessHookPool在没有状态的实例上调用process_*_recv, 拒绝使用了self的拦截方法
+    """
+    for name in ("process_down_recv", "process_up_recv"):
+        if _uses_self(getattr(cls, name).im_func):
+            raise ValueError("%s.%s uses self, but hooks in a process pool run without forward state. "
+                             "Use hook_pool=\"thread\" or make the hook depend only on data." % (cls.__name__, name))
+
+
+def _call_method(cls, name, args):
+    # 在子进程中执行
+    return run_hook(getattr(cls.__new__(cls), name), args)
+
+
+class HookPool(object):
+    offloads_pipeline = True    # 是否可以处理Pipeline
+
+    def __init__(self, proxy):
+        """
+        @param proxy: 所属的Redirection, 通知用的socket注册在proxy.r_list中, 由proxy.on_readable交给on_wakeup
+        """
+        self.proxy = proxy
+        self.wakeup, self._notify = socket.socketpair()
+        self.wakeup.setblocking(0)
+        self._notify.setblocking(0)
+        self._done = deque()    # 工作线程放入的(job, (result, error, seconds))
+        self.depth = {}         # hook -> 等待或正在处理的调用数
+        stats = proxy.stats
+        stats.gauge("hook_queue_depth", "Offloaded hook calls waiting or running.", ("hook",),
+                lambda: [((hook,), depth) for hook, depth in sorted(self.depth.iteritems())])
+        self.seconds = stats.histogram("hook_seconds", "Run time of offloaded hook calls.", ("hook",))
+        self.delay = stats.histogram("hook_delay_seconds",
+                "Time from submitting a hook call to applying its result on the event loop.", ("hook",))
+        self.errors = stats.counter("hook_errors_total", "Offloaded hook calls that raised.", ("hook",))
+        proxy.r_list.add(self.wakeup)
+
+    def submit(self, forward, hook, func, args):
+        """在池中调用func(*args), 完成后在事件循环中调用forward.on_hooked(result, error)
+        @param hook: 统计用的名字
+        """
+        self.depth[hook] = self.depth.get(hook, 0) + 1
+        self._submit((forward, hook, time.time()), func, args)
+
+    def _submit(self, job, func, args):
+        raise NotImplementedError
+
+    def _complete(self, job, outcome):
+        """在工作线程中调用
+        """
+        self._done.append((job, outcome))
+        try:
+            self._notify.send("\0")
+        except socket.error:
+            pass    # 缓冲中已有未读的通知, 或者已经close
+
+    def on_wakeup(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except socket.error, e:
+            if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise
+        now = time.time()
+        while self._done:
+            (forward, hook, submitted), (result, error, seconds) = self._done.popleft()
+            self.depth[hook] -= 1
+            self.seconds.observe(seconds, hook)
+            self.delay.observe(now - submitted, hook)
+            if error:
+                self.errors.inc(1, hook)
+                logging.error("Hook %s failed:\n%s", hook, error)
+            forward.on_hooked(result, error)
+
+    def close(self):
+        """所属的Redirection停止并且没有forward之后调用, 尚未完成的调用结果被丢弃
+        """
+        self.proxy.r_list.discard(self.wakeup)
+        self.wakeup.close()
+        self._notify.close()
+
+
+class ThreadHookPool(HookPool):
+    def __init__(self, proxy, workers=4):
+        HookPool.__init__(self, proxy)
+        self._jobs = Queue.Queue()
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work, name="hook-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _submit(self, job, func, args):
+        self._jobs.put((job, func, args))
+
+    def _work(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            job, func, args = item
+            self._complete(job, run_hook(func, args))
+
+    def close(self):
+        for thread in self._threads:
+            self._jobs.put(None)
+        HookPool.close(self)
+
+
+class ProcessHookPool(HookPool):
+    offloads_pipeline = False
+
+    def __init__(self, proxy, workers=4):
+        """proxy.Forward的拦截方法使用了self时抛出ValueError
+        """
+        import multiprocessing
+        check_process_hooks(proxy.Forward)
+        self._pool = multiprocessing.Pool(workers)
+        HookPool.__init__(self, proxy)
+
+    def _submit(self, job, func, args):
+        # func是forward的process_*_recv, 按类与方法名传给子进程
+        self._pool.apply_async(_call_method, (type(func.im_self), func.__name__, args),
+                callback=lambda outcome: self._complete(job, outcome))
+
+    def close(self):
+        self._pool.terminate()
+        HookPool.close(self)
+
+
+def create_hook_pool(proxy, kind, workers):
+    """
+    @param kind: "thread", "process"
+    """
+    if kind == "thread":
+        return ThreadHookPool(proxy, workers)
+    if kind == "process":
+        return ProcessHookPool(proxy, workers)
+    raise ValueError("Unknown hook pool: %s" % kind)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 事件轮询层: epoll(边缘触发) / poll / select
+#
+#   Redirection通过 r_list / w_list 登记关注的读写事件, 这两个集合的add/discard会
+#   立即同步到内核(epoll_ctl / poll.register), 每次循环不再需要把全部socket交给select.
+#   多个Redirection共用一个Poller时各自使用一个PollerView, 见Redirector.
+#
+
+import select
+import errno
+
+
+class InterestSet(object):
+    """关注某一类事件的socket集合, 用法与set相同(add/discard/in/len/iter)
+    """
+    def __init__(self, poller):
+        self._poller = poller
+        self._socks = set()
+
+    def add(self, sock):
+        if sock not in self._socks:
+            self._socks.add(sock)
+            self._poller.update(sock)
+
+    def discard(self, sock):
+        if sock in self._socks:
+            self._socks.discard(sock)
+            self._poller.update(sock)
+
+    def __contains__(self, sock):
+        return sock in self._socks
+
+    def __len__(self):
+        return len(self._socks)
+
+    def __iter__(self):
+        return iter(self._socks)
+
+
+class Poller(object):
+    name = None
+
+    def __init__(self):
+        self.r_list = InterestSet(self)
+        self.w_list = InterestSet(self)
+
+    def update(self, sock):
+        """sock的读写关注发生变化, 同步到底层
+        """
+        pass
+
+    def poll(self, timeout):
+        """
+        @return: (r_list, w_list, e_list) 与select.select相同
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SelectPoller(Poller):
+    """兼容用, 每次调用都是O(n), 且受FD_SETSIZE限制
+    """
+    name = "select"
+
+    def poll(self, timeout):
+        r_socks, w_socks = self.r_list._socks, self.w_list._socks
+        try:
+            return select.select(r_socks, w_socks, r_socks, timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return [], [], []
+
+
+class _FdPoller(Poller):
+    """poll/epoll的公共部分: 维护fd -> sock的映射, 按需register/modify/unregister
+    """
+    READ_EVENTS = 0
+    WRITE_EVENTS = 0
+    ERROR_EVENTS = 0
+    EXTRA_FLAGS = 0
+
+    def __init__(self):
+        Poller.__init__(self)
+        self._fds = {}      # sock -> fd, sock关闭后fileno()不可用, 需要记下来
+        self._socks = {}    # fd -> sock
+
+    def _event_mask(self, sock):
+        mask = 0
+        if sock in self.r_list:
+            mask |= self.READ_EVENTS
+        if sock in self.w_list:
+            mask |= self.WRITE_EVENTS
+        return mask
+
+    def update(self, sock):
+        mask = self._event_mask(sock)
+        fd = self._fds.get(sock)
+        if not mask:
+            if fd is not None:
+                del self._fds[sock]
+                del self._socks[fd]
+                self._unregister(fd)
+        elif fd is None:
+            fd = sock.fileno()
+            self._fds[sock] = fd
+            self._socks[fd] = sock
+            self._impl.register(fd, mask | self.EXTRA_FLAGS)
+        else:
+            self._impl.modify(fd, mask | self.EXTRA_FLAGS)
+
+    def _unregister(self, fd):
+        try:
+            self._impl.unregister(fd)
+        except (IOError, OSError, KeyError):
+            pass    # fd已经被关闭
+
+    def _poll(self, timeout):
+        raise NotImplementedError
+
+    def poll(self, timeout):
+        r_list, w_list, e_list = [], [], []
+        try:
+            events = self._poll(timeout)
+        except (IOError, OSError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return r_list, w_list, e_list
+        for fd, event in events:
+            sock = self._socks.get(fd)
+            if sock is None:
+                continue
+            # 出错/挂断时交给recv/send去发现, 这样缓冲里剩余的数据也能被读出来
+            if event & (self.READ_EVENTS | self.ERROR_EVENTS) and sock in self.r_list:
+                r_list.append(sock)
+            if event & (self.WRITE_EVENTS | self.ERROR_EVENTS) and sock in self.w_list:
+                w_list.append(sock)
+        return r_list, w_list, e_list
+
+
+class PollPoller(_FdPoller):
+    name = "poll"
+
+    def __init__(self):
+        _FdPoller.__init__(self)
+        self.READ_EVENTS = select.POLLIN | select.POLLPRI
+        self.WRITE_EVENTS = select.POLLOUT
+        self.ERROR_EVENTS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        self._impl = select.poll()
+
+    def _poll(self, timeout):
+        return self._impl.poll(None if timeout is None else timeout * 1000)
+
+
+class EpollPoller(_FdPoller):
+    """边缘触发: 只有状态变化时才通知, 所以recv/accept必须一直读到EAGAIN(或缓冲区满后
+    从r_list中移除, 重新add时modify会再次检查就绪状态).
+    """
+    name = "epoll"
+
+    def __init__(self):
+        _FdPoller.__init__(self)
+        self.READ_EVENTS = select.EPOLLIN | select.EPOLLPRI
+        self.WRITE_EVENTS = select.EPOLLOUT
+        self.ERROR_EVENTS = select.EPOLLERR | select.EPOLLHUP
+        self.EXTRA_FLAGS = select.EPOLLET
+        self._impl = select.epoll()
+
+    def _poll(self, timeout):
+        return self._impl.poll(-1 if timeout is None else timeout)
+
+    def close(self):
+        self._impl.close()
+
+
+class _ViewSet(object):
+    """PollerView的r_list/w_list: 登记socket时记下所属的视图, 两个集合都不再关注时删除
+    """
+    def __init__(self, view, interest, other):
+        self._view = view
+        self._interest = interest
+        self._other = other
+
+    def add(self, sock):
+        self._view.owners[sock] = self._view
+        self._interest.add(sock)
+
+    def discard(self, sock):
+        self._interest.discard(sock)
+        if sock not in self._other:
+            self._view.owners.pop(sock, None)
+
+    def __contains__(self, sock):
+        return sock in self._interest
+
+    def __len__(self):
+        return len(self._interest)
+
+    def __iter__(self):
+        return iter(self._interest)
+
+
+class PollerView(object):
+    """多个Redirection共用一个Poller, TimerQueue和IOScheduler(见Redirector)时, 每个Redirection使用的poller.
+    事件由Redirector按owners(sock -> 视图)交给视图的owner
+    """
+    def __init__(self, poller, timers, scheduler, owners):
+        """
+        @param poller: 共用的Poller
+        @param timers: 共用的TimerQueue
+        @param scheduler: 共用的Scheduler.IOScheduler
+        @param owners: sock -> PollerView, 同一个Poller的所有视图共用
+        """
+        self.timers = timers
+        self.scheduler = scheduler
+        self.owners = owners
+        self.owner = None   # 使用这个视图的Redirection
+        self.r_list = _ViewSet(self, poller.r_list, poller.w_list)
+        self.w_list = _ViewSet(self, poller.w_list, poller.r_list)
+
+    def poll(self, timeout):
+        raise RuntimeError("A shared poller is polled by its Redirector.")
+
+    def close(self):
+        pass
+
+
+POLLERS = [("epoll", EpollPoller), ("poll", PollPoller), ("select", SelectPoller)]
+
+
+def create_poller(name=None):
+    """
+    @param name: "epoll", "poll", "select", None表示当前平台可用的最好实现. PollerView原样返回
+    """
+    if isinstance(name, PollerView):
+        return name
+    for poller_name, cls in POLLERS:
+        if name is not None and name != poller_name:
+            continue
+        if hasattr(select, poller_name):
+            return cls()
+    raise ValueError("Poller[%s] is not available." % name)
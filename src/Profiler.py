@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 事件循环的性能分析(可选)
+#
+#   开启时(slow_callback > 0)包装proxy的poller.poll, timers.run与_call, 记录:
+#       loop_busy_seconds       每轮循环中poll返回后处理事件的时间
+#       poll_seconds            阻塞在poll中的时间
+#       callback_seconds        每次回调的时间, 按处理者的类名, 事件(on_recv/on_send/close/timers)和方向(up/down)区分
+#   统计放在proxy.stats中, 与其它指标一起输出. proxy为Redirector时, 每个映射的_call由watch_calls(mapping)包装.
+#   超过slow_callback的回调记录一条警告; 回调还在执行时, 看门狗线程取得事件循环线程的调用栈一起输出.
+#   收到SIGUSR1时把各回调的统计写入日志.
+#
+#   不开启时不做任何包装, 事件循环没有额外开销.
+#
+
+import sys
+import time
+import signal
+import thread
+import logging
+import threading
+import traceback
+
+
+CALLBACK_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+
+class LoopProfiler(object):
+    def __init__(self, proxy, slow_callback):
+        """
+        @param proxy: 所属的Redirection
+        @param slow_callback: 回调超过这么久(秒)时记录警告和调用栈
+        """
+        self.proxy = proxy
+        self.slow_callback = slow_callback
+        stats = proxy.stats
+        self.loop_busy = stats.histogram("loop_busy_seconds",
+                "Time spent handling events in one event loop iteration.", buckets=CALLBACK_BUCKETS)
+        self.poll_time = stats.histogram("poll_seconds", "Time blocked in the poller.")
+        self.callbacks = stats.histogram("callback_seconds", "Time spent in one event loop callback.",
+                ("handler", "event", "side"), CALLBACK_BUCKETS)
+        self.slow = stats.counter("slow_callbacks_total", "Callbacks slower than the slow_callback threshold.")
+        self.polled = None      # 上次poll返回的时间
+        self.thread_id = None   # 事件循环所在的线程
+        self.current = None     # 正在执行的回调: (开始时间, 描述)
+        self.stack = None       # 看门狗取得的调用栈: (回调, 调用栈)
+        self._watchdog = None
+
+    def install(self):
+        """包装proxy的事件循环入口, 启动看门狗, 注册SIGUSR1
+        """
+        proxy = self.proxy
+        proxy.poller.poll = self.wrap_poll(proxy.poller.poll)
+        proxy.timers.run = self.wrap(proxy.timers.run, "TimerQueue", "timers")
+        self.watch_calls(proxy)
+        self._watchdog = threading.Thread(target=self.watch, name="LoopWatchdog")
+        self._watchdog.daemon = True
+        self._watchdog.start()
+        try:
+            previous = signal.getsignal(signal.SIGUSR1)
+            def on_signal(signum, frame):
+                logging.warning("Event loop profile of %s:\n%s", type(proxy).__name__, self.snapshot())
+                if callable(previous):
+                    previous(signum, frame)
+            signal.signal(signal.SIGUSR1, on_signal)
+        except (ValueError, AttributeError):    # 不在主线程中, 或者平台不支持SIGUSR1
+            pass
+
+    def wrap_poll(self, poll):
+        def profiled_poll(timeout):
+            start = time.time()
+            if self.polled is not None:
+                self.loop_busy.observe(start - self.polled)
+            else:
+                self.thread_id = thread.get_ident()
+            try:
+                return poll(timeout)
+            finally:
+                self.polled = time.time()
+                self.poll_time.observe(self.polled - start)
+        return profiled_poll
+
+    def wrap(self, func, handler, event):
+        def profiled():
+            self.run(func, (), (handler, event, ""))
+        return profiled
+
+    def watch_calls(self, proxy):
+        """记录proxy._call中每次回调的时间
+        """
+        proxy._call = self.wrap_call(proxy, proxy._call)
+
+    def wrap_call(self, proxy, call):
+        def profiled_call(sock, method):
+            handler = proxy._forwards.get(sock)
+            side = ""
+            if getattr(handler, "down", None) is not None and handler.down.sock is sock:
+                side = "down"
+            elif getattr(handler, "up", None) is not None and handler.up.sock is sock:
+                side = "up"
+            self.run(call, (sock, method), (type(handler).__name__ if handler else "pool", method, side))
+        return profiled_call
+
+    def run(self, func, args, labels):
+        start = time.time()
+        current = self.current = (start, labels)
+        try:
+            func(*args)
+        finally:
+            elapsed = time.time() - start
+            self.current = None
+            self.callbacks.observe(elapsed, *labels)
+            if elapsed >= self.slow_callback:
+                self.slow.inc()
+                stack = self.stack[1] if self.stack and self.stack[0] is current else ""
+                self.stack = None
+                logging.warning("Slow callback %s.%s(%s) took %.3fs.%s", labels[0], labels[1], labels[2],
+                        elapsed, "\n" + stack if stack else "")
+
+    def watch(self):
+        """看门狗线程: 回调执行超过slow_callback时, 取得事件循环线程的调用栈
+        """
+        interval = max(self.slow_callback / 2.0, 0.001)
+        while True:
+            time.sleep(interval)
+            current = self.current
+            if current is None or time.time() - current[0] < self.slow_callback:
+                continue
+            if self.stack and self.stack[0] is current:
+                continue    # 已经取得
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None and self.current is current:
+                self.stack = (current, "".join(traceback.format_stack(frame)))
+
+    def snapshot(self):
+        """
+        @return: 各回调按总时间排序的统计(文本)
+        """
+        lines = []
+        for name, metric in (("poll", self.poll_time), ("busy", self.loop_busy)):
+            for labels, (counts, total, count) in metric.values.items():
+                lines.append("%-40s count=%d total=%.3fs" % (name, count, total))
+        rows = sorted(self.callbacks.values.items(), key=lambda item: -item[1][1])
+        for labels, (counts, total, count) in rows:
+            lines.append("%-40s count=%d total=%.3fs avg=%.6fs" % (
+                    ".".join(label for label in labels if label), count, total, total / count))
+        lines.append("slow callbacks: %d" % self.slow.values.get((), 0))
+        return "\n".join(lines)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 一个事件循环服务多个端口映射
+#
+#   Redirector持有唯一的Poller和TimerQueue. 每个映射仍是一个普通的Redirection(TcpLocalRedirection,
+#   RRDServer或RRDClient), 使用Redirector提供的PollerView: 视图记下每个socket属于哪个映射,
+#   事件直接交给该映射的on_readable/on_writable/on_error, 每轮循环结束时调用各映射的on_loop_end.
+#
+#   映射可以在运行时增删(在事件循环线程中, 例如SIGHUP之后的reload): remove只关闭监听socket,
+#   已有的forward继续转发, 全部关闭后才丢弃这个映射.
+#
+#   映射表(load)是dict的list, 例如:
+#       [{"name": "ssh", "listen": "0.0.0.0:2222", "remote": "10.0.0.2:22"},
+#        {"name": "web", "listen": ":8080", "remote": ["10.0.0.3:80", ["10.0.0.4:80", 2]],
+#         "forward": "MyForwards.HttpForward", "max_buf_size": 262144},
+#        {"name": "db", "type": "rrd_server", "listen": ":3306", "tunnel": ":13306"},
+#        {"name": "db-tunnel", "type": "rrd_client", "rrd_server": "gw:13306", "remote": "127.0.0.1:3306"}]
+#   每个通过RRDServer暴露的服务各占一个映射(公开端口 + tunnel端口), RRDClient一侧同样.
+#   其它键作为关键字参数传给对应的Redirection; down_socket/up_socket为SocketProfile的参数(dict).
+#
+
+import copy
+import json
+import signal
+import socket
+import logging
+from collections import OrderedDict
+
+from Poller import create_poller, PollerView
+from Timers import TimerQueue
+from Scheduler import IOScheduler, QUANTUM, MAX_ACCEPTS
+from Buffer import budget
+from Metrics import Registry, MetricsServer
+from SocketProfile import SocketProfile
+from Profiler import LoopProfiler
+from TcpLocalRedirection import TcpLocalRedirection
+from TcpRemoteRedirection import RRDServer, RRDClient
+
+
+def parse_addr(value):
+    """
+    @param value: "host:port", ":port"(所有地址)或[host, port]
+    @return: (host, port)
+    """
+    if isinstance(value, basestring):
+        host, _, port = value.rpartition(":")
+        return (str(host) or "0.0.0.0", int(port))
+    return (str(value[0]), int(value[1]))
+
+
+def parse_remote(value):
+    """
+    @param value: "host:port", 或多个后端["host:port", ["host:port", weight], ...]
+    @return: TcpLocalRedirection的remote_addr
+    """
+    if isinstance(value, basestring):
+        return parse_addr(value)
+    return [parse_addr(item) if isinstance(item, basestring) else (parse_addr(item[0]), int(item[1]))
+            for item in value]
+
+
+def load_class(path):
+    """
+    @param path: "module.Class"
+    """
+    module, _, name = path.rpartition(".")
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+def mapping_args(entry):
+    """
+    @param entry: 映射表中的一项
+    @return: (Redirection类, args, kwargs)
+    """
+    tp = entry.get("type", "local")
+    kwargs = dict((str(key), value) for key, value in entry.iteritems()
+                  if key not in ("name", "type", "listen", "remote", "tunnel", "rrd_server"))
+    if isinstance(kwargs.get("forward"), basestring):
+        kwargs["forward"] = load_class(kwargs["forward"])
+    for key in ("down_socket", "up_socket"):
+        if isinstance(kwargs.get(key), dict):
+            kwargs[key] = SocketProfile(**dict((str(k), v) for k, v in kwargs[key].iteritems()))
+    if kwargs.get("metrics_addr"):
+        kwargs["metrics_addr"] = parse_addr(kwargs["metrics_addr"])
+    if tp == "local":
+        return TcpLocalRedirection, (parse_addr(entry["listen"]), parse_remote(entry["remote"])), kwargs
+    if tp == "rrd_server":
+        if entry.get("tunnel"):
+            kwargs["tunnel_addr"] = parse_addr(entry["tunnel"])
+        return RRDServer, (parse_addr(entry["listen"]),), kwargs
+    if tp == "rrd_client":
+        return RRDClient, (parse_addr(entry["rrd_server"]), parse_addr(entry["remote"])), kwargs
+    raise ValueError("Unknown mapping type: %s" % tp)
+
+
+class Redirector(object):
+    def __init__(self, poller=None, metrics_addr=None, buffer_budget=0, slow_callback=0, io_quantum=QUANTUM,
+                 max_accepts=MAX_ACCEPTS):
+        """
+        @param poller: "epoll", "poll", "select", None表示自动选择, 所有映射共用
+        @param io_quantum, max_accepts: 每个socket每轮最多接收的字节数与accept的连接数(见Scheduler), 对所有映射有效
+        @param metrics_addr: (host, port), 输出所有映射的统计(带mapping标签), None表示不提供
+        @param buffer_budget: 进程内所有连接缓冲的总字节数上限(见Buffer.BufferBudget), 0表示不限制
+        @param slow_callback: 大于0时开启事件循环的性能分析(见Profiler), 对所有映射有效
+        """
+        self.poller = create_poller(poller)
+        self.timers = TimerQueue()
+        self.scheduler = IOScheduler(self.poller.r_list, io_quantum, max_accepts)
+        self.owners = {}                # sock -> PollerView
+        self.mappings = OrderedDict()   # name -> Redirection
+        self.entries = {}               # name -> 映射表中的一项(由load添加时)
+        self._draining = []             # 已删除但还有连接的Redirection
+        self._reload_path = None        # 收到SIGHUP后要重新加载的映射表
+        if buffer_budget:
+            budget.set_limit(buffer_budget)
+
+        # Redirector自己的socket(MetricsServer)也通过一个视图分发
+        view = PollerView(self.poller, self.timers, self.scheduler, self.owners)
+        view.owner = self
+        self.r_list = view.r_list
+        self.w_list = view.w_list
+        self._forwards = {}
+        self.stats = Registry("tcpredir_")
+        self.stats.gauge("mappings", "Port mappings served by the event loop.", func=lambda: len(self.mappings))
+        self.stats.gauge("mappings_draining", "Removed mappings whose forwards are still open.",
+                func=lambda: len(self._draining))
+        self.stats.counter("io_deferrals_total", "Reads or accepts postponed to the next loop iteration by the quota.",
+                func=lambda: self.scheduler.deferred)
+        if metrics_addr:
+            MetricsServer(self, metrics_addr)
+        self.profiler = None
+        if slow_callback:
+            self.profiler = LoopProfiler(self, slow_callback)
+            self.profiler.install()
+
+    def add(self, name, cls, *args, **kwargs):
+        """
+        @param cls: TcpLocalRedirection, RRDServer, RRDClient或它们的子类, 用args, kwargs创建
+        @return: 创建的Redirection
+        """
+        if name in self.mappings:
+            raise ValueError("Mapping[%s] already exists." % name)
+        for key in ("slow_callback", "buffer_budget", "io_quantum", "max_accepts"):
+            if key in kwargs:
+                raise ValueError("%s is set on the Redirector." % key)
+        view = PollerView(self.poller, self.timers, self.scheduler, self.owners)
+        kwargs["poller"] = view
+        try:
+            proxy = cls(*args, **kwargs)
+        except Exception:
+            for sock, owner in self.owners.items():     # 创建到一半时已经登记的socket(例如监听socket)
+                if owner is view:
+                    view.r_list.discard(sock)
+                    view.w_list.discard(sock)
+                    sock.close()
+            raise
+        view.owner = proxy
+        proxy.stats.labels = (("mapping", name),)
+        self.stats.children.append(proxy.stats)
+        if self.profiler:
+            self.profiler.watch_calls(proxy)
+        self.mappings[name] = proxy
+        logging.info("Add mapping[%s]: %s", name, cls.__name__)
+        return proxy
+
+    def remove(self, name):
+        """停止接受新的连接, 已有的forward继续转发直到关闭
+        """
+        proxy = self.mappings.pop(name)
+        self.entries.pop(name, None)
+        self.stats.children.remove(proxy.stats)
+        proxy.stop()
+        if proxy.active:
+            self._draining.append(proxy)
+        logging.info("Remove mapping[%s].", name)
+
+    def load(self, table):
+        """按映射表增删映射: 表中没有的删除, 新增的添加, 配置变化了的删除后重新添加, 没有变化的不受影响
+        @param table: [dict, ...], 格式见模块说明
+        """
+        entries = OrderedDict((entry["name"], entry) for entry in table)
+        for name in list(self.mappings):
+            if name not in entries or self.entries.get(name) != entries[name]:
+                self.remove(name)
+        for name, entry in entries.iteritems():
+            if name not in self.mappings:
+                cls, args, kwargs = mapping_args(entry)
+                self.add(name, cls, *args, **kwargs)
+                self.entries[name] = copy.deepcopy(entry)
+
+    def load_file(self, path):
+        with open(path) as f:
+            self.load(json.load(f))
+
+    def reload_on_signal(self, path, signum=signal.SIGHUP):
+        """收到signum时在事件循环中重新加载映射表文件path
+        """
+        def on_signal(signum, frame):
+            self._reload_path = path
+        signal.signal(signum, on_signal)
+
+    def _reload(self):
+        path, self._reload_path = self._reload_path, None
+        try:
+            self.load_file(path)
+        except (IOError, ValueError, KeyError, ImportError, socket.error), e:
+            logging.error("Reload mappings from %s failed: %s", path, e)
+
+    def _call(self, sock, method):
+        if sock not in self.r_list and sock not in self.w_list:
+            return  # 在本轮循环中已经被关闭
+        handler = self._forwards.get(sock)
+        if handler:
+            getattr(handler, method)(sock)
+        else:
+            self.r_list.discard(sock)
+            self.w_list.discard(sock)
+            sock.close()
+
+    def on_readable(self, sock):
+        self._call(sock, "on_recv")
+
+    def on_writable(self, sock):
+        self._call(sock, "on_send")
+
+    def on_error(self, sock):
+        self._call(sock, "close")
+
+    def main_loop(self):
+        owners = self.owners
+        while True:
+            r_list, w_list, e_list = self.poller.poll(self.scheduler.timeout(self.timers.timeout()))
+            self.timers.run()
+            for sock in e_list:
+                view = owners.get(sock)
+                if view:
+                    view.owner.on_error(sock)
+            for sock in self.scheduler.readable(r_list):
+                view = owners.get(sock)
+                if view:
+                    view.owner.on_readable(sock)
+            for sock in w_list:
+                view = owners.get(sock)
+                if view:
+                    view.owner.on_writable(sock)
+            for proxy in self.mappings.itervalues():
+                proxy.on_loop_end()
+            if self._draining:
+                for proxy in self._draining:
+                    proxy.on_loop_end()     # 最后一个forward关闭后也调用一次, 释放hook_pool等
+                self._draining = [proxy for proxy in self._draining if proxy.active]
+            if self._reload_path:
+                self._reload()
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.DEBUG)
+    redirector = Redirector()
+    redirector.load_file(sys.argv[1])
+    redirector.reload_on_signal(sys.argv[1])
+    redirector.main_loop()
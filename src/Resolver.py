@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 地址解析缓存: remote_addr为域名时, 避免每个新连接都做一次(阻塞的)DNS查询
+#
+#   getaddrinfo会阻塞事件循环, 所以只在启动时(prewarm)和第一次遇到未知的地址时同步解析.
+#   缓存过期后继续返回旧的结果, 同时在后台线程中重新解析, 解析成功后替换; 失败时保留旧的结果, retry秒后再试.
+#   IP地址不需要解析, 直接返回.
+#
+
+import time
+import socket
+import logging
+import threading
+import Queue
+
+
+def is_ip(host):
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+        return True
+    except (socket.error, ValueError):
+        return False
+
+
+class Resolver(object):
+    def __init__(self, ttl=300, retry=5):
+        """
+        @param ttl: 解析结果的缓存时间(秒), 过期后在后台刷新
+        @param retry: 后台刷新失败时, 这么久(秒)之后再试
+        """
+        self.ttl = ttl
+        self.retry = retry
+        self._cache = {}        # (host, port) -> (resolved_addr, expire), 后台线程只替换整项
+        self._refreshing = set()
+        self._jobs = None       # 第一次刷新时创建后台线程
+
+    def lookup(self, addr):
+        """阻塞地解析addr, 失败时抛出socket.error
+        """
+        host, port = addr
+        infos = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+        return infos[0][4]
+
+    def prewarm(self, addrs):
+        """在事件循环开始之前解析addrs, 失败的地址在第一次使用时再解析
+        """
+        for addr in addrs:
+            if is_ip(addr[0]) or addr in self._cache:
+                continue
+            try:
+                self._cache[addr] = (self.lookup(addr), time.time() + self.ttl)
+            except socket.error, e:
+                logging.warning("Resolve [%s:%s] failed: %s", addr[0], addr[1], e)
+
+    def resolve(self, addr):
+        """
+        @return: 可以直接用于connect的(ip, port), 没有缓存且解析失败时抛出socket.error
+        """
+        cached = self._cache.get(addr)
+        if cached:
+            if cached[1] <= time.time():
+                self._refresh(addr)
+            return cached[0]
+        if is_ip(addr[0]):
+            return addr
+        resolved = self.lookup(addr)
+        self._cache[addr] = (resolved, time.time() + self.ttl)
+        return resolved
+
+    def invalidate(self, addr):
+        self._cache.pop(addr, None)
+
+    def _refresh(self, addr):
+        if addr in self._refreshing:
+            return
+        self._refreshing.add(addr)
+        if self._jobs is None:
+            self._jobs = Queue.Queue()
+            thread = threading.Thread(target=self._work, name="resolver")
+            thread.daemon = True
+            thread.start()
+        self._jobs.put(addr)
+
+    def _work(self):
+        while True:
+            addr = self._jobs.get()
+            try:
+                self._cache[addr] = (self.lookup(addr), time.time() + self.ttl)
+            except socket.error, e:
+                logging.warning("Refresh [%s:%s] failed: %s", addr[0], addr[1], e)
+                cached = self._cache.get(addr)
+                if cached:
+                    self._cache[addr] = (cached[0], time.time() + self.retry)
+            finally:
+                self._refreshing.discard(addr)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 每轮事件循环的公平调度
+#
+#   epoll边沿触发时, 一个socket可读后要一直读到EAGAIN(或缓冲满). 一个高速的大流量连接因此可以占满一轮循环,
+#   同一轮中就绪的交互式连接要等它处理完. IOScheduler限制每个socket每轮最多接收quantum字节,
+#   每个监听socket每轮最多accept max_accepts个连接. 配额用完的socket中可能还有数据, 边沿触发不会再通知,
+#   所以放入ready队列, 下一轮在poll返回的新事件之后处理; 这样的socket轮流(round-robin)每轮各得到一个quantum.
+#   ready队列不为空时poll不阻塞.
+#
+
+from collections import OrderedDict
+
+
+QUANTUM = 256 * 1024    # 每个socket每轮最多接收的字节数
+MAX_ACCEPTS = 64        # 每个监听socket每轮最多accept的连接数
+
+
+class IOScheduler(object):
+    def __init__(self, r_list, quantum=QUANTUM, max_accepts=MAX_ACCEPTS):
+        """
+        @param r_list: 事件循环的Poller.r_list, 已经不再关注读事件(关闭, 缓冲满, 暂停accept)的socket不再处理
+        @param quantum: 每个socket每轮最多接收的字节数, 0表示不限制
+        @param max_accepts: 每个监听socket每轮最多accept的连接数, 0表示不限制
+        """
+        self.r_list = r_list
+        self.quantum = quantum
+        self.max_accepts = max_accepts
+        self.ready = OrderedDict()  # 配额用完的socket -> None
+        self.deferred = 0           # 推迟到下一轮的次数
+
+    def exhausted(self, rsize):
+        """
+        @param rsize: 本轮从socket接收的字节数
+        """
+        return 0 < self.quantum <= rsize
+
+    def defer(self, sock):
+        """sock本轮的配额用完, 下一轮继续处理
+        """
+        self.ready[sock] = None
+        self.deferred += 1
+
+    def timeout(self, timeout):
+        """
+        @param timeout: 定时器给出的poll超时
+        @return: poll的超时, 有等待处理的socket时为0
+        """
+        return 0 if self.ready else timeout
+
+    def readable(self, r_list):
+        """
+        @param r_list: poll返回的可读socket
+        @return: 本轮要处理的可读socket, 上一轮配额用完的排在新事件之后
+        """
+        if not self.ready:
+            return r_list
+        ready, self.ready = self.ready, OrderedDict()
+        for sock in r_list:
+            ready.pop(sock, None)
+        interest = self.r_list
+        return list(r_list) + [sock for sock in ready if sock in interest]
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 每一端(down: client一侧, up: remote或tunnel一侧)socket的选项
+#
+#   Redirection的down_socket/up_socket参数, 不指定时与以前相同, 除SO_REUSEADDR外不设置任何选项.
+#   socket创建(connect之前)或accept之后由apply(conn)设置; 监听socket由listen(sock)设置.
+#   cork为真时, Connection发送多段数据(拦截产生的响应与文件等)期间设置TCP_CORK, 发送完后取消,
+#   内核把这些数据合并成完整的报文段.
+#
+
+import socket
+import logging
+
+
+class SocketProfile(object):
+    def __init__(self, nodelay=False, sndbuf=0, rcvbuf=0, keepalive=0, cork=False, backlog=200):
+        """
+        @param nodelay: 设置TCP_NODELAY
+        @param sndbuf, rcvbuf: SO_SNDBUF/SO_RCVBUF(字节), 0表示使用系统默认值
+        @param keepalive: 空闲这么久(秒)后开始发送TCP keepalive, 0表示不开启
+        @param cork: 发送多段数据时设置TCP_CORK(平台支持时)
+        @param backlog: 监听socket的backlog, 只对接受连接的一端有效
+        """
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.keepalive = keepalive
+        self.cork = cork and hasattr(socket, "TCP_CORK")
+        self.backlog = backlog
+
+    def listen(self, sock):
+        """设置监听socket并开始监听, 缓冲大小由accept的socket继承(接收窗口的缩放在握手时确定)
+        """
+        self._set_buffers(sock)
+        sock.listen(self.backlog)
+
+    def apply(self, conn):
+        """
+        @param conn: Connection, 设置conn.sock的选项和conn.cork
+        """
+        sock = conn.sock
+        conn.cork = self.cork
+        try:
+            self._set_buffers(sock)
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                for name, value in (("TCP_KEEPIDLE", self.keepalive), ("TCP_KEEPINTVL", max(1, self.keepalive // 3)),
+                                    ("TCP_KEEPCNT", 3)):
+                    if hasattr(socket, name):
+                        sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+        except socket.error, e:
+            logging.warning("Set socket options failed: %s", e)
+
+    def _set_buffers(self, sock):
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+
+def set_cork(sock, on):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
+    except socket.error:
+        pass
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 标准库没有提供(或只在新版本中提供)的系统调用, 不可用时为None
+#
+
+import os
+import sys
+import socket
+import ctypes
+import ctypes.util
+
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+
+def _libc_func(name, argtypes, restype):
+    func = getattr(_libc, name, None) if _libc else None
+    if func is not None:
+        func.argtypes = argtypes
+        func.restype = restype
+    return func
+
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+def _make_splice():
+    if hasattr(os, "splice"):
+        def splice(fd_in, fd_out, count, flags=0):
+            return os.splice(fd_in, fd_out, count, flags=flags)
+        return splice
+    func = _libc_func("splice", [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint], ctypes.c_ssize_t)
+    if func is None:
+        return None
+    def splice(fd_in, fd_out, count, flags=0):
+        """在fd_in与fd_out之间移动最多count字节(其中一端必须是pipe), 失败时抛出OSError
+        @return: 移动的字节数, 0表示fd_in已到结尾
+        """
+        return _check(func(fd_in, None, fd_out, None, count, flags))
+    return splice
+
+splice = _make_splice()
+
+
+def _make_sendfile():
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+    func = _libc_func("sendfile64", [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                     ctypes.c_size_t], ctypes.c_ssize_t)
+    if func is None:
+        return None
+    def sendfile(out_fd, in_fd, offset, count):
+        """把in_fd从offset开始的最多count字节发送到out_fd, 不改变in_fd的文件位置, 失败时抛出OSError
+        @return: 发送的字节数, 0表示已到文件结尾
+        """
+        return _check(func(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count))
+    return sendfile
+
+sendfile = _make_sendfile()
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("base", ctypes.c_void_p), ("len", ctypes.c_size_t)]
+
+
+class _PyBuffer(ctypes.Structure):
+    # Py_buffer的开头部分, 之后的字段只需留出空间
+    _fields_ = [("buf", ctypes.c_void_p), ("obj", ctypes.c_void_p), ("len", ctypes.c_ssize_t),
+                ("rest", ctypes.c_char * 128)]
+
+
+def _make_sendmsg():
+    if hasattr(socket.socket, "sendmsg"):
+        def sendmsg(sock, buffers):
+            return sock.sendmsg(buffers)
+        return sendmsg
+    func = _libc_func("writev", [ctypes.c_int, ctypes.c_void_p, ctypes.c_int], ctypes.c_ssize_t)
+    get_buffer = getattr(ctypes.pythonapi, "PyObject_GetBuffer", None)
+    if func is None or get_buffer is None:
+        return None
+    get_buffer.argtypes = [ctypes.py_object, ctypes.c_void_p, ctypes.c_int]
+    get_buffer.restype = ctypes.c_int
+    release = ctypes.pythonapi.PyBuffer_Release
+    release.argtypes = [ctypes.c_void_p]
+    release.restype = None
+    def sendmsg(sock, buffers):
+        """把buffers(str/memoryview的list)依次发送到sock, 只用一次系统调用, 失败时抛出socket.error
+        @return: 发送的字节数
+        """
+        count = len(buffers)
+        iov = (_IOVec * count)()
+        views = []
+        try:
+            for i, data in enumerate(buffers):
+                view = _PyBuffer()
+                get_buffer(data, ctypes.byref(view), 0)
+                views.append(view)
+                iov[i].base, iov[i].len = view.buf, view.len
+            ret = func(sock.fileno(), iov, count)
+        finally:
+            for view in views:
+                release(ctypes.byref(view))
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise socket.error(err, os.strerror(err))
+        return ret
+    return sendmsg
+
+sendmsg = _make_sendmsg()
+
+
+SCM_RIGHTS = getattr(socket, "SCM_RIGHTS", 1)
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("name", ctypes.c_void_p), ("namelen", ctypes.c_uint32), ("iov", ctypes.c_void_p),
+                ("iovlen", ctypes.c_size_t), ("control", ctypes.c_void_p), ("controllen", ctypes.c_size_t),
+                ("flags", ctypes.c_int)]
+
+
+class _FdControl(ctypes.Structure):
+    # 只带一个fd的cmsghdr, 结构体的对齐与CMSG_SPACE(sizeof(int))一致
+    _fields_ = [("len", ctypes.c_size_t), ("level", ctypes.c_int), ("type", ctypes.c_int), ("fd", ctypes.c_int)]
+
+_FD_CONTROL_LEN = _FdControl.fd.offset + ctypes.sizeof(ctypes.c_int)    # CMSG_LEN(sizeof(int))
+
+
+def _make_fd_passing():
+    if hasattr(socket.socket, "sendmsg"):
+        import array
+        import struct
+
+        def send_fd(sock, data, fd):
+            return sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))])
+
+        def recv_fd(sock, size):
+            data, ancdata, flags, addr = sock.recvmsg(size, socket.CMSG_SPACE(struct.calcsize("i")))
+            fd = None
+            for level, tp, cdata in ancdata:
+                if level == socket.SOL_SOCKET and tp == socket.SCM_RIGHTS and len(cdata) >= 4:
+                    fd = struct.unpack("i", cdata[:4])[0]
+            return data, fd
+        return send_fd, recv_fd
+    func_send = _libc_func("sendmsg", [ctypes.c_int, ctypes.POINTER(_MsgHdr), ctypes.c_int], ctypes.c_ssize_t)
+    func_recv = _libc_func("recvmsg", [ctypes.c_int, ctypes.POINTER(_MsgHdr), ctypes.c_int], ctypes.c_ssize_t)
+    if func_send is None or func_recv is None:
+        return None, None
+
+    def _error():
+        err = ctypes.get_errno()
+        return socket.error(err, os.strerror(err))
+
+    def send_fd(sock, data, fd):
+        """把data与fd(SCM_RIGHTS)作为一个消息发送到sock, 失败时抛出socket.error, 不会只发出其中之一
+        @return: 发送的字节数
+        """
+        buf = ctypes.create_string_buffer(data, len(data))
+        iov = _IOVec(ctypes.cast(buf, ctypes.c_void_p), len(data))
+        control = _FdControl(_FD_CONTROL_LEN, socket.SOL_SOCKET, SCM_RIGHTS, fd)
+        msg = _MsgHdr(None, 0, ctypes.cast(ctypes.byref(iov), ctypes.c_void_p), 1,
+                      ctypes.cast(ctypes.byref(control), ctypes.c_void_p), ctypes.sizeof(control), 0)
+        ret = func_send(sock.fileno(), ctypes.byref(msg), 0)
+        if ret < 0:
+            raise _error()
+        return ret
+
+    def recv_fd(sock, size):
+        """从sock接收一个消息, 失败时抛出socket.error
+        @return: (data, fd), 消息没有附带fd时fd为None
+        """
+        buf = ctypes.create_string_buffer(size)
+        iov = _IOVec(ctypes.cast(buf, ctypes.c_void_p), size)
+        control = _FdControl()
+        msg = _MsgHdr(None, 0, ctypes.cast(ctypes.byref(iov), ctypes.c_void_p), 1,
+                      ctypes.cast(ctypes.byref(control), ctypes.c_void_p), ctypes.sizeof(control), 0)
+        ret = func_recv(sock.fileno(), ctypes.byref(msg), 0)
+        if ret < 0:
+            raise _error()
+        fd = None
+        if (msg.controllen >= _FD_CONTROL_LEN and control.level == socket.SOL_SOCKET
+                and control.type == SCM_RIGHTS):
+            fd = control.fd
+        return buf.raw[:ret], fd
+    return send_fd, recv_fd
+
+send_fd, recv_fd = _make_fd_passing()
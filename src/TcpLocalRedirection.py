@@ -3,142 +3,544 @@
 # 
 # [up] remote server <- local redir <- client [down]
 # 
+#   remote可以是多个后端, 由Balancer选择, 连接失败时换下一个后端重试
+# 
 
-import select
 import socket
 import errno
 import time
 import logging
 import mimetypes
+from collections import OrderedDict
+
+from Poller import create_poller, PollerView
+from Scheduler import IOScheduler, QUANTUM, MAX_ACCEPTS
+from Resolver import Resolver
+from Buffer import Buffer, PipeBuffer, budget, PIPE_CAPACITY, SHRINK_AFTER
+from Upstream import UpstreamPool
+from Balancer import Backend, Balancer, HealthChecker
+from Timers import TimerQueue
+from Metrics import Stats, MetricsServer
+from SocketProfile import SocketProfile, set_cork
+from Profiler import LoopProfiler
+from Offload import create_hook_pool, feed_pipeline
 
 
 class Connection(object):
-    def __init__(self, sock, addr, max_buf_size):
+    budgeted = True     # 受缓冲预算(Buffer.budget)限制
+    cork = False        # 发送多段数据时设置TCP_CORK, 见SocketProfile
+
+    def __init__(self, sock, addr, max_buf_size, min_buf_size=0):
+        """
+        @param max_buf_size, min_buf_size: 接收缓冲大小的范围, min_buf_size为0时固定为max_buf_size
+        """
         self.sock = sock
         self.addr = addr
         self.create = time.time()
-        self.rbuf = ""
+        self.rbuf = Buffer()
         self.max_buf_size = max_buf_size
+        self.min_buf_size = min_buf_size or max_buf_size
+        self.buf_size = self.min_buf_size   # 当前的缓冲大小
+        self.small_reads = 0                # 连续的接收后缓冲占用不到1/4的次数
+        self.connecting = False
 
     @property
     def rbuf_full(self):
-        return len(self.rbuf) >= self.max_buf_size
+        return len(self.rbuf) >= self.buf_size or self.rbuf.stalled
+
+    @property
+    def over_budget(self):
+        """缓冲预算不允许再接收
+        """
+        return self.budgeted and budget.allowance(self.rbuf.memory) <= 0
+
+    def recv_limit(self):
+        """
+        @return: 现在最多还能接收的字节数, 受buf_size与缓冲预算限制
+        """
+        left = self.buf_size - len(self.rbuf)
+        if self.budgeted and left > 0:
+            left = min(left, budget.allowance(self.rbuf.memory))   # FileRegion不占用内存
+        return left
 
-    def recv(self):
+    def recv(self, quota=0):
         """
+        @param quota: 本次最多接收的字节数(见Scheduler), 0表示接收到EAGAIN或缓冲满为止
         @return received size. -1表示连接断开
         """
         rsize = 0
+        rbuf, sock = self.rbuf, self.sock
+        buf_left = self.recv_limit()
         try:
             while True:
-                buf_left = self.max_buf_size - len(self.rbuf)
-                data = self.sock.recv(buf_left)
-                if data:
-                    self.rbuf += data
-                    rsize += len(data)
-                    if self.rbuf_full:
-                        return rsize
+                if buf_left <= 0:
+                    if not self.grow():     # 加倍后继续读, epoll边沿触发时必须读到EAGAIN或缓冲满
+                        break
+                    buf_left = self.recv_limit()
+                    continue
+                if quota:
+                    if rsize >= quota:
+                        break
+                    size = rbuf.recv_from(sock, min(buf_left, quota - rsize))
                 else:
+                    size = rbuf.recv_from(sock, buf_left)
+                if size:
+                    rsize += size
+                    buf_left -= size
+                else:
+                    return -1   # connection closed.
+        except socket.error, e:
+            if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return -1
+        self.shrink()
+        return rsize
+
+    def recv_through(self, pipeline, quota=0):
+        """与recv相同, 但收到的数据先经过pipeline(Filters.Pipeline)处理再放入rbuf
+        @return received size. -1表示连接断开
+        """
+        rsize = 0
+        rbuf, sock = self.rbuf, self.sock
+        try:
+            while True:
+                buf_left = self.recv_limit()
+                if buf_left <= 0:
+                    if self.grow():     # 加倍后继续读, epoll边沿触发时必须读到EAGAIN或缓冲满
+                        continue
+                    break
+                if quota:
+                    if rsize >= quota:
+                        break
+                    buf_left = min(buf_left, quota - rsize)
+                data = sock.recv(buf_left)
+                if not data:
+                    for chunk in pipeline.flush():
+                        rbuf.write(chunk)
                     return -1   # connection closed.
+                rsize += len(data)
+                for chunk in pipeline.feed(data):
+                    rbuf.write(chunk)
         except socket.error, e:
             if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return -1
+        self.shrink()
         return rsize
 
-    def send(self, data):
+    def recv_data(self, quota=0):
+        """与recv相同, 但收到的数据不放入rbuf(交给Offload.HookPool处理后再放入), 最多接收到缓冲剩余的大小
+        @return: (收到的数据, 连接是否断开)
         """
+        limit = self.recv_limit()
+        if quota:
+            limit = min(limit, quota)
+        chunks, rsize = [], 0
+        try:
+            while rsize < limit:
+                data = self.sock.recv(limit - rsize)
+                if not data:
+                    return "".join(chunks), True
+                chunks.append(data)
+                rsize += len(data)
+        except socket.error, e:
+            if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return "".join(chunks), True
+        return "".join(chunks), False
+
+    def send(self, buf):
+        """发送buf(Buffer)头部的数据, 已发送的部分从buf中移除
         @return sended size, -1表示连接断开
         """
+        cork = self.cork and buf.fragmented
+        if cork:
+            set_cork(self.sock, True)
         ssize = 0
         try:
-            # while data:
-            #     size = self.sock.send(data)
-            #     data = data[size:]
-            #     ssize += size
-            ssize = self.sock.send(data)
+            # send_to每次只发送头部的一部分, epoll边沿触发时需要一直发送到EAGAIN
+            while buf:
+                ssize += buf.send_to(self.sock)
         except socket.error, e:
             if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return -1   # socket closed
+        finally:
+            if cork:
+                set_cork(self.sock, False)
         return ssize
 
+    def connect(self, addr):
+        """非阻塞connect
+        @return: False表示连接失败. 返回True时若self.connecting为真, 需等socket可写后调用finish_connect
+        """
+        err = self.sock.connect_ex(addr)
+        if err in (0, errno.EISCONN):
+            return True
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.connecting = True
+            return True
+        return False
+
+    def finish_connect(self):
+        """
+        @return: 连接是否成功
+        """
+        self.connecting = False
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+
+    def use_pipe(self):
+        """改用PipeBuffer(splice)缓冲, 缓冲中已有的数据会移到pipe中
+        @return: 是否切换成功
+        """
+        if not PipeBuffer.available:
+            return False
+        try:
+            rbuf = PipeBuffer(PIPE_CAPACITY, self.rbuf.getvalue())
+        except (OSError, IOError), e:
+            logging.debug("Splice is unavailable: %s", e)
+            return False
+        self.rbuf.close()
+        self.rbuf = rbuf
+        # pipe按页存放, 数据不满一页时也占用一页, 多留一些页以免提前放满
+        self.fix_buf_size(min(self.max_buf_size, rbuf.capacity // 4))
+        return True
+
+    def grow(self):
+        """缓冲已满时调用, 如果之前的数据曾全部发送完(对端跟得上), buf_size加倍
+        @return: 是否加倍, 加倍后应继续接收(epoll边沿触发)
+        """
+        if self.buf_size >= self.max_buf_size or not self.rbuf.emptied:
+            return False
+        self.rbuf.emptied = False
+        self.buf_size = min(self.buf_size * 2, self.max_buf_size)
+        self.small_reads = 0
+        return True
+
+    def shrink(self):
+        """接收结束后调用, 连续SHRINK_AFTER次缓冲占用不到1/4时buf_size减半
+        """
+        if self.buf_size <= self.min_buf_size:
+            return
+        if len(self.rbuf) >= self.buf_size // 4:
+            self.small_reads = 0
+            return
+        self.small_reads += 1
+        if self.small_reads >= SHRINK_AFTER:
+            self.small_reads = 0
+            self.buf_size = max(self.buf_size // 2, self.min_buf_size)
+
+    def fix_buf_size(self, size):
+        """固定缓冲大小, 不再调整
+        """
+        self.min_buf_size = self.max_buf_size = self.buf_size = size
+
 
 class Forward(object):
     def __init__(self, proxy, client, client_addr):
-        remote_addr = proxy.remote_addr
-        remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            remote.connect(proxy.remote_addr)   # remote-sock is blocking now.
-        except socket.error, e:
-            logging.warning("Connect to remote[%s:%s] failed." % remote_addr)
-            remote.close()
+        self.proxy = proxy
+        self.closing = None     # 已断开的一端, 它发来的数据转发完后关闭
+        self.intercept_down = _overrides(self, "process_down_recv")
+        self.intercept_up = _overrides(self, "process_up_recv")
+        self.down_pipeline = self.create_down_pipeline()
+        self.up_pipeline = self.create_up_pipeline()
+        self.down = Connection(client, client_addr, self.proxy.max_buf_size, self.proxy.min_buf_size)
+        proxy.down_profile.apply(self.down)
+        self.up = None
+        self.backend = None
+        self.tried = []         # 已经尝试过的后端
+        self.last_active = proxy.timers.now
+        self.idle_timer = None
+        self.active = False     # 计入了stats.forwards_active
+        self.hooking = None     # 交给hook_pool处理中的(connection, rsize, pipeline), 完成之前不读取两端
+        self.holding = None     # process_*_recv处理中的connection, 它的rbuf暂不发送
+        if not self.connect_upstream():
             client.close()
             return
-        remote.setblocking(0)
 
-        self.proxy = proxy
-        self.down = Connection(client, client_addr, self.proxy.max_buf_size)
-        self.up = Connection(remote, remote_addr, self.proxy.max_buf_size)
+        self.active = True
+        proxy.stats.forwards.inc()
+        proxy.stats.forwards_active.inc()
+        if self.pipe_enabled:
+            self.down.use_pipe()
         proxy._forwards[client] = self
-        proxy._forwards[remote] = self
-        proxy.r_list.add(client)
-        proxy.r_list.add(remote)
-
-    def close(self):
-        for conn in (self.up, self.down):
-            sock = conn.sock
-            self.proxy._forwards.pop(sock, None)
-            self.proxy.r_list.discard(sock)
-            self.proxy.w_list.discard(sock)
-            sock.close()
+        proxy.r_list.add(client)    # 连接建立之前client发来的数据先缓存在down.rbuf
+        if proxy.idle_timeout:
+            self.idle_timer = proxy.timers.call_later(proxy.idle_timeout, self.check_idle)
+
+    def check_idle(self):
+        """空闲超时定时器到期. 期间有过收发时, 按最后活动时间重新设置
+        """
+        timers, timeout = self.proxy.timers, self.proxy.idle_timeout
+        if timers.now - self.last_active >= timeout:
+            logging.info("Close idle forward of client[%s:%s]." % self.down.addr)
+            self.close()
+        else:
+            self.idle_timer = timers.call_at(self.last_active + timeout, self.check_idle)
+
+    @property
+    def pipe_enabled(self):
+        """未重载拦截方法(也没有使用Pipeline)时, 两个方向都改用splice转发, 数据不再经过用户空间
+        """
+        if self.down_pipeline or self.up_pipeline:
+            return False
+        return self.proxy.splice and not (self.intercept_down or self.intercept_up)
+
+    def connect_upstream(self):
+        """从尚未尝试过的后端中选择一个并连接
+        @return: 是否成功(包括正在连接), 所有后端都失败时返回False
+        """
+        proxy = self.proxy
+        while True:
+            backend = proxy.balancer.choose(self.down.addr, self.tried)
+            if backend is None:
+                return False
+            self.tried.append(backend)
+            up = backend.pool.get() if backend.pool else None
+            if up is None:
+                remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                remote.setblocking(0)
+                up = Connection(remote, backend.addr, proxy.max_buf_size, proxy.min_buf_size)
+                proxy.up_profile.apply(up)
+                try:
+                    connected = up.connect(proxy.resolver.resolve(backend.addr))
+                except socket.error, e:
+                    connected = False
+                if not connected:
+                    logging.warning("Connect to remote[%s:%s] failed." % backend.addr)
+                    remote.close()
+                    proxy.balancer.report(backend, False)
+                    continue
+            self.up, self.backend = up, backend
+            backend.active += 1
+            if self.pipe_enabled:
+                up.use_pipe()
+            proxy._forwards[up.sock] = self
+            if up.connecting:
+                proxy._connecting[self] = proxy.timers.call_later(proxy.connect_timeout, self.on_connect_timeout)
+                proxy.w_list.add(up.sock)
+            else:
+                if not up.rbuf_full:
+                    proxy.r_list.add(up.sock)
+                if up.rbuf:    # 在池中时remote已经发来的数据
+                    proxy.w_list.add(self.down.sock)
+            return True
+
+    def retry(self):
+        """连接当前后端失败, 换下一个后端. client发来的数据还在down.rbuf中, 不会丢失
+        """
+        self.proxy.balancer.report(self.backend, False)
+        self._close_up()
+        if not self.connect_upstream():
+            logging.warning("All remotes failed for client[%s:%s]." % self.down.addr)
+            self.close()
+
+    def on_connect_timeout(self):
+        del self.proxy._connecting[self]
+        logging.warning("Connect to remote[%s:%s] timeout." % self.up.addr)
+        self.retry()
+
+    def finish_connect(self):
+        self.proxy.timers.cancel(self.proxy._connecting.pop(self, None))
+        if not self.up.finish_connect():
+            logging.warning("Connect to remote[%s:%s] failed." % self.up.addr)
+            self.retry()
+            return False
+        self.proxy.stats.connect_seconds.observe(time.time() - self.up.create, "upstream")
+        self.proxy.balancer.report(self.backend, True)
+        if not self.hooking:
+            self.proxy.r_list.add(self.up.sock)
+        return True
+
+    def _close_up(self):
+        self.proxy.timers.cancel(self.proxy._connecting.pop(self, None))
+        up, self.up = self.up, None
+        if up:
+            self.backend.active -= 1
+            self.proxy._forwards.pop(up.sock, None)
+            self.proxy.r_list.discard(up.sock)
+            self.proxy.w_list.discard(up.sock)
+            up.sock.close()
+            up.rbuf.close()
+
+    def close(self, sock=None):
+        self._close_up()
+        self.proxy.timers.cancel(self.idle_timer)
+        if self.active:
+            self.active = False
+            self.proxy.stats.forwards_active.dec()
+        sock = self.down.sock
+        self.proxy._forwards.pop(sock, None)
+        self.proxy.r_list.discard(sock)
+        self.proxy.w_list.discard(sock)
+        sock.close()
+        self.down.rbuf.close()
 
     def on_recv(self, sock):
         if self.up.sock is sock:
-            conn, other, name = self.up, self.down, "Up"
+            conn, other, name = self.up, self.down, "up"
         elif self.down.sock is sock:
-            conn, other, name = self.down, self.up, "Down"
+            conn, other, name = self.down, self.up, "down"
         else:   # never happen
             assert 0, "wimp out?"
+        self.last_active = self.proxy.timers.now
+        stats = self.proxy.stats
 
-        rsize = conn.recv()
-        if rsize == -1:
+        pipeline = self.up_pipeline if conn is self.up else self.down_pipeline
+        if conn is self.up:
+            intercept, process = self.intercept_up, self.process_up_recv
+        else:
+            intercept, process = self.intercept_down, self.process_down_recv
+        hook_pool = self.proxy.hook_pool
+        if hook_pool and (intercept or pipeline) and (hook_pool.offloads_pipeline or not pipeline):
+            self.offload_recv(conn, other, name, pipeline, process)
+            return
+        quantum = self.proxy.scheduler.quantum
+        rsize = conn.recv_through(pipeline, quantum) if pipeline else conn.recv(quantum)
+        if rsize > 0:
+            stats.bytes.inc(rsize, name)
+        if rsize == -1 and not conn.rbuf:
             self.close()
         else:
             logging.debug("Recv from %s: %d", name, rsize)
-            process = self.process_up_recv if conn is self.up else self.process_down_recv
-            rdata, sdata = process(conn.rbuf)
-            if rdata is not None:
-                conn.rbuf = rdata
-            if sdata is not None:
-                other.rbuf += sdata
+            if pipeline:
+                for response in pipeline.take_responses():
+                    other.rbuf.write(response)
                 if other.rbuf:
                     self.proxy.w_list.add(conn.sock)
-            if conn.rbuf:
-                self.proxy.w_list.add(other.sock)
-            if conn.rbuf_full:
-                self.proxy.r_list.discard(conn.sock)
+            elif intercept:   # 未重载拦截方法时不需要把缓冲拷贝成str
+                rdata, sdata = process(conn.rbuf.getvalue())
+                self.apply_process(conn, other, rdata, sdata)
+            self.recv_done(conn, other, name, rsize)
+
+    def recv_done(self, conn, other, name, rsize):
+        """从conn接收并拦截之后: 处理连接断开, 通知发送, 缓冲满或配额用完时暂停读取
+        """
+        stats = self.proxy.stats
+        if rsize == -1:
+            if not conn.rbuf:
+                self.close()
+                return
+            self.closing = conn     # 连接断开之前收到的数据转发完再关闭
+            self.proxy.r_list.discard(conn.sock)
+        if conn.rbuf:
+            self.proxy.w_list.add(other.sock)
+        if conn.rbuf_full:
+            stats.backpressure.inc(1, name)
+            self.proxy.r_list.discard(conn.sock)
+        elif conn.over_budget and self.closing is not conn:
+            self.proxy.wait_budget(conn, name)
+        elif self.proxy.scheduler.exhausted(rsize):
+            self.proxy.scheduler.defer(conn.sock)
+
+    def apply_process(self, conn, other, rdata, sdata):
+        """应用process_*_recv的结果
+        """
+        if rdata is not None:
+            conn.rbuf.set(rdata)
+        if sdata is not None:
+            other.rbuf.write(sdata)
+            if other.rbuf:
+                self.proxy.w_list.add(conn.sock)
+
+    def offload_recv(self, conn, other, name, pipeline, process):
+        """接收的数据交给hook_pool拦截(见Offload), 完成之前不再读取两端, 由on_hooked应用结果
+        """
+        proxy = self.proxy
+        if self.hooking:    # 上一次的结果还没有应用(例如缓冲预算恢复时被加回r_list)
+            proxy.r_list.discard(conn.sock)
+            return
+        quantum = proxy.scheduler.quantum
+        if pipeline:
+            data, closed = conn.recv_data(quantum)
+            received, rsize = len(data), -1 if closed else len(data)
+            hook, func, args = name + "_pipeline", feed_pipeline, (pipeline, data, closed)
+        else:
+            received = rsize = conn.recv(quantum)
+            hook, func, args = process.__name__, process, (conn.rbuf.getvalue(),)
+        if received > 0:
+            proxy.stats.bytes.inc(received, name)
+        logging.debug("Recv from %s: %d", name, rsize)
+        if rsize == 0 or (rsize == -1 and not pipeline and not conn.rbuf):
+            self.recv_done(conn, other, name, rsize)
+            return
+        self.hooking = (conn, rsize, pipeline)
+        if not pipeline:
+            self.holding = conn
+        for c in (self.down, self.up):
+            proxy.r_list.discard(c.sock)
+        proxy.hook_pool.submit(self, hook, func, args)
+
+    def on_hooked(self, result, error):
+        """hook_pool处理完成, 在事件循环中调用
+        @param result: feed_pipeline或process_*_recv的返回值
+        @param error: 拦截抛出了异常(traceback), 关闭转发
+        """
+        conn, rsize, pipeline = self.hooking
+        self.hooking = self.holding = None
+        if not self.active:
+            return
+        if conn is self.down:
+            other, name = self.up, "down"
+        elif conn is self.up:
+            other, name = self.down, "up"
+        else:   # conn已经被关闭(换了后端)
+            return
+        if error:
+            self.close()
+            return
+        proxy = self.proxy
+        if pipeline:
+            chunks, responses = result
+            for chunk in chunks:
+                conn.rbuf.write(chunk)
+            for response in responses:
+                other.rbuf.write(response)
+            if other.rbuf:
+                proxy.w_list.add(conn.sock)
+        else:
+            self.apply_process(conn, other, *result)
+        self.recv_done(conn, other, name, rsize)
+        if not self.active:
+            return
+        for c in (self.down, self.up):
+            if (not c.connecting and self.closing is not c and not c.rbuf_full
+                    and c not in proxy._budget_waiting):
+                proxy.r_list.add(c.sock)
 
     def on_send(self, sock):
         if self.up.sock is sock:
-            conn, other, name = self.up, self.down, "Up"
+            conn, other, name = self.up, self.down, "up"
         elif self.down.sock is sock:
-            conn, other, name = self.down, self.up, "Down"
+            conn, other, name = self.down, self.up, "down"
         else:   # never happen
             assert 0, "wimp out?"
-        if not other.rbuf:
+        self.last_active = self.proxy.timers.now
+        if conn.connecting and not self.finish_connect():
+            return
+        if not other.rbuf or self.holding is other:
+            self.proxy.w_list.discard(conn.sock)
             return
         ssize = conn.send(other.rbuf)
-        if ssize == -1:
+        if ssize == -1 or (self.closing is other and not other.rbuf):
             self.close()
         else:
             logging.debug("Send to %s: %d", name, ssize)
-            other.rbuf = other.rbuf[ssize:]
             if not other.rbuf:
                 self.proxy.w_list.discard(conn.sock)
-            if not other.rbuf_full:
+            if not other.rbuf_full and self.closing is not other and not self.hooking:
                 self.proxy.r_list.add(other.sock)
 
     # ----- 对转发进行拦截 -----
 
+    def create_down_pipeline(self):
+        """
+        @return: 流式处理从Client接收到的数据的Filters.Pipeline, 使用时不再调用process_down_recv. None表示不使用
+        """
+        return None
+
+    def create_up_pipeline(self):
+        """
+        @return: 流式处理从Remote接收到的数据的Filters.Pipeline, 使用时不再调用process_up_recv. None表示不使用
+        """
+        return None
+
     def process_down_recv(self, data):
         """处理从Client接收到的数据
         @param data: 从Client接收到的数据
@@ -160,65 +562,238 @@ class Forward(object):
         return (None, None)
 
 
+def _overrides(forward, name):
+    """forward是否重载了Forward的拦截方法name
+    """
+    return getattr(type(forward), name).im_func is not getattr(Forward, name).im_func
+
+
 class TcpLocalRedirection(object):
-    def __init__(self, bind_addr, remote_addr, max_buf_size=1024*64, forward=None):
+    def __init__(self, bind_addr, remote_addr, max_buf_size=1024*1024, forward=None, poller=None,
+                 connect_timeout=10, splice=True, reuse_port=False, upstream_pool=0,
+                 balance="round_robin", health_check=5, idle_timeout=0, metrics_addr=None, buffer_budget=0,
+                 min_buf_size=1024*4, slow_callback=0, down_socket=None, up_socket=None, io_quantum=QUANTUM,
+                 max_accepts=MAX_ACCEPTS, hook_pool=None, hook_workers=4):
+        """
+        @param remote_addr: (host, port), 或多个后端[(host, port), ...] / [((host, port), weight), ...]
+        @param poller: "epoll", "poll", "select", None表示自动选择, 或者Redirector提供的PollerView
+        @param connect_timeout: 连接remote的超时时间(秒)
+        @param upstream_pool: 每个后端预先建立的空闲连接数, 0表示每个client到来时才连接remote
+        @param balance: 多个后端时的负载均衡策略, "round_robin", "least_active", "hash"(按client ip)
+        @param health_check: 多个后端时健康检查的间隔(秒), 0表示不检查
+        @param idle_timeout: 两个方向都没有数据超过这么久(秒)时关闭转发, 0表示不限制
+        @param metrics_addr: (host, port), 在此地址上提供Prometheus格式的统计(GET /metrics), None表示不提供
+        @param buffer_budget: 进程内所有连接缓冲的总字节数上限(见Buffer.BufferBudget), 0表示不限制
+        @param slow_callback: 大于0时开启事件循环的性能分析(见Profiler), 回调超过这么久(秒)时记录警告
+        @param io_quantum: 每个socket每轮循环最多接收的字节数, 用完后下一轮继续(见Scheduler), 0表示不限制
+        @param max_accepts: 每轮循环最多accept的连接数, 0表示不限制
+        @param hook_pool: "thread"或"process", 在线程/进程池中执行拦截(见Offload), None表示在事件循环中执行
+        @param hook_workers: 池中的线程/进程数
+        @param down_socket, up_socket: client一侧与remote/tunnel一侧socket的选项(SocketProfile), None表示不设置
+        @param max_buf_size, min_buf_size: 每个连接接收缓冲大小的范围, 两者相等时大小固定
+                缓冲从min_buf_size开始, 对端跟得上且缓冲被填满时加倍, 持续用不到1/4时减半
+        @param splice: 对未重载拦截方法的Forward使用splice转发(平台支持时)
+        @param reuse_port: 设置SO_REUSEPORT, 多个进程绑定同一地址(见Workers.WorkerPool)
+        """
         self.bind_addr = bind_addr
-        self.remote_addr = remote_addr
+        if isinstance(remote_addr[0], basestring):
+            remote_addr = [remote_addr]
+        backends = [Backend(*addr) if isinstance(addr[0], tuple) else Backend(addr) for addr in remote_addr]
+        self.remote_addr = backends[0].addr
+        self.balancer = Balancer(backends, balance)
         self.max_buf_size = max_buf_size
+        self.min_buf_size = min(min_buf_size, max_buf_size)
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.splice = splice
+        self.down_profile = down_socket or SocketProfile()
+        self.up_profile = up_socket or SocketProfile()
+        self.resolver = Resolver()
+        self.resolver.prewarm([backend.addr for backend in backends])
+        if buffer_budget:
+            budget.set_limit(buffer_budget)
+        self.accept_paused = False
+        self._budget_waiting = OrderedDict()    # 等待缓冲预算的connection
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setblocking(0)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR  , 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind(bind_addr)
-        sock.listen(200)
+        self.down_profile.listen(sock)
         self.server = sock
         self.Forward = forward if forward else Forward
 
         self._forwards = {}
-        self.w_list = set()
-        self.r_list = set()
+        self._connecting = {}   # forward -> connect超时定时器
+        self.stats = stats = Stats()
+        self.poller = create_poller(poller)
+        self.w_list = self.poller.w_list
+        self.r_list = self.poller.r_list
+        if isinstance(self.poller, PollerView):
+            self.timers, self.scheduler = self.poller.timers, self.poller.scheduler
+        else:
+            self.timers = TimerQueue()
+            self.scheduler = IOScheduler(self.poller.r_list, io_quantum, max_accepts)
+            stats.counter("io_deferrals_total", "Reads or accepts postponed to the next loop iteration by the quota.",
+                    func=lambda: self.scheduler.deferred)
         self.r_list.add(self.server)
+        self.hook_pool = create_hook_pool(self, hook_pool, hook_workers) if hook_pool else None
+        if upstream_pool:
+            for backend in backends:
+                backend.pool = UpstreamPool(self, backend.addr, upstream_pool, Connection)
+        self.health_check = None
+        if health_check and len(backends) > 1:
+            self.health_check = HealthChecker(self, self.balancer, health_check, connect_timeout)
+
+        per_backend = lambda get: lambda: [((repr(b),), get(b)) for b in backends]
+        stats.gauge("backend_healthy", "Whether the backend passes health checks.", ("backend",),
+                per_backend(lambda b: int(b.healthy)))
+        stats.gauge("backend_active", "Forwards currently using the backend.", ("backend",),
+                per_backend(lambda b: b.active))
+        if upstream_pool:
+            stats.gauge("upstream_pool_idle", "Connected idle sockets in the upstream pool.", ("backend",),
+                    per_backend(lambda b: len(b.pool.idle)))
+            stats.counter("upstream_pool_hits_total", "Clients served from the upstream pool.", ("backend",),
+                    per_backend(lambda b: b.pool.hits))
+            stats.counter("upstream_pool_misses_total", "Clients that found the upstream pool empty.", ("backend",),
+                    per_backend(lambda b: b.pool.misses))
+        if metrics_addr:
+            MetricsServer(self, metrics_addr)
+        if slow_callback:
+            LoopProfiler(self, slow_callback).install()
+
+    def wait_budget(self, conn, side):
+        """缓冲预算不允许conn再接收, 暂停读取, 预算回落后由check_budget恢复
+        """
+        self.stats.budget_pauses.inc(1, side)
+        self.r_list.discard(conn.sock)
+        self._budget_waiting[conn] = None
 
-    def main_loop(self):
-        def call(sock, method):
-            forward = self._forwards.get(sock)
-            if forward:
-                getattr(forward, method)(sock)
-            else:
-                logging.error("Close [unkown connection].")
-                self.r_list.discard(sock)
-                self.w_list.discard(sock)
-                sock.close()
+    def check_budget(self):
+        """每轮循环结束时调用: 预算用完时暂停accept; 回落到low_water以下时恢复accept和等待预算的连接
+        """
+        if budget.exhausted:
+            if self.server and not self.accept_paused:
+                logging.info("Buffer budget is exhausted (%d bytes), pause accepting.", budget.used)
+                self.accept_paused = True
+                self.stats.accept_pauses.inc()
+                self.r_list.discard(self.server)
+        elif not budget.tight:
+            if self.accept_paused:
+                logging.info("Buffer budget is available, resume accepting.")
+                self.accept_paused = False
+                self.r_list.add(self.server)
+            if self._budget_waiting:
+                waiting, self._budget_waiting = self._budget_waiting, OrderedDict()
+                for conn in waiting:    # 按暂停的先后
+                    if not conn.rbuf.closed:
+                        self.r_list.add(conn.sock)
+
+    def _call(self, sock, method):
+        if sock not in self.r_list and sock not in self.w_list:
+            return  # 在本轮循环中已经被关闭
+        forward = self._forwards.get(sock)
+        if forward:
+            getattr(forward, method)(sock)
+        else:
+            logging.error("Close [unkown connection].")
+            self.r_list.discard(sock)
+            self.w_list.discard(sock)
+            sock.close()
 
-        timeout = 0.1
+    def accept(self):
+        accepted = 0
         while True:
-            r_list, w_list, e_list = select.select(self.r_list, self.w_list, self.r_list, timeout)
+            try:
+                client, client_addr = self.server.accept()
+                client.setblocking(0)
+                logging.info("Accept conn[%s:%s]" % client_addr)
+                self.stats.accepts.inc()
+                self.Forward(self, client, client_addr)
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                raise
+            accepted += 1
+            if accepted == self.scheduler.max_accepts:
+                self.scheduler.defer(self.server)   # 其余的连接下一轮再accept
+                break
+
+    # on_readable, on_writable, on_error, on_loop_end: 事件循环的入口, 由main_loop或Redirector调用
+    def on_readable(self, sock):
+        if sock is self.server:
+            self.accept()
+        elif self.hook_pool and sock is self.hook_pool.wakeup:
+            self.hook_pool.on_wakeup()
+        else:
+            self._call(sock, "on_recv")
+
+    def on_writable(self, sock):
+        self._call(sock, "on_send")
+
+    def on_error(self, sock):
+        self._call(sock, "close")
+
+    def on_loop_end(self):
+        """每轮循环处理完所有事件后调用
+        """
+        self.check_budget()
+        if self.hook_pool and not self.server and not self._forwards:
+            self.hook_pool.close()  # stop之后所有forward都已关闭
+            self.hook_pool = None
+
+    def stop(self):
+        """停止接受新的client(Redirector删除映射时), 已有的forward继续转发直到关闭
+        """
+        if self.server:
+            self.r_list.discard(self.server)
+            self.server.close()
+            self.server = None
+            self.accept_paused = False
+        if self.health_check:
+            self.health_check.stop()
+        for backend in self.balancer.backends:
+            if backend.pool:
+                backend.pool.stop()
+        if self.hook_pool and not self._forwards:
+            self.hook_pool.close()
+            self.hook_pool = None
+
+    @property
+    def active(self):
+        """还有正在转发的连接(stop之后用于判断是否可以丢弃)
+        """
+        return bool(self._forwards)
+
+    def main_loop(self):
+        while True:
+            r_list, w_list, e_list = self.poller.poll(self.scheduler.timeout(self.timers.timeout()))
+            self.timers.run()
             for sock in e_list:
-                call(sock, "close")
-            for sock in r_list:
-                if sock is self.server:
-                    while True:
-                        try:
-                            client, client_addr = sock.accept()
-                            client.setblocking(0)
-                            logging.info("Accept conn[%s:%s]" % client_addr)
-                            self.Forward(self, client, client_addr)
-                        except socket.error, e:
-                            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
-                                break
-                            raise
-                else:
-                    call(sock, "on_recv")
+                self.on_error(sock)
+            for sock in self.scheduler.readable(r_list):
+                self.on_readable(sock)
             for sock in w_list:
-                call(sock, "on_send")
+                self.on_writable(sock)
+            self.on_loop_end()
 
 
 if __name__ == '__main__':
+    import sys
     logging.basicConfig(level=logging.DEBUG)
     bind_addr = ("127.0.0.1", 1234)
     remote_addr = ("127.0.0.1", 22)
-    lrd = TcpLocalRedirection(bind_addr, remote_addr)
-    lrd.main_loop()
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    if workers:
+        from Workers import WorkerPool
+        def run_worker(worker_id):
+            TcpLocalRedirection(bind_addr, remote_addr, reuse_port=True).main_loop()
+        WorkerPool(run_worker, workers).run()
+    else:
+        lrd = TcpLocalRedirection(bind_addr, remote_addr)
+        lrd.main_loop()
 
 
 
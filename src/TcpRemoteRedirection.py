@@ -4,176 +4,496 @@
 # [up]Server <-> RRDClient <-> RRDServer <-> Client[down]
 # 
 #   RRDClient启动时，会创建一定数的连接连接到RRDServer，并发送长度为10个字节(格式为"{[(xxxx)]}")到RRDServer，用于标识为内部链接
+#   RRDServer指定了tunnel_addr时, private连接连接到这个单独的端口, 公开端口上的连接accept后立即作为open连接配对,
+#   由服务端先发送数据的协议(ssh, smtp, mysql等)也可以转发. 只用一个端口时按标识头区分, 超过classify_timeout
+#   还没有收到任何数据的连接按open连接处理.
+#   扩展格式"{[(Xnnn)]}"中nnn为标志位, FLAG_MUX表示该连接是多路复用tunnel(见Multiplex)
+#   FLAG_ADAPTIVE的private连接配对时, RRDServer会在数据之前插入一个控制头"{[(Gnnn)]}",
+#   nnn为建议RRDClient增加的private连接数(还在排队的open连接), 0表示不需要
+#   FLAG_ZLIB的private连接配对时, RRDServer插入控制头"{[(Z001)]}"表示之后的数据压缩传输, "{[(Z000)]}"表示不压缩(见Compression)
+#   FLAG_PAIRED的private连接配对时, RRDServer插入控制头"{[(P000)]}", RRDClient收到后立即连接Server,
+#   不必等待Client先发送数据
+#   旧版的RRDServer只认识"{[(nnnn)]}", 把扩展格式当作open连接. 所以RRDClient默认(paired=False, 固定的连接池,
+#   不压缩, 不使用多路复用tunnel)只发送"{[(nnnn)]}"; 升级时先升级RRDServer, 再在RRDClient上开启这些选项
 # 
 
 
 import socket
-import select
 import errno
 import time
 import re
+import math
 import random
 import logging
+from collections import OrderedDict
+
+from Poller import create_poller, PollerView
+from Scheduler import IOScheduler, QUANTUM, MAX_ACCEPTS
+from Resolver import Resolver
+from Buffer import Buffer, PipeBuffer, budget, PIPE_CAPACITY, SHRINK_AFTER
+from Multiplex import MuxTunnel, FRAME_CLOSE
+from Timers import TimerQueue
+from Metrics import Stats, MetricsServer
+from SocketProfile import SocketProfile, set_cork
+from Profiler import LoopProfiler
+from Filters import Pipeline
+from Compression import CompressStage, DecompressStage, CompressionStats
+
+
+PRIVATE_HEAD_SIZE = 10
+FLAG_MUX = 1        # 多路复用tunnel
+FLAG_ADAPTIVE = 2   # 接受RRDServer的控制头, 动态调整连接池大小
+FLAG_ZLIB = 4       # 请求压缩传输, RRDServer用控制头回复是否接受
+FLAG_PAIRED = 8     # 配对时RRDServer用控制头通知
+CONTROL_FLAGS = FLAG_ADAPTIVE | FLAG_ZLIB | FLAG_PAIRED    # 配对时RRDServer会回复控制头的标志
+
+CONTROL_HEAD_REGEX = re.compile(r"^\{\[\(([A-Z])(\d{3})\)\]\}$")
+GROW_HINT_WAIT = 0.1    # open连接等待配对超过这么久(秒), 就建议RRDClient扩大连接池
+POOL_LIVE_TIME = 60     # 尚未配对的连接没有数据时最多保留这么久(秒)
+CLASSIFY_TIMEOUT = 0.5  # 只有一个端口时, accept后这么久(秒)没有收到数据的连接按open连接处理
+PRIVATE_HEAD_PREFIX = "{[("
+RETRY_DELAY = 1         # RRDClient连接失败后, 这么久(秒)之后再补充连接
+
+
+def private_head(flags=0):
+    """private连接的标识头
+    """
+    if flags:
+        return "{[(X%03d)]}" % flags
+    return "{[(%04d)]}" % random.randint(1, 9999)
+
+
+def head_flags(head):
+    return int(head[4:7]) if head[3] == "X" else 0
+
+
+def control_head(kind, value):
+    """RRDServer发往RRDClient的控制头
+    """
+    return "{[(%s%03d)]}" % (kind, min(value, 999))
 
 
 class Connection(object):
-    PRIVATE_HEAD_REGEX = re.compile(r"^\{\[\(\d{4}\)\]\}$")
+    PRIVATE_HEAD_REGEX = re.compile(r"^\{\[\((\d{4}|X\d{3})\)\]\}$")
+    PRIVATE_HEAD_PREFIX = PRIVATE_HEAD_PREFIX
 
     TP_PRIVATE = 1      # RRDServer与RRDClient之间的连接
     TP_OPEN = 2         # 外部链接
     TP_UNKNOWN = 3      # 未知
 
-    def __init__(self, sock, addr, max_buf_size):
+    budgeted = True     # 受缓冲预算(Buffer.budget)限制
+    cork = False        # 发送多段数据时设置TCP_CORK, 见SocketProfile
+    tunnel_port = False # 从RRDServer的tunnel端口accept, 只能是private连接
+
+    def __init__(self, sock, addr, max_buf_size, min_buf_size=0):
+        """
+        @param max_buf_size, min_buf_size: 接收缓冲大小的范围, min_buf_size为0时固定为max_buf_size
+        """
         self.sock = sock
         self.addr = addr
         self.create = time.time()
-        self.rbuf = ""
+        self.rbuf = Buffer()
         self.max_buf_size = max_buf_size
+        self.min_buf_size = min_buf_size or max_buf_size
+        self.buf_size = self.min_buf_size   # 当前的缓冲大小
+        self.small_reads = 0                # 连续的接收后缓冲占用不到1/4的次数
         self.rsize = 0
         self.ssize = 0
+        self.connecting = False
+        self.flags = 0      # private连接标识头中的标志位
+        self.timer = None   # 在conn_pool中的寿命定时器
 
     @property
     def type(self):
         """当前连接类型
         """
         cls = type(self)
-        if len(self.rbuf) >= 10:
-            if cls.PRIVATE_HEAD_REGEX.match(self.rbuf[:10]):
-                return cls.TP_PRIVATE
-            else:
-                return cls.TP_OPEN
-        else:
-            str1 = "{[(0000)]}"
-            str2 = "{[(9999)]}"
-            for idx, c in enumerate(self.rbuf):
-                if 3 <= idx < 7:
-                    if not (str1[idx] <= c <= str2[idx]):
-                        return cls.TP_OPEN
-                else:
-                    if str1[idx] != c:
-                        return cls.TP_OPEN
+        head = self.rbuf.head(PRIVATE_HEAD_SIZE)
+        prefix = cls.PRIVATE_HEAD_PREFIX
+        if not head.startswith(prefix) and not prefix.startswith(head):
+            return cls.TP_OPEN     # 固定前缀不符, 绝大多数open连接在这里确定
+        if len(head) < PRIVATE_HEAD_SIZE:
             return cls.TP_UNKNOWN
+        return cls.TP_PRIVATE if cls.PRIVATE_HEAD_REGEX.match(head) else cls.TP_OPEN
 
     @property
     def rbuf_full(self):
-        return len(self.rbuf) >= self.max_buf_size
+        return len(self.rbuf) >= self.buf_size or self.rbuf.stalled
+
+    @property
+    def over_budget(self):
+        """缓冲预算不允许再接收
+        """
+        return self.budgeted and budget.allowance(self.rbuf.memory) <= 0
+
+    def recv_limit(self):
+        """
+        @return: 现在最多还能接收的字节数, 受buf_size与缓冲预算限制
+        """
+        left = self.buf_size - len(self.rbuf)
+        if self.budgeted and left > 0:
+            left = min(left, budget.allowance(self.rbuf.memory))   # FileRegion不占用内存
+        return left
 
-    def recv(self):
+    def recv(self, quota=0):
         """
+        @param quota: 本次最多接收的字节数(见Scheduler), 0表示接收到EAGAIN或缓冲满为止
         @return received size. -1表示连接断开
         """
         rsize = 0
+        rbuf, sock = self.rbuf, self.sock
+        buf_left = self.recv_limit()
         try:
             while True:
-                buf_left = self.max_buf_size - len(self.rbuf)
-                # if buf_left <= 0:
-                #     break
-                data = self.sock.recv(buf_left)
-                if data:
-                    self.rbuf += data
-                    rsize += len(data)
-                    self.rsize += len(data)
-                    if self.rbuf_full:
-                        return rsize
+                if buf_left <= 0:
+                    if not self.grow():     # 加倍后继续读, epoll边沿触发时必须读到EAGAIN或缓冲满
+                        break
+                    buf_left = self.recv_limit()
+                    continue
+                if quota:
+                    if rsize >= quota:
+                        break
+                    size = rbuf.recv_from(sock, min(buf_left, quota - rsize))
+                else:
+                    size = rbuf.recv_from(sock, buf_left)
+                if size:
+                    rsize += size
+                    buf_left -= size
                 else:
                     return -1   # connection closed.
         except socket.error, e:
             if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return -1
+        finally:
+            self.rsize += rsize
+        self.shrink()
         return rsize
 
-    def send(self, data):
+    def recv_through(self, pipeline, quota=0):
+        """与recv相同, 但收到的数据先经过pipeline(Filters.Pipeline)处理再放入rbuf
+        @return received size. -1表示连接断开
         """
+        rsize = 0
+        rbuf, sock = self.rbuf, self.sock
+        try:
+            while True:
+                buf_left = self.recv_limit()
+                if buf_left <= 0:
+                    if self.grow():     # 加倍后继续读, epoll边沿触发时必须读到EAGAIN或缓冲满
+                        continue
+                    break
+                if quota:
+                    if rsize >= quota:
+                        break
+                    buf_left = min(buf_left, quota - rsize)
+                data = sock.recv(buf_left)
+                if not data:
+                    for chunk in pipeline.flush():
+                        rbuf.write(chunk)
+                    return -1   # connection closed.
+                rsize += len(data)
+                for chunk in pipeline.feed(data):
+                    rbuf.write(chunk)
+        except socket.error, e:
+            if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return -1
+        finally:
+            self.rsize += rsize
+        self.shrink()
+        return rsize
+
+    def send(self, buf):
+        """发送buf(Buffer)头部的数据, 已发送的部分从buf中移除
         @return sended size, -1表示连接断开
         """
+        cork = self.cork and buf.fragmented
+        if cork:
+            set_cork(self.sock, True)
         ssize = 0
         try:
-            # while data:
-            #     size = self.sock.send(data)
-            #     data = data[size:]
-            #     ssize += size
-            ssize = self.sock.send(data)
-            self.ssize += ssize
+            # send_to每次只发送头部的一部分, epoll边沿触发时需要一直发送到EAGAIN
+            while buf:
+                ssize += buf.send_to(self.sock)
         except socket.error, e:
             if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return -1   # socket closed
+        finally:
+            self.ssize += ssize
+            if cork:
+                set_cork(self.sock, False)
         return ssize
 
     @property
     def connected(self):
         return self.recv() != -1
 
+    def connect(self, addr):
+        """非阻塞connect
+        @return: False表示连接失败. 返回True时若self.connecting为真, 需等socket可写后调用finish_connect
+        """
+        err = self.sock.connect_ex(addr)
+        if err in (0, errno.EISCONN):
+            return True
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.connecting = True
+            return True
+        return False
+
+    def finish_connect(self):
+        """
+        @return: 连接是否成功
+        """
+        self.connecting = False
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+
+    def use_pipe(self):
+        """改用PipeBuffer(splice)缓冲, 缓冲中已有的数据会移到pipe中
+        @return: 是否切换成功
+        """
+        if not PipeBuffer.available:
+            return False
+        try:
+            rbuf = PipeBuffer(PIPE_CAPACITY, self.rbuf.getvalue())
+        except (OSError, IOError), e:
+            logging.debug("Splice is unavailable: %s", e)
+            return False
+        self.rbuf.close()
+        self.rbuf = rbuf
+        # pipe按页存放, 数据不满一页时也占用一页, 多留一些页以免提前放满
+        self.fix_buf_size(min(self.max_buf_size, rbuf.capacity // 4))
+        return True
+
+    def grow(self):
+        """缓冲已满时调用, 如果之前的数据曾全部发送完(对端跟得上), buf_size加倍
+        @return: 是否加倍, 加倍后应继续接收(epoll边沿触发)
+        """
+        if self.buf_size >= self.max_buf_size or not self.rbuf.emptied:
+            return False
+        self.rbuf.emptied = False
+        self.buf_size = min(self.buf_size * 2, self.max_buf_size)
+        self.small_reads = 0
+        return True
+
+    def shrink(self):
+        """接收结束后调用, 连续SHRINK_AFTER次缓冲占用不到1/4时buf_size减半
+        """
+        if self.buf_size <= self.min_buf_size:
+            return
+        if len(self.rbuf) >= self.buf_size // 4:
+            self.small_reads = 0
+            return
+        self.small_reads += 1
+        if self.small_reads >= SHRINK_AFTER:
+            self.small_reads = 0
+            self.buf_size = max(self.buf_size // 2, self.min_buf_size)
+
+    def fix_buf_size(self, size):
+        """固定缓冲大小, 不再调整
+        """
+        self.min_buf_size = self.max_buf_size = self.buf_size = size
+
 
 class Forward(object):
+    hops = 0    # open连接在worker之间被传递的次数, 见Workers.Handoff
+
     def __init__(self, proxy, up=None, down=None):
         self.proxy = proxy
         self.up = up
         self.down = down
+        self.closing = None     # 已断开的一端, 它发来的数据转发完后关闭
+        self.timer = None       # 在forward_pool中时是寿命定时器, 配对后是空闲超时定时器
+        self.last_active = proxy.timers.now
+        self.active = False     # 已配对, 计入了stats.forwards_active
+        self.intercept_down = _overrides(self, "process_down_recv")
+        self.intercept_up = _overrides(self, "process_up_recv")
+        self.down_pipeline = self.create_down_pipeline()
+        self.up_pipeline = self.create_up_pipeline()
+        self.compressed = False     # tunnel一端压缩传输, 见enable_compression
+        self.compress_stage = None  # 压缩发往tunnel的数据的CompressStage
+
+    @property
+    def intercepted(self):
+        """是否重载了拦截方法或使用了Pipeline
+        """
+        return bool(self.intercept_down or self.intercept_up or self.down_pipeline or self.up_pipeline)
+
+    def enable_compression(self):
+        """private连接协商了压缩: 发往tunnel的数据经过拦截后压缩, 从tunnel收到的数据先解压再拦截.
+        RRDClient不拦截数据, 只有压缩与解压. 从tunnel收到的数据经Stage回复给tunnel时同样压缩(见take_responses)
+        """
+        proxy = self.proxy
+        compress = self.compress_stage = CompressStage(proxy.compress, proxy.compression_stats)
+        decompress = DecompressStage(proxy.compression_stats)
+        if proxy.tunnel_side == "up":
+            down_stages = self.down_pipeline.stages if self.down_pipeline else ()
+            up_stages = self.up_pipeline.stages if self.up_pipeline else ()
+            self.down_pipeline = Pipeline(*(down_stages + (compress,)))
+            self.up_pipeline = Pipeline(*((decompress,) + up_stages))
+        else:
+            self.down_pipeline = Pipeline(decompress)
+            self.up_pipeline = Pipeline(compress)
+        self.compressed = True
+
+    def take_responses(self, pipeline, side):
+        """
+        @param side: pipeline处理的数据来自哪一端, Stage的回复发回这一端
+        @return: 回复的数据块list, 发回压缩的tunnel时经过compress_stage, 与其它发往tunnel的数据在同一个zlib流中
+        """
+        responses = pipeline.take_responses()
+        if responses and self.compressed and side == self.proxy.tunnel_side:
+            return self.compress_stage.feed("".join(responses))
+        return responses
+
+    def on_paired(self):
+        """配对完成(up与down都已就绪)后调用
+        """
+        stats = self.proxy.stats
+        stats.forwards.inc()
+        stats.forwards_active.inc()
+        self.active = True
+        self.last_active = self.proxy.timers.now
+        if self.proxy.idle_timeout:
+            self.timer = self.proxy.timers.call_later(self.proxy.idle_timeout, self.check_idle)
+
+    def check_idle(self):
+        """空闲超时定时器到期. 期间有过收发时, 按最后活动时间重新设置
+        """
+        timers, timeout = self.proxy.timers, self.proxy.idle_timeout
+        if timers.now - self.last_active >= timeout:
+            logging.info("Close idle forward.")
+            self.close()
+        else:
+            self.timer = timers.call_at(self.last_active + timeout, self.check_idle)
 
-    def close(self):
+    def close(self, sock=None):
         up, down = self.up, self.down
         if up and down:
             fmt = "Close forward. [Up rsize/szize: %d/%d], [Down rsize/ssize: %d/%d]"
             logging.debug(fmt, up.rsize, up.ssize, down.rsize, down.ssize)
         else:
             logging.debug("Close private connection.")
+        if self.active:
+            self.active = False
+            self.proxy.stats.forwards_active.dec()
         for conn in (up, down):
             if conn:
+                self.proxy.timers.cancel(self.proxy._connecting.pop(conn, None))
                 self.proxy._forwards.pop(conn.sock, None)
                 self.proxy.r_list.discard(conn.sock)
                 self.proxy.w_list.discard(conn.sock)
                 conn.sock.close()
-        if self in self.proxy.forward_pool:
-            self.proxy.forward_pool.remove(self)
+                conn.rbuf.close()
+        self.proxy.remove_from_pool(self)
 
     def on_recv(self, sock):
         if self.up and sock is self.up.sock:
-            conn, other, name = self.up, self.down, "Up"
+            conn, other, name = self.up, self.down, "up"
         elif self.down and sock is self.down.sock:
-            conn, other, name = self.down, self.up, "Down"
+            conn, other, name = self.down, self.up, "down"
         else:           # never happen
             assert 0, "wimp out?"
-        rsize = conn.recv()
-        if rsize == -1:
+        self.last_active = self.proxy.timers.now
+        stats = self.proxy.stats
+        pipeline = None
+        if other and (self.compressed or isinstance(self.proxy, RRDServer)):
+            pipeline = self.up_pipeline if conn is self.up else self.down_pipeline
+        quantum = self.proxy.scheduler.quantum
+        rsize = conn.recv_through(pipeline, quantum) if pipeline else conn.recv(quantum)
+        if rsize > 0:
+            stats.bytes.inc(rsize, name)
+        if rsize == -1 and not (conn.rbuf and other):
             self.close()
         else:
             logging.debug("Recv from %s: %d", name, rsize)
-            if isinstance(self.proxy, RRDServer) and conn and other:
-                process = self.process_up_recv \
-                                if conn is self.up else self.process_down_recv
-                rdata, sdata = process(conn.rbuf)
+            if conn is self.up:
+                intercept, process = self.intercept_up, self.process_up_recv
+            else:
+                intercept, process = self.intercept_down, self.process_down_recv
+            if pipeline:
+                for response in self.take_responses(pipeline, name):
+                    other.rbuf.write(response)
+                if other.rbuf:
+                    self.proxy.w_list.add(conn.sock)
+            elif intercept and isinstance(self.proxy, RRDServer) and other:
+                rdata, sdata = process(conn.rbuf.getvalue())
                 if rdata is not None:
-                    conn.rbuf = rdata
+                    conn.rbuf.set(rdata)
                 if sdata is not None:
-                    other.rbuf += sdata
+                    other.rbuf.write(sdata)
                     if other.rbuf:
                         self.proxy.w_list.add(conn.sock)
+            if rsize == -1:
+                if not conn.rbuf:
+                    self.close()
+                    return
+                self.closing = conn     # 连接断开之前收到的数据转发完再关闭
+                self.proxy.r_list.discard(sock)
             if conn.rbuf and other:
                 self.proxy.w_list.add(other.sock)
             if conn.rbuf_full:
+                stats.backpressure.inc(1, name)
                 self.proxy.r_list.discard(sock)
+            elif conn.over_budget and self.closing is not conn:
+                self.proxy.wait_budget(conn, name)
+            elif self.proxy.scheduler.exhausted(rsize):
+                self.proxy.scheduler.defer(sock)
 
     def on_send(self, sock):
         if self.up and sock is self.up.sock:
-            conn, other, name = self.up, self.down, "Up"
+            conn, other, name = self.up, self.down, "up"
         elif self.down and sock is self.down.sock:
-            conn, other, name = self.down, self.up, "Down"
+            conn, other, name = self.down, self.up, "down"
         else:   # never happen
             assert 0, "wimp out?"
+        self.last_active = self.proxy.timers.now
+        if conn.connecting and not self.finish_connect(conn):
+            return
+        if not other:
+            self.proxy.w_list.discard(sock)
+            return
         ssize = conn.send(other.rbuf)
-        if ssize == -1:
+        if ssize == -1 or (self.closing is other and not other.rbuf):
             self.close()
         else:
             logging.debug("Send to %s: %d", name, ssize)
-            other.rbuf = other.rbuf[ssize:]
             if not other.rbuf:
                 self.proxy.w_list.discard(conn.sock)
-            if not other.rbuf_full:
+            if not other.rbuf_full and self.closing is not other:
                 self.proxy.r_list.add(other.sock)
 
+    def use_pipe(self):
+        """未重载拦截方法时, 两个方向都改用splice转发, 数据不再经过用户空间
+        """
+        if self.proxy.splice and not self.intercepted and not self.compressed:
+            for conn in (self.up, self.down):
+                conn.use_pipe()
+
+    def finish_connect(self, conn):
+        self.proxy.timers.cancel(self.proxy._connecting.pop(conn, None))
+        if not conn.finish_connect():
+            self.proxy.on_connect_failed(conn.addr, "connect failed")
+            self.close()
+            return False
+        target = "tunnel" if conn is self.down else "upstream"
+        self.proxy.stats.connect_seconds.observe(time.time() - conn.create, target)
+        self.proxy.r_list.add(conn.sock)
+        self.proxy.on_connected(self, conn)
+        return True
 
     # ----- 对转发进行拦截(只对RRDServer有效) -----
 
+    def create_down_pipeline(self):
+        """
+        @return: 流式处理从Client接收到的数据的Filters.Pipeline, 使用时不再调用process_down_recv. None表示不使用
+        """
+        return None
+
+    def create_up_pipeline(self):
+        """
+        @return: 流式处理从Remote接收到的数据的Filters.Pipeline, 使用时不再调用process_up_recv. None表示不使用
+        """
+        return None
+
     def process_down_recv(self, data):
         """处理从Client接收到的数据
         @param data: 从Client接收到的数据
@@ -195,22 +515,140 @@ class Forward(object):
         return (None, None)
 
 
+def _overrides(forward, name):
+    """forward是否重载了Forward的拦截方法name
+    """
+    return getattr(type(forward), name).im_func is not getattr(Forward, name).im_func
+
+
 class RemoteRedirection(object):
-    def __init__(self, max_buf_size):
-        self.forward_pool = []
+    # Multiplex中stream的本地连接与tunnel分别相当于Forward的哪一端, 用于统计
+    stream_side = None
+    tunnel_side = None
+
+    def __init__(self, max_buf_size, poller=None, splice=True, idle_timeout=0, metrics_addr=None,
+                 buffer_budget=0, min_buf_size=1024*4, slow_callback=0, down_socket=None, up_socket=None,
+                 compress=0, io_quantum=QUANTUM, max_accepts=MAX_ACCEPTS):
+        """
+        @param poller: "epoll", "poll", "select", None表示自动选择, 或者Redirector提供的PollerView
+        @param splice: 对未重载拦截方法的Forward使用splice转发(平台支持时)
+        @param idle_timeout: 配对后两个方向都没有数据超过这么久(秒)时关闭转发, 0表示不限制
+        @param metrics_addr: (host, port), 在此地址上提供Prometheus格式的统计(GET /metrics), None表示不提供
+        @param buffer_budget: 进程内所有连接缓冲的总字节数上限(见Buffer.BufferBudget), 0表示不限制
+        @param slow_callback: 大于0时开启事件循环的性能分析(见Profiler), 回调超过这么久(秒)时记录警告
+        @param io_quantum: 每个socket每轮循环最多接收的字节数, 用完后下一轮继续(见Scheduler), 0表示不限制
+        @param max_accepts: 每轮循环最多accept的连接数, 0表示不限制
+        @param down_socket, up_socket: client一侧与remote/tunnel一侧socket的选项(SocketProfile), None表示不设置
+        @param compress: private连接压缩传输的zlib级别(1-9, True等同于1), 0表示不压缩. 两端都开启时才压缩
+        @param max_buf_size, min_buf_size: 每个连接接收缓冲大小的范围, 两者相等时大小固定
+                缓冲从min_buf_size开始, 对端跟得上且缓冲被填满时加倍, 持续用不到1/4时减半
+        """
+        self.forward_pool = {}  # sock -> 尚未配对的forward
         self._forwards = {}
-        self.w_list = set()
-        self.r_list = set()
-        # self.e_list = set()
+        self.mux_tunnels = []   # 多路复用tunnel
+        self.stopped = False    # 已经调用了stop(Redirector删除了映射)
+        self._connecting = {}   # connection -> connect超时定时器
+        self.idle_timeout = idle_timeout
+        self.poller = create_poller(poller)
+        self.w_list = self.poller.w_list
+        self.r_list = self.poller.r_list
         self.max_buf_size = max_buf_size
+        self.min_buf_size = min(min_buf_size, max_buf_size)
+        self.splice = splice
+        self.down_profile = down_socket or SocketProfile()
+        self.up_profile = up_socket or SocketProfile()
+        self.compress = int(compress)
+        self.stats = Stats()
+        if isinstance(self.poller, PollerView):
+            self.timers, self.scheduler = self.poller.timers, self.poller.scheduler
+        else:
+            self.timers = TimerQueue()
+            self.scheduler = IOScheduler(self.poller.r_list, io_quantum, max_accepts)
+            self.stats.counter("io_deferrals_total",
+                    "Reads or accepts postponed to the next loop iteration by the quota.",
+                    func=lambda: self.scheduler.deferred)
+        self.server = None      # RRDServer的监听socket
+        self.accept_paused = False
+        self._budget_waiting = OrderedDict()    # 等待缓冲预算的connection
+        if buffer_budget:
+            budget.set_limit(buffer_budget)
+        self.compression_stats = CompressionStats(self.stats) if compress else None
+        if metrics_addr:
+            MetricsServer(self, metrics_addr)
+        if slow_callback:
+            LoopProfiler(self, slow_callback).install()
 
     def get_forward_from_pool(self, sock):
-        for fw in self.forward_pool:
-            if (fw.up and fw.up.sock is sock) \
-                                or (fw.down and fw.down.sock is sock):
-                return fw
+        return self.forward_pool.get(sock)
+
+    def wait_budget(self, conn, side):
+        """缓冲预算不允许conn再接收, 暂停读取, 预算回落后由check_budget恢复
+        """
+        self.stats.budget_pauses.inc(1, side)
+        self.r_list.discard(conn.sock)
+        self._budget_waiting[conn] = None
+
+    def check_budget(self):
+        """每轮循环结束时调用: 预算用完时暂停accept; 回落到low_water以下时恢复accept和等待预算的连接
+        """
+        if budget.exhausted:
+            if self.server and not self.accept_paused:
+                logging.info("Buffer budget is exhausted (%d bytes), pause accepting.", budget.used)
+                self.accept_paused = True
+                self.stats.accept_pauses.inc()
+                self.r_list.discard(self.server)
+        elif not budget.tight:
+            if self.accept_paused:
+                logging.info("Buffer budget is available, resume accepting.")
+                self.accept_paused = False
+                self.r_list.add(self.server)
+            if self._budget_waiting:
+                waiting, self._budget_waiting = self._budget_waiting, OrderedDict()
+                for conn in waiting:    # 按暂停的先后
+                    if not conn.rbuf.closed:
+                        self.r_list.add(conn.sock)
+
+    def add_to_pool(self, fw):
+        for conn in (fw.up, fw.down):
+            if conn:
+                self.forward_pool[conn.sock] = fw
+        fw.timer = self.timers.call_later(POOL_LIVE_TIME, self.expire_forward, fw)
+
+    def remove_from_pool(self, fw):
+        for conn in (fw.up, fw.down):
+            if conn:
+                self.forward_pool.pop(conn.sock, None)
+        self.timers.cancel(fw.timer)
+        fw.timer = None
+
+    def expire_forward(self, fw):
+        """forward在池中的寿命到期, 有数据等待配对时延长
+        """
+        conn = fw.down if fw.down else fw.up
+        if conn.rbuf:
+            fw.timer = self.timers.call_later(POOL_LIVE_TIME, self.expire_forward, fw)
+        else:
+            fw.close()
+
+    def on_connected(self, fw, conn):
+        """fw中的conn完成了非阻塞connect
+        """
+        pass
+
+    def on_connect_failed(self, addr, e):
+        logging.warning("Connect to [%s:%s] fail: %s", addr[0], addr[1], e)
+
+    def on_stream_open(self, tunnel, stream_id):
+        """对端通过多路复用tunnel新建了stream
+        """
+        tunnel.send_frame(FRAME_CLOSE, stream_id)
+
+    def on_tunnel_closed(self, tunnel):
+        pass
 
     def _call(self, sock, method):
+        if sock not in self.r_list and sock not in self.w_list:
+            return  # 在本轮循环中已经被关闭
         fw = self._forwards.get(sock)
         if not fw:
             fw = self.get_forward_from_pool(sock)
@@ -222,211 +660,707 @@ class RemoteRedirection(object):
             self.w_list.discard(sock)
             sock.close()
 
+    # on_readable, on_writable, on_error, on_loop_end: 事件循环的入口, 由main_loop或Redirector调用
+    def on_readable(self, sock):
+        self._call(sock, "on_recv")
+
+    def on_writable(self, sock):
+        self._call(sock, "on_send")
+
+    def on_error(self, sock):
+        self._call(sock, "close")
+
+    def on_loop_end(self):
+        """每轮循环处理完所有事件后调用
+        """
+        if self.stopped:
+            self.close_idle_tunnels()
+        self.check_budget()
+
+    def stop(self):
+        """停止接受或建立新的连接(Redirector删除映射时), 已有的forward继续转发直到关闭
+        """
+        self.stopped = True
+        self.close_idle_tunnels()
+
+    def close_idle_tunnels(self):
+        """stop之后不再有新的stream: 关闭没有stream的多路复用tunnel, 最后一个stream关闭后tunnel随之关闭
+        """
+        for tunnel in [tunnel for tunnel in self.mux_tunnels if not tunnel.streams]:
+            tunnel.close()
+
+    @property
+    def active(self):
+        """还有正在转发或等待配对的连接(stop之后用于判断是否可以丢弃). 多路复用tunnel本身不计入, 其中的stream计入
+        """
+        return bool(self.forward_pool) or any(not isinstance(handler, MuxTunnel)
+                                              for handler in self._forwards.itervalues())
+
+    def main_loop(self):
+        while True:
+            r_list, w_list, e_list = self.poller.poll(self.scheduler.timeout(self.timers.timeout()))
+            self.timers.run()
+            for sock in e_list:
+                self.on_error(sock)
+            for sock in self.scheduler.readable(r_list):
+                self.on_readable(sock)
+            for sock in w_list:
+                self.on_writable(sock)
+            self.on_loop_end()
+
 
 class RRDServer(RemoteRedirection):
-    def __init__(self, bind_addr, max_buf_size=1024*64, forward=None):
-        RemoteRedirection.__init__(self, max_buf_size)
-        self.conn_pool = []
+    stream_side = "down"
+    tunnel_side = "up"
+
+    def __init__(self, bind_addr, max_buf_size=1024*1024, forward=None, poller=None, splice=True,
+                 reuse_port=False, handoff=None, idle_timeout=0, metrics_addr=None, buffer_budget=0,
+                 min_buf_size=1024*4, slow_callback=0, down_socket=None, up_socket=None, compress=0,
+                 tunnel_addr=None, classify_timeout=CLASSIFY_TIMEOUT, io_quantum=QUANTUM, max_accepts=MAX_ACCEPTS):
+        """
+        @param reuse_port: 设置SO_REUSEPORT, 多个进程绑定同一地址(见Workers.WorkerPool)
+        @param handoff: Workers.Handoff, 多进程时把没有private连接可用的open连接交给下一个worker
+        @param tunnel_addr: (host, port), RRDClient连接的单独端口, 此时bind_addr上只有open连接. None表示共用bind_addr
+        @param classify_timeout: 共用端口时, accept后这么久(秒)没有收到数据的连接按open连接处理
+        """
+        RemoteRedirection.__init__(self, max_buf_size, poller, splice, idle_timeout, metrics_addr, buffer_budget,
+                                   min_buf_size, slow_callback, down_socket, up_socket, compress, io_quantum,
+                                   max_accepts)
+        self.conn_pool = {}     # sock -> 尚未确定类型的connection
+        # forward_pool中的forward按类型分别排队, 先到先配对
+        self.idle_tunnels = OrderedDict()       # 只有up(private连接)的forward
+        self.waiting_clients = OrderedDict()    # 只有down(open连接)的forward
+        # self.mux_tunnels: 有可用的tunnel时open连接不再排队
+        self.server = self.listen(bind_addr, reuse_port, self.down_profile)
+        self.bind_addr = bind_addr
+        self.tunnel_server = None
+        if tunnel_addr:
+            self.tunnel_server = self.listen(tunnel_addr, reuse_port, self.up_profile)
+        self.tunnel_addr = tunnel_addr
+        self.classify_timeout = classify_timeout
+        self.Forward = forward if forward else Forward
+        self.handoff = handoff
+        if handoff:
+            self.r_list.add(handoff.inbox)
+
+        stats = self.stats
+        stats.gauge("rrd_idle_tunnels", "Private connections waiting for a client.",
+                func=lambda: len(self.idle_tunnels))
+        stats.gauge("rrd_waiting_clients", "Open connections queued for a private connection.",
+                func=lambda: len(self.waiting_clients))
+        stats.gauge("rrd_mux_tunnels", "Multiplexed tunnels.", func=lambda: len(self.mux_tunnels))
+        stats.gauge("rrd_unclassified", "Accepted connections whose type is not known yet.",
+                func=lambda: len(self.conn_pool))
+        self.queue_wait = stats.histogram("rrd_queue_wait_seconds",
+                "Time from accepting an open connection to pairing it with a tunnel.")
+
+    def listen(self, addr, reuse_port, profile):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setblocking(0)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR  , 1)
-        sock.bind(bind_addr)
-        sock.listen(200)
-        self.server = sock
-        self.r_list.add(self.server)
-        self.bind_addr = bind_addr
-        self.Forward = forward if forward else Forward
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(addr)
+        profile.listen(sock)
+        self.r_list.add(sock)
+        return sock
 
     def get_conn_from_pool(self, sock):
-        for conn in self.conn_pool:
-            if conn.sock is sock:
-                return conn
+        return self.conn_pool.get(sock)
+
+    def remove_conn_from_pool(self, conn):
+        self.timers.cancel(conn.timer)
+        del self.conn_pool[conn.sock]
+        self.r_list.discard(conn.sock)
+        self.w_list.discard(conn.sock)
+        conn.sock.close()
+        conn.rbuf.close()
+
+    def add_to_pool(self, fw):
+        RemoteRedirection.add_to_pool(self, fw)
+        if fw.up:
+            self.idle_tunnels[fw] = None
+        else:
+            self.waiting_clients[fw] = None
 
-    def clear_timeout_conns(self):
-        poll_live_time = 60
+    def remove_from_pool(self, fw):
+        RemoteRedirection.remove_from_pool(self, fw)
+        self.idle_tunnels.pop(fw, None)
+        self.waiting_clients.pop(fw, None)
+
+    def add_open_forward(self, fw):
+        """open连接等待配对. 多进程时, 本worker没有空闲的private连接就交给下一个worker
+        """
+        if self.mux_tunnels:
+            tunnel = min(self.mux_tunnels, key=lambda t: len(t.streams))
+            self.queue_wait.observe(time.time() - fw.down.create)
+            tunnel.open_stream(fw.down)
+            logging.debug("Open stream on [mux-tunnel], streams: %d", len(tunnel.streams))
+            return
+        if self.handoff and not self.idle_tunnels and fw.hops < self.handoff.max_hops:
+            sock = fw.down.sock
+            if self.handoff.send(sock, fw.down.rbuf.getvalue(), fw.hops + 1):
+                self.r_list.discard(sock)
+                self.w_list.discard(sock)
+                sock.close()
+                return
+        self.add_to_pool(fw)
+
+    def pair_forwards(self):
+        """按先后顺序, 把空闲的private连接与等待中的open连接配对
+        """
         now = time.time()
-        for conn in list(self.conn_pool):
-            if (not conn.rbuf and now - conn.create > poll_live_time) \
-                    or now - conn.create > poll_live_time * 5:
-                logging.info("Close connection in conn_pool: %s:%s" % conn.addr)
-                self.r_list.discard(conn.sock)
-                self.conn_pool.remove(conn)
-                conn.sock.close()
+        while self.idle_tunnels and self.waiting_clients:
+            fw, _ = self.idle_tunnels.popitem(last=False)
+            down, _ = self.waiting_clients.popitem(last=False)
+            RemoteRedirection.remove_from_pool(self, fw)
+            RemoteRedirection.remove_from_pool(self, down)
+            assert fw.down is None
+            assert down.up is None
+            fw.down = down.down
+            down.down = None
+            self.queue_wait.observe(now - fw.down.create)
+            compressed = False
+            if fw.up.flags & FLAG_ZLIB and self.compress:
+                if fw.intercept_down or fw.intercept_up:
+                    logging.info("Decline compression: %s overrides process_*_recv.", self.Forward.__name__)
+                else:
+                    fw.enable_compression()
+                    compressed = True
+            # 拦截数据
+            if fw.down.rbuf and fw.down_pipeline:
+                data = fw.down.rbuf.getvalue()
+                fw.down.rbuf.clear()
+                for chunk in fw.down_pipeline.feed(data):
+                    fw.down.rbuf.write(chunk)
+                for response in fw.take_responses(fw.down_pipeline, "down"):
+                    fw.up.rbuf.write(response)
+            elif fw.down.rbuf and fw.intercept_down:
+                rdata, sdata = fw.process_down_recv(fw.down.rbuf.getvalue())
+                if rdata is not None:
+                    fw.down.rbuf.set(rdata)
+                if sdata is not None:
+                    fw.up.rbuf.write(sdata)
+            heads = ""
+            if fw.up.flags & FLAG_ADAPTIVE:
+                grow = 0
+                if self.waiting_clients or now - fw.down.create > GROW_HINT_WAIT:
+                    grow = len(self.waiting_clients) + 1
+                heads += control_head("G", grow)
+            if fw.up.flags & FLAG_ZLIB:
+                heads += control_head("Z", int(compressed))
+            if fw.up.flags & FLAG_PAIRED:
+                heads += control_head("P", 0)
+            if heads:
+                fw.down.rbuf.set(heads + fw.down.rbuf.getvalue())
+            fw.use_pipe()
+            fw.on_paired()
+            self._forwards[fw.up.sock] = fw
+            self._forwards[fw.down.sock] = fw
+            if fw.up.rbuf:
+                self.w_list.add(fw.down.sock)
+            if fw.down.rbuf:
+                self.w_list.add(fw.up.sock)
+
+    def add_mux_tunnel(self, conn):
+        """private连接要求多路复用. 拦截数据的Forward无法用于stream, 此时拒绝
+        """
+        fw = self.Forward(self, up=conn)
+        if fw.intercepted:
+            logging.warning("Reject [mux-tunnel]: %s intercepts data.", self.Forward.__name__)
+            sock = conn.sock
+            self.timers.cancel(self._connecting.pop(conn, None))
+            self._forwards.pop(sock, None)
+            self.r_list.discard(sock)
+            self.w_list.discard(sock)
+            sock.close()
+            conn.rbuf.close()
+            return
+        tunnel = MuxTunnel(self, conn)
+        self.mux_tunnels.append(tunnel)
+        logging.info("Accept [mux-tunnel]")
+        # 之前排队的open连接全部转到tunnel上
+        while self.waiting_clients:
+            fw, _ = self.waiting_clients.popitem(last=False)
+            RemoteRedirection.remove_from_pool(self, fw)
+            self.add_open_forward(fw)
+        tunnel.process_frames()
+
+    def on_tunnel_closed(self, tunnel):
+        self.mux_tunnels.remove(tunnel)
+
+    def accept_handoffs(self):
+        """接收其他worker传递过来的open连接
+        """
+        while True:
+            item = self.handoff.recv()
+            if item is None:
+                break
+            sock, data, hops = item
+            try:
+                addr = sock.getpeername()
+            except socket.error:
+                sock.close()
+                continue
+            conn = Connection(sock, addr, self.max_buf_size, self.min_buf_size)
+            self.down_profile.apply(conn)
+            conn.rbuf.write(data)
+            fw = self.Forward(self, down=conn)
+            fw.hops = hops
+            logging.debug("Accept [open-connection] from other worker, hops: %d", hops)
+            if not conn.rbuf_full:
+                self.r_list.add(sock)
+            self.add_open_forward(fw)
+
+    def accept(self, lsock):
+        scheduler = self.scheduler
+        accepted = 0
+        while True:
+            if accepted and accepted == scheduler.max_accepts:
+                scheduler.defer(lsock)  # 其余的连接下一轮再accept
+                break
+            try:
+                client, client_addr = lsock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                raise
+            accepted += 1
+            client.setblocking(0)
+            conn = Connection(client, client_addr, self.max_buf_size, self.min_buf_size)
+            self.stats.accepts.inc()
+            logging.debug("Accept [%s:%s]" % client_addr)
+            self.r_list.add(client)
+            if lsock is self.tunnel_server:
+                conn.tunnel_port = True
+                self.up_profile.apply(conn)
+                self.conn_pool[client] = conn
+                conn.timer = self.timers.call_later(POOL_LIVE_TIME, self.expire_conn, conn)
+                continue
+            self.down_profile.apply(conn)
+            if self.tunnel_server:
+                self.accept_open(conn)  # 公开端口上只有open连接, 不必等待数据
+                continue
+            # we don't know it's a private-connection or open-connection, put it to conn_pool first.
+            self.conn_pool[client] = conn
+            conn.timer = self.timers.call_later(self.classify_timeout, self.classify_expired, conn)
+
+    def accept_open(self, conn):
+        self.conn_pool.pop(conn.sock, None)
+        self.timers.cancel(conn.timer)
+        conn.timer = None
+        if conn.rsize:
+            self.stats.bytes.inc(conn.rsize, "down")
+        fw = self.Forward(self, down=conn)
+        logging.info("Accept [open-connection]")
+        self.add_open_forward(fw)
+
+    def accept_private(self, conn):
+        flags = head_flags(conn.rbuf.head(PRIVATE_HEAD_SIZE))
+        conn.rbuf.consume(PRIVATE_HEAD_SIZE)  # strip head
+        conn.rsize -= PRIVATE_HEAD_SIZE
+        self.timers.cancel(conn.timer)
+        conn.timer = None
+        del self.conn_pool[conn.sock]
+        self.stats.bytes.inc(conn.rsize, "up")
+        conn.flags = flags
+        if not conn.tunnel_port:
+            self.up_profile.apply(conn)
+        if flags & FLAG_MUX:
+            self.add_mux_tunnel(conn)
+            return
+        fw = self.Forward(self, up=conn)
+        self.add_to_pool(fw)
+        logging.info("Accept [private-connection]")
+
+    def classify_expired(self, conn):
+        """共用端口时, accept后classify_timeout内类型还不能确定: 没有数据的(服务端先发送数据的协议)按open连接处理,
+        已有部分标识头的继续等待
+        """
+        if conn.rbuf:
+            self.expire_conn(conn)
+        else:
+            self.accept_open(conn)
+
+    def expire_conn(self, conn):
+        """conn_pool中的连接: 没有数据时最多保留POOL_LIVE_TIME, 有数据(但还不能确定类型)时最多5倍
+        """
+        deadline = conn.create + POOL_LIVE_TIME * 5
+        if conn.rbuf and self.timers.now < deadline:
+            conn.timer = self.timers.call_at(deadline, self.expire_conn, conn)
+            return
+        logging.info("Close connection in conn_pool: %s:%s" % conn.addr)
+        self.remove_conn_from_pool(conn)
+
+    def classify(self, conn):
+        """conn_pool中的连接收到数据, 按标识头确定类型
+        """
+        rsize = conn.recv()
+        if rsize == -1:
+            self.remove_conn_from_pool(conn)
+            return
+        if conn.rbuf_full:
+            self.r_list.discard(conn.sock)
+        elif conn.over_budget:
+            self.wait_budget(conn, "down")
+        tp = conn.type
+        if tp == conn.TP_PRIVATE:
+            self.accept_private(conn)
+        elif tp == conn.TP_OPEN and conn.tunnel_port:
+            logging.warning("Invalid private head from [%s:%s]." % conn.addr)
+            self.remove_conn_from_pool(conn)
+        elif tp == conn.TP_OPEN:
+            self.accept_open(conn)
+        else:
+            pass    # we still don't know what's type of the connection, left it away.
+
+    def on_readable(self, sock):
+        if self.handoff and sock is self.handoff.inbox:
+            self.accept_handoffs()
+        elif sock is self.server or sock is self.tunnel_server:
+            self.accept(sock)
+        else:
+            conn = self.get_conn_from_pool(sock)
+            if conn:
+                self.classify(conn)
+            else:
+                self._call(sock, "on_recv")
+
+    def on_error(self, sock):
+        conn = self.get_conn_from_pool(sock)
+        if conn:
+            self.remove_conn_from_pool(conn)
+        else:
+            self._call(sock, "close")
+
+    def on_loop_end(self):
+        if self.idle_tunnels and self.waiting_clients:
+            self.pair_forwards()
+        RemoteRedirection.on_loop_end(self)
+
+    def stop(self):
+        """关闭监听socket. 已经accept的连接与等待配对的open连接不受影响,
+        不再有open连接时关闭池中的private连接与空闲的多路复用tunnel
+        """
+        for sock in (self.server, self.tunnel_server):
+            if sock:
+                self.r_list.discard(sock)
+                sock.close()
+        self.server = self.tunnel_server = None
+        self.accept_paused = False
+        RemoteRedirection.stop(self)
 
-        for fw in list(self.forward_pool):
-            conn = fw.down if fw.down else fw.up
-            if not conn.rbuf and now - conn.create > poll_live_time:
+    def close_idle_tunnels(self):
+        RemoteRedirection.close_idle_tunnels(self)
+        if not self.waiting_clients:
+            for fw in list(self.idle_tunnels):
                 fw.close()
 
+    @property
+    def active(self):
+        return bool(self.waiting_clients or self.conn_pool) or any(not isinstance(handler, MuxTunnel)
+                                                                   for handler in self._forwards.itervalues())
+
     def main_loop(self):
-        timeout = 0.1
         logging.info("RRDServer is running at %s:%s" % self.bind_addr)
-        while True:
-            self.clear_timeout_conns()
-
-            r_list, w_list, e_list = select.select(
-                                self.r_list, self.w_list, self.r_list, timeout)
-            for sock in e_list:
-                conn = self.get_conn_from_pool(sock)
-                if conn:
-                    self.conn_pool.remove(conn)
-                    self.w_list.discard(sock)
-                    self.r_list.discard(sock)
-                    sock.close()
-                else:
-                    self._call(sock, "close")
-            for sock in r_list:
-                if sock is self.server:
-                    while True:
-                        try:
-                            client, client_addr = sock.accept()
-                            client.setblocking(0)
-                            conn = Connection(client, client_addr, self.max_buf_size)
-                            # we don't know it's a private-connection or open-connection, put it to conn_pool first.
-                            self.conn_pool.append(conn) 
-                            logging.debug("Accept [%s:%s]" % client_addr)
-                            self.r_list.add(client)
-                        except socket.error, e:
-                            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
-                                break
-                            raise
-                else:
-                    conn = self.get_conn_from_pool(sock)
-                    if conn:
-                        rsize = conn.recv()
-                        if rsize == -1:
-                            self.r_list.discard(sock)
-                            sock.close()
-                            self.conn_pool.remove(conn)
-                        else:
-                            tp = conn.type
-                            if tp == conn.TP_PRIVATE:
-                                header_size = 10
-                                conn.rbuf = conn.rbuf[header_size:]  # strip head
-                                conn.rsize -= header_size
-                                fw = self.Forward(self, up=conn)
-                                self.conn_pool.remove(conn)
-                                self.forward_pool.append(fw)
-                                logging.info("Accept [private-connection]")
-                            elif tp == conn.TP_OPEN:
-                                fw = self.Forward(self, down=conn)
-                                self.conn_pool.remove(conn)
-                                self.forward_pool.append(fw)
-                                logging.info("Accept [open-connection]")
-                            else:
-                                pass    # we still don't know what's type of the connection, left it away.
-                    else:
-                        self._call(sock, "on_recv")
-            for sock in w_list:
-                self._call(sock, "on_send")
-
-            if self.forward_pool:
-                # group forward socket-pair
-                ups = [fw for fw in self.forward_pool if fw.up]
-                downs = [fw for fw in self.forward_pool if fw.down]
-                for up, down in zip(ups, downs):
-                    assert up.down is None
-                    assert down.up is None
-                    fw = up
-                    fw.down = down.down
-                    # 拦截数据
-                    if fw.down.rbuf:
-                        rdata, sdata = fw.process_down_recv(fw.down.rbuf)
-                        if rdata is not None:
-                            fw.down.rbuf = rdata
-                        if sdata is not None:
-                            fw.up.rbuf += sdata
-                    down.down = None
-                    self.forward_pool.remove(up)
-                    self.forward_pool.remove(down)
-                    self._forwards[fw.up.sock] = fw
-                    self._forwards[fw.down.sock] = fw
-                    if fw.up.rbuf:
-                        self.w_list.add(fw.down.sock)
-                    if fw.down.rbuf:
-                        self.w_list.add(fw.up.sock)
+        RemoteRedirection.main_loop(self)
 
 
 class RRDClient(RemoteRedirection):
-    def __init__(self, rrd_server_addr, server_addr, max_buf_size=1024*64, forward=None):
-        RemoteRedirection.__init__(self, max_buf_size)
+    stream_side = "up"
+    tunnel_side = "down"
+
+    def __init__(self, rrd_server_addr, server_addr, max_buf_size=1024*1024, forward=None, poller=None,
+                 connect_timeout=10, splice=True, mux_tunnels=0, pool_min=2, pool_max=0, pool_decay=10,
+                 idle_timeout=0, metrics_addr=None, buffer_budget=0, min_buf_size=1024*4,
+                 slow_callback=0, down_socket=None, up_socket=None, compress=0, io_quantum=QUANTUM, paired=False):
+        """
+        paired, pool_max, compress, mux_tunnels使用扩展标识头, 需要RRDServer也是支持它们的版本
+        @param connect_timeout: 连接RRDServer/Server的超时时间(秒)
+        @param paired: 请求FLAG_PAIRED控制头, 配对后立即连接Server(由服务端先发送数据的协议也可以转发).
+                False时Client先发送数据后才连接Server
+        @param mux_tunnels: 多路复用tunnel的数量, 0表示每个open连接占用一个private连接
+        @param pool_min, pool_max: 空闲private连接池大小的范围, pool_max不大于pool_min时连接池大小固定
+                池中的连接用完或RRDServer建议扩大时, 池大小加倍;
+                pool_decay秒内没有扩大时, 缩小1/4, 但不小于最近每秒新建的open连接数
+        """
+        RemoteRedirection.__init__(self, max_buf_size, poller, splice, idle_timeout, metrics_addr, buffer_budget,
+                                   min_buf_size, slow_callback, down_socket, up_socket, compress, io_quantum)
         self.rrd_server_addr = rrd_server_addr
         self.server_addr = server_addr
         self.Forward = forward if forward else Forward
+        self.connect_timeout = connect_timeout
+        self.resolver = Resolver()
+        self.resolver.prewarm([rrd_server_addr, server_addr])
+        self.mux_size = mux_tunnels
+        self.pool_min = pool_min
+        self.pool_max = max(pool_min, pool_max)
+        self.pool_decay = pool_decay
+        self.pool_size = pool_min
+        self.paired = paired
+        self.arrivals = 0           # 本周期内被使用的private连接数
+        self.arrival_rate = 0.0     # 每秒被使用的private连接数
+        self.last_grow = self.last_adjust = time.time()
+        self._fill_timer = None
 
         self.err_flag = False    # a flag, same error will only be loged once.
 
-    def create_conn(self, addr):
+        stats = self.stats
+        stats.gauge("rrd_pool_size", "Target size of the private connection pool.", func=lambda: self.pool_size)
+        stats.gauge("rrd_pool_idle", "Private connections waiting in the pool.", func=lambda: len(self.forward_pool))
+        stats.gauge("rrd_mux_tunnels", "Multiplexed tunnels.", func=lambda: len(self.mux_tunnels))
+        stats.gauge("rrd_arrival_rate", "Private connections used per second (smoothed).",
+                func=lambda: self.arrival_rate)
+        self.schedule_fill()
+        if self.pool_max > self.pool_min and not self.mux_size:
+            self.timers.call_later(self.pool_decay, self.on_pool_decay)
+
+    def create_conn(self, addr, profile):
+        """非阻塞地连接addr, 连接建立后(可写)由Forward.finish_connect处理
+        @param profile: 连接的SocketProfile
+        """
         sock = None
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(addr)
             sock.setblocking(0)
-            self.r_list.add(sock)
-            # logging.debug("Create a conn to [%s:%s]" % addr)
-            self.err_flag = False
-            return Connection(sock, sock.getsockname(), self.max_buf_size)
+            conn = Connection(sock, addr, self.max_buf_size, self.min_buf_size)
+            profile.apply(conn)
+            if not conn.connect(self.resolver.resolve(addr)):
+                raise socket.error("connect failed")
+            if conn.connecting:
+                self._connecting[conn] = self.timers.call_later(self.connect_timeout, self.on_connect_timeout, conn)
+                self.w_list.add(sock)
+            else:
+                self.r_list.add(sock)
+            return conn
         except socket.error, e:
-            if e.args[0] not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
-                pass    # server busy
-            if not self.err_flag:
-                logging.warning("Connect to [%s:%s] fail: %s", addr[0], addr[1], e)
-                self.err_flag = True
+            self.on_connect_failed(addr, e)
             if sock:
                 sock.close()
 
-    def full_poll(self):
-        pool_size = 5
-        poll_live_time = 60
+    def on_connect_failed(self, addr, e):
+        if not self.err_flag:
+            logging.warning("Connect to [%s:%s] fail: %s", addr[0], addr[1], e)
+            self.err_flag = True
 
-        now = time.time()
-        for fw in list(self.forward_pool):
-            if now - fw.down.create > poll_live_time:
-                fw.close()
+    def on_connected(self, fw, conn):
+        self.err_flag = False
+        if isinstance(fw, MuxTunnel):
+            logging.info("Create [mux-tunnel] to RRDServer[%s:%s]." % self.rrd_server_addr)
+        elif conn is fw.down:     # private-connection
+            conn.sock.send(private_head(conn.flags))    # send private-connection flag
+            logging.info("Create [private-connection] to RRDServer[%s:%s]." % self.rrd_server_addr)
+
+    def create_mux_tunnel(self):
+        conn = self.create_conn(self.rrd_server_addr, self.down_profile)
+        if not conn:
+            return None
+        tunnel = MuxTunnel(self, conn)
+        tunnel.out.write(private_head(FLAG_MUX))  # 随后的数据都是帧, 连接建立后一起发送
+        self.w_list.add(conn.sock)
+        self.mux_tunnels.append(tunnel)
+        if not conn.connecting:
+            self.on_connected(tunnel, conn)
+        return tunnel
+
+    def on_connect_timeout(self, conn):
+        del self._connecting[conn]
+        self.on_connect_failed(conn.addr, "timeout")
+        fw = self._forwards.get(conn.sock) or self.get_forward_from_pool(conn.sock)
+        if fw:
+            fw.close()
+
+    def on_tunnel_closed(self, tunnel):
+        self.mux_tunnels.remove(tunnel)
+        self.schedule_fill()
+
+    def remove_from_pool(self, fw):
+        RemoteRedirection.remove_from_pool(self, fw)
+        self.schedule_fill()
+
+    def grow_pool(self, need=0):
+        size = min(self.pool_max, max(self.pool_size * 2, len(self.forward_pool) + need))
+        if size > self.pool_size:
+            logging.debug("Grow pool: %d -> %d", self.pool_size, size)
+            self.pool_size = size
+            self.schedule_fill()
+        self.last_grow = time.time()
+
+    def adjust_pool(self, now):
+        """统计private连接的使用速度, 长时间没有扩大时缩小连接池
+        """
+        elapsed = now - self.last_adjust
+        if elapsed < self.pool_decay:
+            return
+        self.arrival_rate = (self.arrival_rate + self.arrivals / elapsed) / 2
+        self.arrivals = 0
+        self.last_adjust = now
+        if now - self.last_grow < self.pool_decay:
+            return
+        floor = max(self.pool_min, int(math.ceil(self.arrival_rate)))
+        if self.pool_size > floor:
+            size = max(floor, self.pool_size - max(1, self.pool_size // 4))
+            logging.debug("Shrink pool: %d -> %d", self.pool_size, size)
+            self.pool_size = size
+            self.schedule_fill()
+
+    def on_pool_decay(self):
+        if self.stopped:
+            return
+        self.adjust_pool(self.timers.now)
+        self.timers.call_later(self.pool_decay, self.on_pool_decay)
+
+    def take_control_head(self, fw):
+        """去掉RRDServer在tunnel(fw.down)数据之前插入的控制头, CONTROL_FLAGS中每个标志一个
+        @return: None表示控制头还不完整, False表示控制头无效
+        """
+        conn = fw.down
+        if len(conn.rbuf) < PRIVATE_HEAD_SIZE:
+            return None
+        match = CONTROL_HEAD_REGEX.match(conn.rbuf.head(PRIVATE_HEAD_SIZE))
+        if not match:
+            return False
+        conn.rbuf.consume(PRIVATE_HEAD_SIZE)
+        conn.rsize -= PRIVATE_HEAD_SIZE
+        kind, value = match.group(1), int(match.group(2))
+        if kind == "G":
+            conn.flags &= ~FLAG_ADAPTIVE
+            if value:
+                self.grow_pool(value)
+        elif kind == "Z":
+            conn.flags &= ~FLAG_ZLIB
+            if value:
+                fw.enable_compression()
+        elif kind == "P":
+            conn.flags &= ~FLAG_PAIRED
+        else:
+            return False
+        return True
+
+    def decompress_buffered(self, fw):
+        """控制头之后已经收到的(压缩的)数据交给fw.down_pipeline解压
+        @return: False表示数据无法解压
+        """
+        data = fw.down.rbuf.getvalue()
+        fw.down.rbuf.clear()
+        try:
+            for chunk in fw.down_pipeline.feed(data):
+                fw.down.rbuf.write(chunk)
+        except socket.error, e:
+            logging.error("%s from RRDServer.", e.args[1])
+            return False
+        return True
+
+    def on_stream_open(self, tunnel, stream_id):
+        conn = self.create_conn(self.server_addr, self.up_profile)
+        if conn:
+            tunnel.add_stream(stream_id, conn)
+        else:
+            tunnel.send_frame(FRAME_CLOSE, stream_id)
 
-        if len(self.forward_pool) < pool_size:
+    def schedule_fill(self, delay=None):
+        """稍后补充连接池, 上一次连接失败时延迟RETRY_DELAY
+        """
+        if self._fill_timer is None and not self.stopped:
+            if delay is None:
+                delay = RETRY_DELAY if self.err_flag else 0
+            self._fill_timer = self.timers.call_later(delay, self.fill_pool)
+
+    def stop(self):
+        """不再补充连接池, 关闭池中空闲的private连接. 多路复用tunnel上已有的stream不受影响
+        """
+        RemoteRedirection.stop(self)
+        self.timers.cancel(self._fill_timer)
+        self._fill_timer = None
+        for fw in set(self.forward_pool.itervalues()):
+            fw.close()
+
+    def fill_pool(self):
+        """把空闲的private连接(或多路复用tunnel)补充到目标数量
+        """
+        self._fill_timer = None
+        if self.mux_size:
+            while len(self.mux_tunnels) < self.mux_size:
+                if not self.create_mux_tunnel():
+                    self.schedule_fill(RETRY_DELAY)
+                    break
+            return
+
+        pool_size = self.pool_size
+        if len(self.forward_pool) > pool_size:
+            # 连接池缩小了, 先关闭最早创建的连接
+            surplus = sorted(self.forward_pool.itervalues(), key=lambda fw: fw.down.create)
+            for fw in surplus[:len(self.forward_pool) - pool_size]:
+                fw.close()
+        elif len(self.forward_pool) < pool_size:
             for i in xrange(pool_size - len(self.forward_pool)):
-                conn = self.create_conn(self.rrd_server_addr)
+                conn = self.create_conn(self.rrd_server_addr, self.down_profile)
                 if not conn:
+                    self.schedule_fill(RETRY_DELAY)
                     break
-                conn.sock.send("{[(%04d)]}" % random.randint(1, 9999))    # send private-connection flag
+                if self.pool_max > self.pool_min:
+                    conn.flags |= FLAG_ADAPTIVE
+                if self.compress:
+                    conn.flags |= FLAG_ZLIB
+                if self.paired:
+                    conn.flags |= FLAG_PAIRED
                 fw = self.Forward(self, down=conn)
-                self.forward_pool.append(fw)
-                logging.info("Create [private-connection] to RRDServer[%s:%s]." % self.rrd_server_addr)
+                self.add_to_pool(fw)
+                if not conn.connecting:
+                    self.on_connected(fw, conn)
 
+    def recv_pooled(self, fw):
+        """池中的private连接收到数据: 去掉控制头, 配对后连接Server
+        """
+        assert fw.up is None
+        sock = fw.down.sock
+        rsize = fw.down.recv()
+        if rsize == -1:
+            fw.close()
+            return
+        self.stats.bytes.inc(rsize, "down")
+        if fw.down.rbuf_full:
+            self.r_list.discard(sock)
+        elif fw.down.over_budget:
+            self.wait_budget(fw.down, "down")
+        if fw.down.flags & CONTROL_FLAGS:
+            taken = True
+            while taken and fw.down.flags & CONTROL_FLAGS:
+                taken = self.take_control_head(fw)
+            if taken is False:
+                logging.error("Invalid control head from RRDServer.")
+                fw.close()
+                return
+            if not taken:
+                return  # 等待更多数据
+        elif not fw.down.rbuf:
+            return
+        if fw.compressed and fw.down.rbuf and not self.decompress_buffered(fw):
+            fw.close()
+            return
+        conn = self.create_conn(self.server_addr, self.up_profile)
+        if conn:
+            logging.info("Create [conn] to Server[%s:%s]" % self.server_addr)
+            self.remove_from_pool(fw)
+            self.arrivals += 1
+            if not self.forward_pool:
+                self.grow_pool()    # 连接池已经用完
+            fw.up = conn
+            fw.use_pipe()
+            fw.on_paired()
+            self._forwards[fw.up.sock] = fw
+            self._forwards[fw.down.sock] = fw
+            if fw.down.rbuf:
+                self.w_list.add(fw.up.sock)   # 连接建立后再发送
+        else:
+            fw.close()
 
-    def main_loop(self):
-        timeout = 0.1
-        while True:
-            self.full_poll()
-            r_list, w_list, e_list = select.select(self.r_list, self.w_list, self.r_list, timeout)
-            for sock in e_list:
-                self._call(sock, "close")
-            for sock in r_list:
-                fw = self.get_forward_from_pool(sock)
-                if fw:
-                    assert fw.up is None
-                    rsize = fw.down.recv()
-                    if rsize == -1:
-                        fw.close()
-                    else:
-                        conn = self.create_conn(self.server_addr)
-                        if conn:
-                            logging.info("Create [conn] to Server[%s:%s]" % self.server_addr)
-                            fw.up = conn
-                            self.forward_pool.remove(fw)
-                            self._forwards[fw.up.sock] = fw
-                            self._forwards[fw.down.sock] = fw
-                            if fw.down.rbuf:
-                                self.w_list.add(fw.up.sock)
-                        else:
-                            fw.close()
-                            continue
-                else:
-                    self._call(sock, "on_recv")
-            for sock in w_list:
-                self._call(sock, "on_send")
-
+    def on_readable(self, sock):
+        fw = self.get_forward_from_pool(sock)
+        if fw:
+            self.recv_pooled(fw)
+        else:
+            self._call(sock, "on_recv")
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, 
@@ -436,10 +1370,19 @@ if __name__ == '__main__':
     import sys
     if sys.argv[1] == "server":
         bind = ("127.0.0.1", 1234)
-        server = RRDServer(bind)
-        server.main_loop()
+        tunnel = ("127.0.0.1", 1235)    # ssh由服务端先发送数据, 使用单独的tunnel端口
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+        if workers:
+            from Workers import WorkerPool, create_handoff_ring
+            ring = create_handoff_ring(workers)
+            def run_worker(worker_id):
+                RRDServer(bind, reuse_port=True, handoff=ring[worker_id], tunnel_addr=tunnel).main_loop()
+            WorkerPool(run_worker, workers).run()
+        else:
+            server = RRDServer(bind, tunnel_addr=tunnel)
+            server.main_loop()
     else:
-        rrd_server = ("127.0.0.1", 1234)
+        rrd_server = ("127.0.0.1", 1235)
         server = ("127.0.0.1", 22)
         client = RRDClient(rrd_server, server)
         client.main_loop()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 定时器队列
+#
+#   所有超时(connect超时, 空闲超时, 连接池中连接的寿命等)都放在一个最小堆中,
+#   事件循环用最近的到期时间作为poll的超时, 不再每轮扫描全部连接.
+#   cancel只做标记(O(1)), 被取消的定时器到期时直接丢弃; 被取消的太多时重建堆.
+#
+#   空闲超时不需要在每次收发数据时重新设置定时器: 只记录最后活动时间, 定时器到期时
+#   若期间有过活动, 再按最后活动时间重新设置一次.
+#
+
+import time
+import heapq
+import itertools
+
+
+class Timer(object):
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerQueue(object):
+    def __init__(self):
+        self._heap = []     # [(deadline, seq, timer)]
+        self._seq = itertools.count()
+        self._cancelled = 0
+        self.now = time.time()  # 本轮循环的时间, 供频繁的活动时间记录使用
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_at(self, deadline, callback, *args):
+        """
+        @return: Timer, 用于cancel(timer)
+        """
+        timer = Timer(deadline, callback, args)
+        heapq.heappush(self._heap, (deadline, next(self._seq), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        if timer is not None and not timer.cancelled:
+            timer.cancelled = True
+            self._cancelled += 1
+            if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+                # 原地重建: run()执行的回调中也可能cancel, run()持有的仍是同一个list
+                heap = self._heap
+                heap[:] = [item for item in heap if not item[2].cancelled]
+                heapq.heapify(heap)
+                self._cancelled = 0
+
+    def timeout(self, max_timeout=None):
+        """
+        @return: 距离最近的到期时间还有多少秒, 作为poll的超时. 没有定时器时返回max_timeout
+        """
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        if not heap:
+            return max_timeout
+        timeout = max(0, heap[0][0] - time.time())
+        return timeout if max_timeout is None else min(timeout, max_timeout)
+
+    def run(self):
+        """执行所有已到期的定时器
+        """
+        self.now = now = time.time()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                self._cancelled -= 1
+                continue
+            timer.cancelled = True  # 已执行, 之后的cancel()无效
+            timer.callback(*timer.args)
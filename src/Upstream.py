@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 预先建立好的到remote的连接池
+#
+#   新的client到来时直接从池中取一个已连接的socket, 不必等待一次TCP握手.
+#   池中空闲的socket仍在事件循环中: 可读且EOF表示remote已关闭, 立即丢弃并在后台补充.
+#   remote先发送的数据(例如ssh的banner)会保留在连接的rbuf中, 取出后转发给client.
+#   connect超时, 空闲寿命与补充都由proxy.timers驱动.
+#
+
+import time
+import socket
+import logging
+from collections import OrderedDict
+
+
+class UpstreamPool(object):
+    def __init__(self, proxy, addr, size, connection_class, max_idle=60, retry_delay=1):
+        """
+        @param proxy: 所属的Redirection, 池中的socket注册在proxy._forwards中, 使用proxy.timers
+        @param addr: remote地址
+        @param size: 池的目标大小(空闲 + 正在连接)
+        @param connection_class: 连接类型, connection_class(sock, addr, max_buf_size, min_buf_size)
+        @param max_idle: 空闲超过这么久(秒)的连接会被替换, 以免remote已经超时关闭
+        @param retry_delay: 连接失败后, 这么久(秒)之后再补充
+        """
+        self.proxy = proxy
+        self.addr = addr
+        self.size = size
+        self.connection_class = connection_class
+        self.max_idle = max_idle
+        self.retry_delay = retry_delay
+        self.idle = OrderedDict()   # 已连接的connection -> 寿命定时器
+        self.pending = {}           # 正在连接的connection -> connect超时定时器
+        self._conns = {}            # sock -> connection
+        self._fill_timer = None
+
+        self.hits = 0       # get()取到了连接
+        self.misses = 0     # get()时池是空的
+        self.dropped = 0    # 池中被remote关闭或超时的连接
+        self.schedule_fill(0)
+
+    def get(self):
+        """
+        @return: 已连接的connection, 池为空时返回None. 返回的连接已从事件循环中移除
+        """
+        if not self.idle:
+            self.misses += 1
+            return None
+        conn = next(reversed(self.idle))    # 最近放入的连接最不可能已被关闭
+        self.hits += 1
+        self._remove(conn)
+        self.schedule_fill(0)
+        return conn
+
+    def schedule_fill(self, delay):
+        if self._fill_timer is None:
+            self._fill_timer = self.proxy.timers.call_later(delay, self.fill)
+
+    def fill(self):
+        """补充连接到目标大小
+        """
+        self._fill_timer = None
+        for i in xrange(self.size - len(self.idle) - len(self.pending)):
+            if not self._connect():
+                self.schedule_fill(self.retry_delay)
+                break
+
+    def stop(self):
+        """关闭池中空闲和正在建立的连接, 不再补充
+        """
+        self.size = 0
+        self.proxy.timers.cancel(self._fill_timer)
+        for conn in list(self.idle) + list(self.pending):
+            self._remove(conn)
+            conn.sock.close()
+            conn.rbuf.close()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        conn = self.connection_class(sock, self.addr, self.proxy.max_buf_size, self.proxy.min_buf_size)
+        self.proxy.up_profile.apply(conn)
+        try:
+            connected = conn.connect(self.proxy.resolver.resolve(self.addr))
+        except socket.error:
+            connected = False
+        if not connected:
+            logging.warning("Pooled connect to remote[%s:%s] failed." % self.addr)
+            sock.close()
+            return False
+        self._conns[sock] = conn
+        self.proxy._forwards[sock] = self
+        if conn.connecting:
+            timers = self.proxy.timers
+            self.pending[conn] = timers.call_later(self.proxy.connect_timeout, self._timeout, conn)
+            self.proxy.w_list.add(sock)
+        else:
+            self._add_idle(conn)
+        return True
+
+    def _add_idle(self, conn):
+        self.idle[conn] = self.proxy.timers.call_later(self.max_idle, self._drop, conn)
+        self.proxy.r_list.add(conn.sock)
+
+    def _timeout(self, conn):
+        logging.warning("Pooled connect to remote[%s:%s] timeout." % self.addr)
+        self._drop(conn, self.retry_delay)
+
+    def _remove(self, conn):
+        sock = conn.sock
+        timers = self.proxy.timers
+        timers.cancel(self.idle.pop(conn, None))
+        timers.cancel(self.pending.pop(conn, None))
+        self._conns.pop(sock, None)
+        self.proxy._forwards.pop(sock, None)
+        self.proxy.r_list.discard(sock)
+        self.proxy.w_list.discard(sock)
+
+    def _drop(self, conn, refill_delay=0):
+        self.dropped += 1
+        self._remove(conn)
+        conn.sock.close()
+        conn.rbuf.close()
+        self.schedule_fill(refill_delay)
+
+    def on_send(self, sock):
+        conn = self._conns[sock]
+        self.proxy.timers.cancel(self.pending.pop(conn, None))
+        self.proxy.w_list.discard(sock)
+        if not conn.finish_connect():
+            logging.warning("Pooled connect to remote[%s:%s] failed." % self.addr)
+            self._drop(conn, self.retry_delay)
+            return
+        self.proxy.stats.connect_seconds.observe(time.time() - conn.create, "upstream")
+        self._add_idle(conn)
+
+    def on_recv(self, sock):
+        conn = self._conns[sock]
+        if conn.recv() == -1:
+            logging.debug("Pooled connection closed by remote[%s:%s]." % self.addr)
+            self._drop(conn)
+        elif conn.rbuf_full or conn.over_budget:
+            self.proxy.r_list.discard(sock)     # 交给forward时再恢复读取
+
+    def close(self, sock=None):
+        conn = self._conns.get(sock)
+        if conn:
+            self._drop(conn)
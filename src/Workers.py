@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# 多进程模式
+#
+#   WorkerPool fork出N个worker, 每个worker独立运行一个Redirection的main_loop,
+#   通过SO_REUSEPORT绑定同一个地址, 由内核把新连接分配给各个worker. worker退出后自动重启.
+#
+#   RRDServer的private连接与open连接需要在同一个worker中配对, 而内核分配连接时并不区分两者.
+#   create_handoff_ring创建一个环: worker i 没有空闲的private连接时, 把等待中的open连接
+#   (fd + 已读取的数据)通过SCM_RIGHTS交给 worker i+1, 最多传递 N-1 次.
+#   数据与fd在同一个消息中发送, 发送失败时两者都没有发出, 接收方不会把数据与其他连接的fd配对.
+#
+
+import os
+import time
+import errno
+import signal
+import socket
+import struct
+import logging
+from Syscalls import send_fd, recv_fd
+
+
+class Handoff(object):
+    """worker之间传递连接的通道: 从inbox接收, 向outbox(下一个worker)发送
+    """
+    META = struct.Struct("!H")     # 已经被传递的次数
+    MAX_DATA = 0x10000              # 随连接一起传递的数据上限
+
+    def __init__(self, inbox, outbox, max_hops):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.max_hops = max_hops
+
+    def send(self, sock, data, hops):
+        """把sock(及已从sock读取的data)交给下一个worker, 成功后调用者应关闭sock
+        @return: 是否成功, 失败时(下一个worker来不及处理等)调用者继续在本worker处理sock
+        """
+        if len(data) > self.MAX_DATA:
+            return False
+        try:
+            send_fd(self.outbox, self.META.pack(hops) + data, sock.fileno())
+        except socket.error, e:
+            if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN, errno.ENOBUFS):
+                logging.warning("Hand off connection failed: %s", e)
+            return False
+        return True
+
+    def recv(self):
+        """不会阻塞, inbox可读时由事件循环调用
+        @return: (sock, data, hops), inbox中没有连接时返回None
+        """
+        while True:
+            try:
+                msg, fd = recv_fd(self.inbox, self.MAX_DATA + self.META.size)
+            except socket.error, e:
+                if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    logging.warning("Receive handoff failed: %s", e)
+                return None
+            if fd is None or len(msg) < self.META.size:
+                logging.warning("Drop malformed handoff, fd: %s, size: %d", fd, len(msg))
+                if fd is not None:
+                    os.close(fd)
+                continue
+            try:
+                sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            except socket.error, e:
+                logging.warning("Receive handoff failed: %s", e)
+                continue
+            finally:
+                os.close(fd)
+            sock.setblocking(0)
+            hops, = self.META.unpack(msg[:self.META.size])
+            return sock, msg[self.META.size:], hops
+
+
+def create_handoff_ring(num_workers):
+    """需要在fork之前调用
+    @return: 每个worker对应的Handoff
+    """
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for i in xrange(num_workers)]
+    for pair in pairs:
+        for sock in pair:
+            sock.setblocking(0)
+    # pairs[i][0]: worker i 的inbox, pairs[i][1]: worker i-1 的outbox
+    return [Handoff(pairs[i][0], pairs[(i + 1) % num_workers][1], num_workers - 1)
+            for i in xrange(num_workers)]
+
+
+class WorkerPool(object):
+    def __init__(self, target, num_workers=None, restart_delay=1):
+        """
+        @param target: target(worker_id), 在worker进程中运行, 通常是创建Redirection并调用main_loop
+        @param num_workers: worker数, None表示CPU核数
+        @param restart_delay: worker启动后这么短时间内就退出, 则延迟这么久再重启, 避免不停地fork
+        """
+        if num_workers is None:
+            import multiprocessing
+            num_workers = multiprocessing.cpu_count()
+        self.target = target
+        self.num_workers = num_workers
+        self.restart_delay = restart_delay
+        self._workers = {}      # pid -> (worker_id, start time)
+        self._stopping = False
+
+    def _spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                self.target(worker_id)
+            except:
+                logging.exception("Worker[%d] crashed.", worker_id)
+                code = 1
+            finally:
+                os._exit(code)
+        self._workers[pid] = (worker_id, time.time())
+        logging.info("Start worker[%d], pid: %d", worker_id, pid)
+
+    def stop(self, *args):
+        self._stopping = True
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        """启动全部worker, 并在worker退出后重启, 直到收到SIGTERM/SIGINT
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker_id in xrange(self.num_workers):
+            self._spawn(worker_id)
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            worker_id, start = self._workers.pop(pid, (None, None))
+            if worker_id is None or self._stopping:
+                continue
+            logging.warning("Worker[%d] exited with status %d, restart it.", worker_id, status)
+            if time.time() - start < self.restart_delay:
+                time.sleep(self.restart_delay)
+            if not self._stopping:
+                self._spawn(worker_id)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# 测试用的回环服务: 各个Redirection在daemon线程中运行main_loop
+#
+
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def spawn(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def run_loop(proxy):
+    spawn(proxy.main_loop)
+    return proxy
+
+
+def _serve(handle):
+    lsock = socket.socket()
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    lsock.bind(("127.0.0.1", 0))
+    lsock.listen(50)
+
+    def accept():
+        while True:
+            sock, _ = lsock.accept()
+            spawn(handle, sock)
+    spawn(accept)
+    return lsock.getsockname()
+
+
+def echo_server():
+    """
+    @return: (host, port), 原样返回收到的数据
+    """
+    def handle(sock):
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sock.sendall(data)
+        sock.close()
+    return _serve(handle)
+
+
+def banner_server(banner="220 ready\r\n"):
+    """由服务端先发送数据的协议(smtp, ssh等): 连接建立后发送banner, 之后原样返回
+    """
+    def handle(sock):
+        sock.sendall(banner)
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sock.sendall(data)
+        sock.close()
+    return _serve(handle)
+
+
+def recv_exact(sock, size, timeout=5):
+    sock.settimeout(timeout)
+    data = ""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def connect(addr, retries=50):
+    """连接addr, 服务还没有开始监听时重试
+    """
+    for i in xrange(retries):
+        try:
+            return socket.create_connection(addr, 5)
+        except socket.error:
+            time.sleep(0.05)
+    return socket.create_connection(addr, 5)
+
+
+def find_python3():
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        exe = os.path.join(path, "python3")
+        if os.path.isfile(exe) and os.access(exe, os.X_OK):
+            return exe
+    return None
+
+
+def run_python3(code):
+    """在python3子进程中运行code(AsyncRedirection), 调用者负责terminate
+    """
+    return subprocess.Popen([find_python3(), "-c", "import sys; sys.path.insert(0, %r)\n%s" % (SRC, code)])
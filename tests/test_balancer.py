@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import select
+import socket
+import unittest
+from collections import Counter
+
+from support import free_port
+from Timers import TimerQueue
+from Resolver import Resolver
+from Balancer import Backend, Balancer, HealthChecker
+
+
+def backends(*weights):
+    return [Backend(("10.0.0.%d" % (i + 1), 80), weight) for i, weight in enumerate(weights)]
+
+
+class ChooseTest(unittest.TestCase):
+    def test_smooth_weighted_round_robin(self):
+        a, b, c = nodes = backends(5, 1, 1)
+        balancer = Balancer(nodes)
+        picks = [balancer.choose(("1.1.1.1", 1)) for i in xrange(7)]
+        # 与nginx相同的顺序: 权重大的后端不会连续集中
+        self.assertEqual(picks, [a, a, b, a, c, a, a])
+        picks = [balancer.choose(("1.1.1.1", 1)) for i in xrange(70)]
+        self.assertEqual(Counter(picks), {a: 50, b: 10, c: 10})
+
+    def test_round_robin_skips_down_and_excluded(self):
+        a, b, c = nodes = backends(1, 1, 1)
+        balancer = Balancer(nodes)
+        b.healthy = False
+        picks = set(balancer.choose(("1.1.1.1", 1)) for i in xrange(10))
+        self.assertEqual(picks, set([a, c]))
+        self.assertEqual(balancer.choose(("1.1.1.1", 1), exclude=(a, c)), b)    # 只剩不可用的也尝试
+        self.assertEqual(balancer.choose(("1.1.1.1", 1), exclude=nodes), None)
+
+    def test_least_active(self):
+        a, b, c = nodes = backends(1, 2, 1)
+        balancer = Balancer(nodes, "least_active")
+        a.active, b.active, c.active = 3, 4, 1
+        self.assertEqual(balancer.choose(("1.1.1.1", 1)), c)
+        c.active = 3
+        self.assertEqual(balancer.choose(("1.1.1.1", 1)), b)   # 4 / 2 < 3
+        b.healthy = False
+        self.assertEqual(balancer.choose(("1.1.1.1", 1)), a)   # 相同时取第一个
+
+    def test_hash_sticky(self):
+        nodes = backends(1, 1, 1, 1)
+        balancer = Balancer(nodes, "hash")
+        clients = ["192.168.0.%d" % i for i in xrange(200)]
+        first = dict((ip, balancer.choose((ip, 1000))) for ip in clients)
+        for ip in clients:
+            self.assertTrue(balancer.choose((ip, 2000)) is first[ip])   # 与端口无关
+        self.assertEqual(set(first.values()), set(nodes))
+
+    def test_hash_fallthrough(self):
+        nodes = backends(1, 1, 1, 1)
+        balancer = Balancer(nodes, "hash")
+        clients = ["192.168.0.%d" % i for i in xrange(200)]
+        first = dict((ip, balancer.choose((ip, 1))) for ip in clients)
+        down = nodes[0]
+        down.healthy = False
+        for ip in clients:
+            chosen = balancer.choose((ip, 1))
+            if first[ip] is down:
+                self.assertTrue(chosen is not down)
+                self.assertTrue(balancer.choose((ip, 1)) is chosen)    # 顺延后同样固定
+            else:
+                self.assertTrue(chosen is first[ip])    # 其它client不受影响
+        down.healthy = True
+        self.assertTrue(all(balancer.choose((ip, 1)) is first[ip] for ip in clients))
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, Balancer, backends(1), "random")
+
+
+class ReportTest(unittest.TestCase):
+    def test_rise_and_fall(self):
+        backend, = backends(1)
+        balancer = Balancer([backend], rise=2, fall=3)
+        for ok in (False, False, True, False, False):
+            balancer.report(backend, ok)
+        self.assertTrue(backend.healthy)    # 成功一次后重新计数
+        balancer.report(backend, False)
+        self.assertFalse(backend.healthy)
+        balancer.report(backend, True)
+        self.assertFalse(backend.healthy)
+        balancer.report(backend, False)
+        balancer.report(backend, True)
+        self.assertFalse(backend.healthy)   # 失败一次后重新计数
+        balancer.report(backend, True)
+        self.assertTrue(backend.healthy)
+        self.assertEqual((backend.fails, backend.successes), (0, 2))
+
+
+class FakeProxy(object):
+    def __init__(self):
+        self.timers = TimerQueue()
+        self.resolver = Resolver()
+        self._forwards = {}
+        self.r_list = set()
+        self.w_list = set()
+
+
+class HealthCheckerTest(unittest.TestCase):
+    def probe_all(self, proxy, checker):
+        """检查一遍所有后端, 等待非阻塞connect的结果
+        """
+        for backend in checker.balancer.backends:
+            checker._probe(backend)
+        while proxy.w_list:
+            r, w, e = select.select([], list(proxy.w_list), [], 2)
+            for sock in w:
+                checker.on_send(sock)
+
+    def test_transitions(self):
+        lsock = socket.socket()
+        lsock.bind(("127.0.0.1", 0))
+        lsock.listen(16)
+        up = Backend(lsock.getsockname())
+        down = Backend(("127.0.0.1", free_port()))
+        balancer = Balancer([up, down], rise=2, fall=2)
+        proxy = FakeProxy()
+        checker = HealthChecker(proxy, balancer, interval=60)
+        self.probe_all(proxy, checker)
+        self.assertTrue(down.healthy)
+        self.probe_all(proxy, checker)
+        self.assertEqual((up.healthy, down.healthy), (True, False))
+        self.assertEqual(proxy._forwards, {})
+        down.addr = up.addr     # 后端恢复
+        self.probe_all(proxy, checker)
+        self.assertFalse(down.healthy)
+        self.probe_all(proxy, checker)
+        self.assertTrue(down.healthy)
+        checker.stop()
+        lsock.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
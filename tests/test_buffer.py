@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import tempfile
+import unittest
+
+import support
+from Buffer import Buffer, budget
+from Filters import FileRegion
+
+
+class BudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = budget.limit
+        self.used, self.holders = budget.used, budget.holders
+        budget.set_limit(1024 * 1024)
+        self.file = tempfile.TemporaryFile()
+        self.file.write("x" * (8 * 1024 * 1024))
+        self.file.flush()
+
+    def tearDown(self):
+        budget.set_limit(self.saved)
+        self.file.close()
+        self.assertEqual((budget.used, budget.holders), (self.used, self.holders))
+
+    def test_allowance(self):
+        buf = Buffer()
+        buf.write("a" * (900 * 1024))
+        self.assertTrue(budget.tight)
+        self.assertFalse(budget.exhausted)
+        # 超过low_water后, 每个缓冲最多持有limit / (持有数 + 1)
+        self.assertEqual(budget.allowance(len(buf)), 0)
+        self.assertEqual(budget.allowance(0), budget.limit - budget.used)   # 其它测试遗留的连接也计入used
+        buf.close()
+
+    def test_file_region_not_counted(self):
+        buf = Buffer()
+        buf.write(FileRegion(self.file, 0, 8 * 1024 * 1024))
+        self.assertEqual(len(buf), 8 * 1024 * 1024)
+        self.assertEqual(buf.memory, 0)
+        self.assertEqual(budget.used, self.used)
+        self.assertFalse(budget.exhausted)
+        buf.close()
+
+    def test_mixed_queue(self):
+        buf = Buffer()
+        buf.write("head")
+        buf.write(FileRegion(self.file, 0, 100))
+        buf.write("tail")
+        self.assertEqual((len(buf), buf.memory), (108, 8))
+        self.assertEqual(budget.used - self.used, 8)
+        buf.consume(2)      # "ad" + region + "tail"
+        self.assertEqual(budget.used - self.used, 6)
+        buf.consume(52)     # 一半的region
+        self.assertEqual((len(buf), buf.memory), (54, 4))
+        buf.consume(50)
+        self.assertEqual((len(buf), buf.memory), (4, 4))
+        self.assertEqual(buf.getvalue(), "tail")
+        buf.consume(4)
+        self.assertEqual(budget.used, self.used)
+        self.assertTrue(buf.emptied)
+
+    def test_sendfile(self):
+        a, b = socket.socketpair()
+        buf = Buffer()
+        buf.write("GET")
+        buf.write(FileRegion(self.file, 0, 256 * 1024))
+        received = 0
+        while buf:
+            buf.send_to(a)
+            received += len(b.recv(1024 * 1024))
+        while received < 3 + 256 * 1024:
+            received += len(b.recv(1024 * 1024))
+        self.assertEqual(budget.used, self.used)
+        a.close()
+        b.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import socket
+import unittest
+
+from support import free_port, run_loop, echo_server, recv_exact, connect
+from Metrics import Registry
+from Filters import Pipeline, FunctionStage
+from TcpRemoteRedirection import RRDServer, RRDClient, Forward
+from Compression import CompressStage, DecompressStage, CompressionStats, SAMPLE_SIZE
+
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = CompressionStats(Registry("test_"))
+
+    def round_trip(self, chunks):
+        compress = Pipeline(CompressStage(6, self.stats))
+        decompress = Pipeline(DecompressStage(self.stats))
+        out = []
+        for chunk in chunks:
+            for wire in compress.feed(chunk):
+                # 每块数据都做了Z_SYNC_FLUSH, 对端收到后立即可以解压
+                out.extend(decompress.feed(wire))
+        self.assertEqual(compress.flush(), [])
+        return "".join(out)
+
+    def test_compressible(self):
+        chunks = ["line %d of a very repetitive log\n" % i for i in xrange(5000)]
+        self.assertEqual(self.round_trip(chunks), "".join(chunks))
+        self.assertEqual(self.stats.disabled.samples()[0][2], 0)
+        raw = self.stats.raw.values[("send",)]
+        wire = self.stats.wire.values[("send",)]
+        self.assertTrue(wire < raw / 2, (wire, raw))
+
+    def test_incompressible_stops_compressing(self):
+        chunks = [os.urandom(4096) for i in xrange(SAMPLE_SIZE // 4096 * 3)]
+        self.assertEqual(self.round_trip(chunks), "".join(chunks))
+        self.assertEqual(self.stats.disabled.samples()[0][2], 1)
+        # 停止压缩之后原样发送
+        self.assertTrue(self.stats.wire.values[("send",)] - self.stats.raw.values[("send",)] < 1024)
+
+    def test_split_wire_data(self):
+        compress = CompressStage(6, self.stats)
+        decompress = DecompressStage(self.stats)
+        data = "abc" * 10000
+        wire = "".join(compress.feed(data))
+        out = []
+        for i in xrange(0, len(wire), 7):
+            out.extend(decompress.feed(wire[i:i + 7]))
+        self.assertEqual("".join(out), data)
+
+    def test_invalid_data(self):
+        decompress = DecompressStage(self.stats)
+        with self.assertRaises(socket.error):
+            decompress.feed("not zlib data at all")
+
+
+class RespondingForward(Forward):
+    """up一侧的Stage在收到Server的"ping"时回复一次"pong", 回复经过压缩的tunnel发给RRDClient(再到Server)
+    """
+    def create_up_pipeline(self):
+        self.replied = False
+        return Pipeline(FunctionStage(self.reply))
+
+    def reply(self, data):
+        if "ping" in data and not self.replied:
+            self.replied = True
+            return None, "pong"
+        return None, None
+
+
+class CompressedTunnelTest(unittest.TestCase):
+    def test_up_stage_response(self):
+        bind = ("127.0.0.1", free_port())
+        tunnel_addr = ("127.0.0.1", free_port())
+        server = run_loop(RRDServer(bind, tunnel_addr=tunnel_addr, compress=6, forward=RespondingForward))
+        run_loop(RRDClient(tunnel_addr, echo_server(), compress=6))
+        time.sleep(0.2)
+        sock = connect(bind)
+        sock.sendall("ping")
+        self.assertEqual(recv_exact(sock, 8), "pingpong")
+        sock.close()
+        self.assertTrue(server.compression_stats.raw.values[("send",)] >= 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
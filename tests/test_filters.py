@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# 流式拦截: HTTP报文切分与跨数据块的替换, 每种输入都在所有可能的位置切分后再检查
+#
+
+import unittest
+from collections import deque
+
+import support
+from Filters import (Pipeline, ReplaceStage, HttpStage, request_body_length, response_body_length,
+                     CHUNKED, UNTIL_CLOSE)
+
+
+def splits(data):
+    """
+    @return: 把data切成数据块的各种方式: 不切分, 在每个位置切成两块, 每字节一块
+    """
+    yield [data]
+    for i in xrange(1, len(data)):
+        yield [data[:i], data[i:]]
+    yield list(data)
+
+
+def run(pipeline, chunks):
+    out = []
+    for chunk in chunks:
+        out.extend(pipeline.feed(chunk))
+    out.extend(pipeline.flush())
+    return "".join(out)
+
+
+class ReplaceStageTest(unittest.TestCase):
+    def check(self, old, new, data):
+        expected = data.replace(old, new)
+        for chunks in splits(data):
+            self.assertEqual(run(Pipeline(ReplaceStage(old, new)), chunks), expected, chunks)
+
+    def test_replace(self):
+        self.check("Host: a", "Host: bb", "GET / HTTP/1.1\r\nHost: a\r\n\r\nHost: aHost: a")
+
+    def test_self_overlapping_prefix(self):
+        self.check("aab", "X", "aaab aab aaaab aa")
+        self.check("abab", "X", "abababab ababa")
+
+    def test_delete(self):
+        self.check("\r\n", "", "a\r\nb\r\n\r\nc\r")
+
+    def test_partial_match_at_end(self):
+        self.check("abc", "X", "xxab")
+        stage = ReplaceStage("abc", "X")
+        self.assertEqual(stage.feed("xxab"), ["xx"])
+        self.assertEqual(stage.flush(), ["ab"])
+
+    def test_unmodified_chunk_passes_through(self):
+        data = "nothing to replace here"
+        self.assertTrue(ReplaceStage("abc", "X").feed(data)[0] is data)
+
+    def test_empty_pattern(self):
+        self.assertRaises(ValueError, ReplaceStage, "", "x")
+
+
+class HttpStageTest(unittest.TestCase):
+    def setUp(self):
+        self.heads = []
+        self.ends = []
+
+    def on_head(self, head):
+        self.heads.append(head.split("\r\n", 1)[0])
+        return None, None
+
+    def on_end(self, head):
+        self.ends.append(head.split("\r\n", 1)[0])
+        return ["<end>"]
+
+    def check(self, data, expected, heads, stage=None):
+        for chunks in splits(data):
+            self.heads, self.ends = [], []
+            pipeline = Pipeline(stage() if stage else HttpStage(self.on_head, self.on_end))
+            self.assertEqual(run(pipeline, chunks), expected, chunks)
+            self.assertEqual(self.heads, heads, chunks)
+            self.assertEqual(self.ends, heads, chunks)
+
+    def test_content_length_and_pipelined(self):
+        post = "POST /a HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+        get = "GET /b HTTP/1.1\r\nHost: x\r\n\r\n"
+        self.check(post + get + get, post + "<end>" + get + "<end>" + get + "<end>",
+                   ["POST /a HTTP/1.1", "GET /b HTTP/1.1", "GET /b HTTP/1.1"])
+
+    def test_chunked(self):
+        post = ("POST /c HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                "5\r\nhello\r\n3;ext=1\r\nabc\r\n0\r\nX-Trailer: 1\r\n\r\n")
+        get = "GET /d HTTP/1.1\r\n\r\n"
+        self.check(post + get, post + "<end>" + get + "<end>", ["POST /c HTTP/1.1", "GET /d HTTP/1.1"])
+
+    def test_responses_without_body(self):
+        methods = deque()
+
+        def stage():
+            methods.extend(["HEAD", "GET", "GET", "GET", "GET"])
+            return HttpStage(self.on_head, self.on_end, lambda head: response_body_length(head, methods.popleft()))
+        messages = ["HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n",     # HEAD的响应没有报文体
+                    "HTTP/1.1 100 Continue\r\n\r\n",
+                    "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok",
+                    "HTTP/1.1 204 No Content\r\n\r\n",
+                    "HTTP/1.1 304 Not Modified\r\nContent-Length: 10\r\n\r\n"]
+        heads = [message.split("\r\n", 1)[0] for message in messages]
+        data, expected = "".join(messages), "".join(message + "<end>" for message in messages)
+        self.check(data, expected, heads, stage)
+
+    def test_discard_and_respond(self):
+        def on_head(head):
+            self.on_head(head)
+            if head.startswith("DELETE"):
+                return "", "HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\n\r\n"
+            return None, None
+        delete = "DELETE /x HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc"
+        get = "GET /y HTTP/1.1\r\n\r\n"
+        for chunks in splits(delete + get):
+            self.heads = []
+            pipeline = Pipeline(HttpStage(on_head))
+            self.assertEqual(run(pipeline, chunks), get)
+            self.assertEqual(pipeline.take_responses(), ["HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\n\r\n"])
+            self.assertEqual(self.heads, ["DELETE /x HTTP/1.1", "GET /y HTTP/1.1"])
+
+    def test_upgrade_passes_rest_through(self):
+        upgrade = "GET /ws HTTP/1.1\r\nUpgrade: websocket\r\n\r\n"
+        frames = "GET /not-http HTTP/1.1\r\n\r\n\x81\x05hello"
+        for chunks in splits(upgrade + frames):
+            self.heads = []
+            self.assertEqual(run(Pipeline(HttpStage(self.on_head)), chunks), upgrade + frames)
+            self.assertEqual(self.heads, ["GET /ws HTTP/1.1"])
+
+    def test_not_http(self):
+        data = "x" * 100
+        self.assertEqual(run(Pipeline(HttpStage(self.on_head, max_size=16)), [data]), data)
+        self.assertEqual(self.heads, [])
+
+
+class BodyLengthTest(unittest.TestCase):
+    def test_request(self):
+        self.assertEqual(request_body_length("GET / HTTP/1.1\r\n\r\n"), 0)
+        self.assertEqual(request_body_length("POST / HTTP/1.1\r\ncontent-length: 12\r\n\r\n"), 12)
+        self.assertEqual(request_body_length("POST / HTTP/1.1\r\nTransfer-Encoding: gzip, chunked\r\n\r\n"), CHUNKED)
+        self.assertEqual(request_body_length("CONNECT a:443 HTTP/1.1\r\n\r\n"), UNTIL_CLOSE)
+
+    def test_response(self):
+        self.assertEqual(response_body_length("HTTP/1.1 200 OK\r\nContent-Length: 7\r\n\r\n"), 7)
+        self.assertEqual(response_body_length("HTTP/1.1 200 OK\r\nContent-Length: 7\r\n\r\n", "HEAD"), 0)
+        self.assertEqual(response_body_length("HTTP/1.1 200 OK\r\n\r\n"), UNTIL_CLOSE)
+        self.assertEqual(response_body_length("HTTP/1.1 101 Switching Protocols\r\n\r\n"), UNTIL_CLOSE)
+        self.assertEqual(response_body_length("HTTP/1.1 200 OK\r\n\r\n", "CONNECT"), UNTIL_CLOSE)
+        for status in ("100 Continue", "204 No Content", "304 Not Modified"):
+            self.assertEqual(response_body_length("HTTP/1.1 %s\r\nContent-Length: 9\r\n\r\n" % status), 0)
+        self.assertEqual(response_body_length("garbage"), UNTIL_CLOSE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# demos/HttpLocalRedirection: 静态文件缓存与请求/响应的顺序
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from collections import deque
+
+import support
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demos"))
+from HttpLocalRedirection import HttpForward, StaticCache, StaticEntry
+
+
+class StaticCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_lru_by_bytes(self):
+        a, b, c = [self.make(name, name * 1000) for name in "abc"]
+        entry_size = StaticEntry(a).size
+        cache = StaticCache(max_bytes=entry_size * 2)
+        cache.get(a)
+        cache.get(b)
+        cache.get(a)    # a变成最近使用的
+        cache.get(c)
+        self.assertEqual(list(cache.entries), [a, c])
+        self.assertEqual(cache.size, entry_size * 2)
+
+    def test_entry_larger_than_cache(self):
+        path = self.make("big", "x" * 5000)
+        cache = StaticCache(max_bytes=100)
+        self.assertEqual(cache.get(path).body, "x" * 5000)
+        self.assertEqual(list(cache.entries), [path])    # 至少保留最近使用的一项
+
+    def test_revalidate(self):
+        path = self.make("page", "one")
+        cache = StaticCache(revalidate=60)
+        self.assertEqual(cache.get(path).body, "one")
+        self.make("page", "two!")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(cache.get(path).body, "one")   # revalidate秒内不检查
+        cache.revalidate = 0
+        entry = cache.get(path)
+        self.assertEqual(entry.body, "two!")
+        self.assertTrue("Content-Length: 4\r\n" in entry.headers)
+        self.assertTrue(cache.get(path) is entry)  # 没有变化时继续使用
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, StaticCache().get, os.path.join(self.dir, "missing"))
+
+
+class FakeProxy(object):
+    bind_addr = ("127.0.0.1", 1213)
+    remote_addr = ("10.0.0.1", 80)
+
+
+class OrderingTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, "static.txt")
+        with open(path, "wb") as f:
+            f.write("static")
+
+        class TestForward(HttpForward):
+            MAPPING = {"/static": path}
+            cache = StaticCache()
+        # 只测试两个方向的Pipeline, 不需要连接
+        self.fw = TestForward.__new__(TestForward)
+        self.fw.proxy = FakeProxy()
+        self.fw.expected = deque()
+        self.down = self.fw.create_down_pipeline()
+        self.up = self.fw.create_up_pipeline()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def join(self, chunks):
+        return "".join(chunk if isinstance(chunk, str) else chunk.tobytes() for chunk in chunks)
+
+    def test_local_response_immediately(self):
+        self.assertEqual(self.down.feed("GET /static HTTP/1.1\r\n\r\n"), [])
+        response = self.join(self.down.take_responses())
+        self.assertTrue(response.startswith("HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(response.endswith("\r\n\r\nstatic"))
+
+    def test_local_response_queued_behind_remote(self):
+        requests = ("GET /remote HTTP/1.1\r\nHost: 127.0.0.1:1213\r\n\r\n"
+                    "HEAD /static HTTP/1.1\r\n\r\n"
+                    "GET /static HTTP/1.1\r\n\r\n")
+        forwarded = self.join(self.down.feed(requests))
+        self.assertEqual(forwarded, "GET /remote HTTP/1.1\r\nHost: 10.0.0.1:80\r\n\r\n")
+        self.assertEqual(self.down.take_responses(), [])    # 等待Remote的响应
+        # 中间响应之后才是最终的响应
+        self.assertEqual(self.join(self.up.feed("HTTP/1.1 100 Continue\r\n\r\n")), "HTTP/1.1 100 Continue\r\n\r\n")
+        out = self.join(self.up.feed("HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nremote"))
+        remote, head_response, get_response = out.split("HTTP/1.1 200 OK\r\n")[1:]
+        self.assertTrue(remote.endswith("\r\n\r\nremote"))
+        self.assertTrue(head_response.endswith("\r\n\r\n"))     # HEAD的响应没有报文体
+        self.assertTrue(get_response.endswith("\r\n\r\nstatic"))
+        self.assertEqual(len(self.fw.expected), 0)
+
+    def test_head_response_from_remote(self):
+        self.down.feed("HEAD /remote HTTP/1.1\r\n\r\nGET /static HTTP/1.1\r\n\r\n")
+        # HEAD的响应带Content-Length但没有报文体, 本地响应紧接在它之后
+        out = self.join(self.up.feed("HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n"))
+        self.assertTrue(out.startswith("HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nHTTP/1.1 200 OK\r\n"))
+        self.assertTrue(out.endswith("static"))
+
+
+if __name__ == "__main__":
+    unittest.main()
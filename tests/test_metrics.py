@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import support
+from Metrics import Registry
+
+
+class RenderTest(unittest.TestCase):
+    def test_render(self):
+        root = Registry("tcpredir_")
+        root.gauge("mappings", "Port mappings.", func=lambda: 2)
+        child = Registry("tcpredir_", labels=(("mapping", "web"),))
+        requests = child.counter("requests_total", "Requests.", ("path",))
+        requests.inc(3, 'a"b\\c\nd')
+        requests.inc(1, "/")
+        latency = child.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            latency.observe(value)
+        other = Registry("tcpredir_", labels=(("mapping", "db"),))
+        other.counter("requests_total", "Requests.", ("path",))
+        root.children.extend([child, other])
+        self.assertEqual(root.render(), "\n".join([
+            "# HELP tcpredir_mappings Port mappings.",
+            "# TYPE tcpredir_mappings gauge",
+            "tcpredir_mappings 2",
+            # 同名的指标合并到一组, 各自带上Registry的标签; db有标签但还没有样本, 不输出
+            "# HELP tcpredir_requests_total Requests.",
+            "# TYPE tcpredir_requests_total counter",
+            'tcpredir_requests_total{mapping="web",path="/"} 1',
+            'tcpredir_requests_total{mapping="web",path="a\\"b\\\\c\\nd"} 3',
+            "# HELP tcpredir_latency_seconds Latency.",
+            "# TYPE tcpredir_latency_seconds histogram",
+            'tcpredir_latency_seconds_bucket{mapping="web",le="0.1"} 2',
+            'tcpredir_latency_seconds_bucket{mapping="web",le="1"} 3',
+            'tcpredir_latency_seconds_bucket{mapping="web",le="+Inf"} 4',
+            'tcpredir_latency_seconds_sum{mapping="web"} 2.65',
+            'tcpredir_latency_seconds_count{mapping="web"} 4',
+            ""]))
+
+    def test_unlabelled_counter_starts_at_zero(self):
+        registry = Registry()
+        registry.counter("events_total", "Events.")
+        self.assertEqual(registry.render(), "# HELP events_total Events.\n# TYPE events_total counter\nevents_total 0\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# 多路复用tunnel的帧编码与解析
+#
+
+import time
+import socket
+import unittest
+
+from support import free_port, run_loop, recv_exact, connect
+from Timers import TimerQueue
+from Metrics import Stats
+from Buffer import budget
+from Filters import Pipeline, FunctionStage
+from TcpRemoteRedirection import RRDServer, Forward, Connection, private_head, FLAG_MUX
+from Multiplex import (MuxTunnel, FRAME_HEAD, WINDOW_UPDATE, FRAME_OPEN, FRAME_DATA, FRAME_CLOSE, FRAME_WINDOW,
+                       MAX_PAYLOAD, WINDOW)
+
+
+class FakeProxy(object):
+    """只提供MuxTunnel用到的部分, OPEN帧新建的stream连接到一个socketpair
+    """
+    stream_side = "up"
+    tunnel_side = "down"
+
+    def __init__(self):
+        self._forwards = {}
+        self._connecting = {}
+        self.r_list = set()
+        self.w_list = set()
+        self.timers = TimerQueue()
+        self.stats = Stats()
+        self.peers = []
+        self.tunnels_closed = []
+
+    def new_conn(self):
+        sock, peer = socket.socketpair()
+        sock.setblocking(0)
+        self.peers.append(peer)
+        return Connection(sock, ("peer", 0), 64 * 1024)
+
+    def on_stream_open(self, tunnel, stream_id):
+        tunnel.add_stream(stream_id, self.new_conn())
+
+    def on_tunnel_closed(self, tunnel):
+        self.tunnels_closed.append(tunnel)
+
+
+def frame(tp, stream_id, payload=""):
+    return FRAME_HEAD.pack(tp, stream_id, len(payload)) + payload
+
+
+def parse(data):
+    """
+    @return: [(type, stream_id, payload), ...]
+    """
+    frames = []
+    while data:
+        tp, stream_id, length = FRAME_HEAD.unpack(data[:FRAME_HEAD.size])
+        frames.append((tp, stream_id, data[FRAME_HEAD.size:FRAME_HEAD.size + length]))
+        data = data[FRAME_HEAD.size + length:]
+    return frames
+
+
+class FrameTest(unittest.TestCase):
+    def setUp(self):
+        self.proxy = FakeProxy()
+        self.tunnel = MuxTunnel(self.proxy, self.proxy.new_conn())
+
+    def tearDown(self):
+        self.tunnel.close()
+        for peer in self.proxy.peers:
+            peer.close()
+
+    def feed(self, data):
+        self.tunnel.conn.rbuf.write(data)
+        self.tunnel.process_frames()
+
+    def test_encode(self):
+        self.tunnel.send_frame(FRAME_OPEN, 7)
+        self.tunnel.send_data(7, "x" * (MAX_PAYLOAD + 10))
+        self.tunnel.send_frame(FRAME_WINDOW, 7, WINDOW_UPDATE.pack(1000))
+        self.assertEqual(parse(self.tunnel.out.getvalue()),
+                         [(FRAME_OPEN, 7, ""), (FRAME_DATA, 7, "x" * MAX_PAYLOAD), (FRAME_DATA, 7, "x" * 10),
+                          (FRAME_WINDOW, 7, WINDOW_UPDATE.pack(1000))])
+        self.assertTrue(self.tunnel.conn.sock in self.proxy.w_list)
+
+    def test_open_and_data(self):
+        self.feed(frame(FRAME_OPEN, 3) + frame(FRAME_DATA, 3, "hello"))
+        stream = self.tunnel.streams[3]
+        self.assertEqual(stream.out.getvalue(), "hello")
+        self.assertTrue(stream.conn.sock in self.proxy.w_list)
+        self.assertEqual(len(self.tunnel.conn.rbuf), 0)
+
+    def test_partial_frame(self):
+        data = frame(FRAME_OPEN, 1) + frame(FRAME_DATA, 1, "abcdef")
+        for i in xrange(len(data)):
+            self.feed(data[i])
+        self.assertEqual(self.tunnel.streams[1].out.getvalue(), "abcdef")
+
+    def test_window_and_close(self):
+        self.feed(frame(FRAME_OPEN, 5))
+        stream = self.tunnel.streams[5]
+        stream.send_window = 0
+        self.feed(frame(FRAME_WINDOW, 5, WINDOW_UPDATE.pack(4096)))
+        self.assertEqual(stream.send_window, 4096)
+        self.feed(frame(FRAME_CLOSE, 5))
+        self.assertTrue(stream.closed)
+        self.assertFalse(5 in self.tunnel.streams)
+        self.feed(frame(FRAME_DATA, 5, "late"))  # 已关闭的stream的帧被忽略
+        self.assertFalse(self.tunnel.closed)
+
+    def test_close_stream_notifies_peer(self):
+        self.feed(frame(FRAME_OPEN, 9))
+        self.tunnel.streams[9].close()
+        self.assertEqual(parse(self.tunnel.out.getvalue()), [(FRAME_CLOSE, 9, "")])
+
+    def test_unknown_type_closes_tunnel(self):
+        self.feed(frame(FRAME_OPEN, 2) + frame(99, 2, "?"))
+        self.assertTrue(self.tunnel.closed)
+        self.assertEqual(self.proxy.tunnels_closed, [self.tunnel])
+        self.assertEqual(self.tunnel.streams, {})
+        self.assertEqual(self.proxy._forwards, {})
+
+    def test_round_trip(self):
+        other = MuxTunnel(FakeProxy(), self.proxy.new_conn())
+        conn = self.proxy.new_conn()
+        conn.rbuf.write("first")
+        stream = self.tunnel.open_stream(conn)
+        self.assertEqual(stream.send_window, WINDOW - len("first"))
+        self.tunnel.send_data(stream.stream_id, "second")
+        other.conn.rbuf.write(self.tunnel.out.getvalue())
+        other.process_frames()
+        self.assertEqual(other.streams[stream.stream_id].out.getvalue(), "firstsecond")
+        other.close()
+        for peer in other.proxy.peers:
+            peer.close()
+
+
+class KeepaliveTest(unittest.TestCase):
+    def setUp(self):
+        self.proxy = FakeProxy()
+        self.tunnel = MuxTunnel(self.proxy, self.proxy.new_conn(), keepalive=0.05)
+
+    def tearDown(self):
+        self.tunnel.close()
+        for peer in self.proxy.peers:
+            peer.close()
+
+    def run_timers(self, seconds):
+        time.sleep(seconds)
+        self.proxy.timers.run()
+
+    def test_keepalive_frame(self):
+        self.run_timers(0.07)
+        self.assertEqual(parse(self.tunnel.out.getvalue()), [(FRAME_WINDOW, 0, WINDOW_UPDATE.pack(0))])
+        self.assertFalse(self.tunnel.closed)
+
+    def test_received_keepalive_is_ignored(self):
+        self.tunnel.conn.rbuf.write(frame(FRAME_WINDOW, 0, WINDOW_UPDATE.pack(0)))
+        self.tunnel.process_frames()
+        self.assertFalse(self.tunnel.closed)
+
+    def test_dead_tunnel_closed(self):
+        self.proxy.on_stream_open(self.tunnel, 1)
+        stream = self.tunnel.streams[1]
+        for i in xrange(4):
+            self.run_timers(0.05)
+        self.assertTrue(self.tunnel.closed)
+        self.assertTrue(stream.closed)
+        self.assertEqual(self.proxy.tunnels_closed, [self.tunnel])
+
+    def test_data_keeps_tunnel_open(self):
+        peer = self.proxy.peers[0]
+        for i in xrange(4):
+            peer.send(frame(FRAME_WINDOW, 0, WINDOW_UPDATE.pack(0)))
+            self.run_timers(0.05)
+            self.tunnel.on_recv(self.tunnel.conn.sock)
+        self.assertFalse(self.tunnel.closed)
+
+
+class InterceptingForward(Forward):
+    def create_down_pipeline(self):
+        return Pipeline(FunctionStage(lambda data: (None, None)))
+
+
+class RejectTest(unittest.TestCase):
+    def test_rejected_mux_tunnel_released(self):
+        bind, tunnel_addr = ("127.0.0.1", free_port()), ("127.0.0.1", free_port())
+        server = run_loop(RRDServer(bind, tunnel_addr=tunnel_addr, forward=InterceptingForward))
+        holders = budget.holders
+        sock = connect(tunnel_addr)
+        sock.sendall(private_head(FLAG_MUX) + "x" * 100)
+        self.assertEqual(recv_exact(sock, 1), "")   # 被拒绝, 连接已关闭
+        sock.close()
+        time.sleep(0.1)
+        self.assertEqual(server._forwards, {})
+        self.assertEqual(server.mux_tunnels, [])
+        self.assertTrue(budget.holders <= holders)
+
+
+if __name__ == "__main__":
+    unittest.main()
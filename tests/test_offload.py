@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from support import free_port, run_loop, echo_server, recv_exact, connect
+from TcpLocalRedirection import TcpLocalRedirection, Forward
+from Filters import Pipeline, FunctionStage, ReplaceStage
+from Offload import check_process_hooks
+
+
+class SlowUpper(Forward):
+    def process_down_recv(self, data):
+        if "slow" in data:
+            time.sleep(0.3)
+        if "boom" in data:
+            raise ValueError("boom")
+        return (data.replace("slow", "SLOW").replace("fast", "FAST"), None)
+
+
+class SlowPipeline(Forward):
+    def create_down_pipeline(self):
+        return Pipeline(FunctionStage(lambda data: (time.sleep(0.3) if "slow" in data else None, None)),
+                        ReplaceStage("slow", "SLOW"), ReplaceStage("fast", "FAST"))
+
+
+class Stateful(Forward):
+    def process_down_recv(self, data):
+        return (data.replace("localhost", "%s:%d" % self.proxy.bind_addr), None)
+
+
+class OffloadTest(unittest.TestCase):
+    def start(self, forward, hook_pool):
+        bind = ("127.0.0.1", free_port())
+        proxy = run_loop(TcpLocalRedirection(bind, echo_server(), forward=forward, hook_pool=hook_pool))
+        return proxy, bind
+
+    def stall(self, forward, hook_pool):
+        """
+        @return: 一个forward的拦截很慢时, 另一个forward的最大往返时间
+        """
+        proxy, bind = self.start(forward, hook_pool)
+        slow, fast = connect(bind), connect(bind)
+        fast.sendall("fast")
+        self.assertEqual(recv_exact(fast, 4), "FAST")
+        slow.sendall("slow")
+        time.sleep(0.02)
+        rtt = 0
+        for i in xrange(5):
+            start = time.time()
+            fast.sendall("fast")
+            self.assertEqual(recv_exact(fast, 4), "FAST")
+            rtt = max(rtt, time.time() - start)
+        self.assertEqual(recv_exact(slow, 4), "SLOW")
+        slow.close()
+        fast.close()
+        return rtt
+
+    def test_inline_stalls(self):
+        self.assertTrue(self.stall(SlowUpper, None) > 0.2)
+
+    def test_thread_pool(self):
+        self.assertTrue(self.stall(SlowUpper, "thread") < 0.15)
+        self.assertTrue(self.stall(SlowPipeline, "thread") < 0.15)
+
+    def test_process_pool(self):
+        self.assertTrue(self.stall(SlowUpper, "process") < 0.15)
+
+    def test_order_and_metrics(self):
+        proxy, bind = self.start(SlowPipeline, "thread")
+        sock = connect(bind)
+        data = "abcdefghij fast " * 20000
+        sock.sendall(data)
+        self.assertEqual(recv_exact(sock, len(data)), data.replace("fast", "FAST"))
+        sock.close()
+        metrics = proxy.stats.render()
+        self.assertTrue('tcpredir_hook_queue_depth{hook="down_pipeline"} 0' in metrics, metrics)
+        self.assertTrue('tcpredir_hook_seconds_count{hook="down_pipeline"}' in metrics)
+
+    def test_error_closes_forward(self):
+        proxy, bind = self.start(SlowUpper, "thread")
+        sock = connect(bind)
+        sock.sendall("boom")
+        self.assertEqual(recv_exact(sock, 1), "")
+        sock.close()
+
+    def test_process_pool_rejects_state(self):
+        check_process_hooks(SlowUpper)
+        with self.assertRaises(ValueError):
+            check_process_hooks(Stateful)
+        with self.assertRaises(ValueError):
+            TcpLocalRedirection(("127.0.0.1", free_port()), echo_server(), forward=Stateful, hook_pool="process")
+
+
+if __name__ == "__main__":
+    unittest.main()
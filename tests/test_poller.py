@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import select
+import socket
+import unittest
+
+import support
+from Poller import create_poller, PollerView, POLLERS
+from Timers import TimerQueue
+
+
+class PollerTest(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(0)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def pollers(self):
+        for name, cls in POLLERS:
+            if hasattr(select, name):
+                yield create_poller(name)
+
+    def test_readable_and_writable(self):
+        for poller in self.pollers():
+            poller.r_list.add(self.sock)
+            self.assertEqual(poller.poll(0), ([], [], []), poller.name)
+            self.peer.send("x")
+            r_list, w_list, e_list = poller.poll(1)
+            self.assertEqual((r_list, w_list), ([self.sock], []), poller.name)
+            self.sock.recv(1)
+            poller.w_list.add(self.sock)
+            r_list, w_list, e_list = poller.poll(1)
+            self.assertEqual(w_list, [self.sock], poller.name)
+            poller.r_list.discard(self.sock)
+            poller.w_list.discard(self.sock)
+            self.peer.send("y")
+            self.assertEqual(poller.poll(0), ([], [], []), poller.name)
+            self.sock.recv(1)
+            poller.close()
+
+    def test_level_or_edge_triggered(self):
+        for poller in self.pollers():
+            poller.r_list.add(self.sock)
+            self.peer.send("ab")
+            self.assertEqual(poller.poll(1)[0], [self.sock])
+            self.sock.recv(1)   # 没有读到EAGAIN
+            again = poller.poll(0)[0]
+            if poller.name == "epoll":
+                # 边沿触发: 没有新数据时不再通知, 重新关注读事件时再次检查就绪状态
+                self.assertEqual(again, [])
+                poller.r_list.discard(self.sock)
+                poller.r_list.add(self.sock)
+                self.assertEqual(poller.poll(0)[0], [self.sock])
+                self.peer.send("c")
+                self.assertEqual(poller.poll(1)[0], [self.sock])
+            else:
+                self.assertEqual(again, [self.sock], poller.name)
+            while True:
+                try:
+                    self.sock.recv(10)
+                except socket.error:
+                    break
+            poller.close()
+
+    def test_closed_peer_is_readable(self):
+        for poller in self.pollers():
+            sock, peer = socket.socketpair()
+            poller.r_list.add(sock)
+            peer.close()
+            self.assertEqual(poller.poll(1)[0], [sock], poller.name)
+            self.assertEqual(sock.recv(1), "")
+            poller.r_list.discard(sock)
+            sock.close()
+            poller.close()
+
+    def test_unknown_poller(self):
+        self.assertRaises(ValueError, create_poller, "kqueue-or-nothing")
+
+
+class PollerViewTest(unittest.TestCase):
+    def test_owners(self):
+        poller = create_poller()
+        owners = {}
+        first = PollerView(poller, TimerQueue(), None, owners)
+        second = PollerView(poller, TimerQueue(), None, owners)
+        self.assertTrue(create_poller(first) is first)
+        a, b = socket.socketpair()
+        first.r_list.add(a)
+        first.w_list.add(a)
+        second.r_list.add(b)
+        self.assertEqual(owners, {a: first, b: second})
+        self.assertTrue(a in poller.r_list and a in poller.w_list and b in poller.r_list)
+        first.r_list.discard(a)
+        self.assertEqual(owners[a], first)  # 还关注写事件
+        self.assertFalse(a in first.r_list)
+        self.assertEqual(len(first.w_list), 1)
+        first.w_list.discard(a)
+        second.r_list.discard(b)
+        self.assertEqual(owners, {})
+        self.assertEqual((len(poller.r_list), len(poller.w_list)), (0, 0))
+        self.assertRaises(RuntimeError, first.poll, 0)
+        a.close()
+        b.close()
+        poller.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# Redirector删除映射: 已有的连接继续转发, 全部关闭后丢弃映射
+#
+
+import time
+import unittest
+
+from support import free_port, spawn, echo_server, recv_exact, connect
+from Redirector import Redirector
+from TcpRemoteRedirection import RRDServer, RRDClient
+
+
+class RemoveMappingTest(unittest.TestCase):
+    def start(self, remove, delay=0.5):
+        """一个Redirector中运行通过多路复用tunnel相连的RRDServer与RRDClient, delay秒后删除映射remove
+        """
+        self.bind = ("127.0.0.1", free_port())
+        tunnel_addr = ("127.0.0.1", free_port())
+        self.redirector = Redirector()
+        self.server = self.redirector.add("server", RRDServer, self.bind, tunnel_addr=tunnel_addr)
+        self.client = self.redirector.add("client", RRDClient, tunnel_addr, echo_server(), mux_tunnels=1)
+        self.redirector.timers.call_later(delay, self.redirector.remove, remove)
+        spawn(self.redirector.main_loop)
+
+    def echo(self, sock, data="hello"):
+        sock.sendall(data)
+        return recv_exact(sock, len(data))
+
+    def test_drain_client_with_open_stream(self):
+        self.start("client")
+        sock = connect(self.bind)
+        self.assertEqual(self.echo(sock), "hello")
+        time.sleep(0.7)
+        self.assertEqual(self.redirector._draining, [self.client])
+        self.assertEqual(self.echo(sock), "hello")  # 删除后已有的stream继续转发
+        sock.close()
+        time.sleep(0.3)
+        self.assertEqual(self.redirector._draining, [])
+        self.assertEqual(self.client.mux_tunnels, [])
+        self.assertEqual(self.client._forwards, {})
+
+    def test_remove_idle_client(self):
+        self.start("client")
+        time.sleep(0.7)
+        self.assertEqual(self.redirector._draining, [])
+        self.assertEqual(self.client.mux_tunnels, [])
+
+    def test_remove_idle_server(self):
+        self.start("server")
+        time.sleep(0.7)
+        self.assertEqual(self.redirector._draining, [])
+        self.assertEqual(self.server.mux_tunnels, [])
+        self.assertEqual(self.server._forwards, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import threading
+import unittest
+
+import support
+from Resolver import Resolver
+
+
+class FakeResolver(Resolver):
+    """lookup返回预先设定的结果, gate未打开时阻塞
+    """
+    def __init__(self, *args, **kwargs):
+        Resolver.__init__(self, *args, **kwargs)
+        self.answer = "10.0.0.1"
+        self.lookups = 0
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def lookup(self, addr):
+        self.lookups += 1
+        self.gate.wait()
+        if self.answer is None:
+            raise socket.error("lookup failed")
+        return (self.answer, addr[1])
+
+
+def wait_for(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class ResolverTest(unittest.TestCase):
+    def test_ip_is_not_looked_up(self):
+        resolver = FakeResolver()
+        resolver.prewarm([("127.0.0.1", 80)])
+        self.assertEqual(resolver.resolve(("127.0.0.1", 80)), ("127.0.0.1", 80))
+        self.assertEqual(resolver.lookups, 0)
+
+    def test_prewarm_and_cache(self):
+        resolver = FakeResolver()
+        resolver.prewarm([("backend", 80)])
+        self.assertEqual(resolver.lookups, 1)
+        for i in xrange(3):
+            self.assertEqual(resolver.resolve(("backend", 80)), ("10.0.0.1", 80))
+        self.assertEqual(resolver.lookups, 1)
+
+    def test_prewarm_failure(self):
+        resolver = FakeResolver()
+        resolver.answer = None
+        resolver.prewarm([("backend", 80)])
+        self.assertRaises(socket.error, resolver.resolve, ("backend", 80))
+
+    def test_stale_while_refreshing(self):
+        resolver = FakeResolver(ttl=0)
+        resolver.prewarm([("backend", 80)])
+        resolver.gate.clear()
+        resolver.answer = "10.0.0.2"
+        start = time.time()
+        for i in xrange(3):
+            self.assertEqual(resolver.resolve(("backend", 80)), ("10.0.0.1", 80))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertTrue(wait_for(lambda: resolver.lookups == 2))   # 只有一个后台刷新
+        resolver.gate.set()
+        self.assertTrue(wait_for(lambda: resolver.resolve(("backend", 80)) == ("10.0.0.2", 80)))
+
+    def test_refresh_failure_keeps_stale(self):
+        resolver = FakeResolver(ttl=0, retry=60)
+        resolver.prewarm([("backend", 80)])
+        resolver.answer = None
+        self.assertEqual(resolver.resolve(("backend", 80)), ("10.0.0.1", 80))
+        self.assertTrue(wait_for(lambda: not resolver._refreshing))
+        self.assertEqual(resolver.resolve(("backend", 80)), ("10.0.0.1", 80))
+        self.assertEqual(resolver.lookups, 2)   # retry秒内不再刷新
+
+    def test_localhost(self):
+        self.assertEqual(Resolver().resolve(("localhost", 80)), ("127.0.0.1", 80))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# RRDServer <-> RRDClient: 标识头, 控制头与标志协商, 包括与AsyncRedirection(python3)之间的互通
+#
+
+import re
+import time
+import socket
+import unittest
+
+from support import (free_port, run_loop, echo_server, banner_server, recv_exact, connect,
+                     find_python3, run_python3)
+from TcpRemoteRedirection import (RRDServer, RRDClient, Connection, private_head, head_flags, control_head,
+                                  FLAG_ADAPTIVE, FLAG_PAIRED, FLAG_ZLIB)
+
+
+class HeadTest(unittest.TestCase):
+    def classify(self, data):
+        conn = Connection(None, None, 1024)
+        conn.rbuf.write(data)
+        return conn.type
+
+    def test_private_head(self):
+        self.assertEqual(len(private_head()), 10)
+        self.assertEqual(head_flags(private_head()), 0)
+        self.assertEqual(private_head(FLAG_PAIRED | FLAG_ZLIB), "{[(X012)]}")
+        self.assertEqual(head_flags("{[(X012)]}"), FLAG_PAIRED | FLAG_ZLIB)
+
+    def test_control_head(self):
+        self.assertEqual(control_head("G", 3), "{[(G003)]}")
+        self.assertEqual(control_head("G", 5000), "{[(G999)]}")
+
+    def test_classify(self):
+        self.assertEqual(self.classify("GET / HTTP/1.1\r\n"), Connection.TP_OPEN)
+        self.assertEqual(self.classify("{[("), Connection.TP_UNKNOWN)
+        self.assertEqual(self.classify("{[(12"), Connection.TP_UNKNOWN)
+        self.assertEqual(self.classify("{[(1234)]}"), Connection.TP_PRIVATE)
+        self.assertEqual(self.classify("{[(X008)]}data"), Connection.TP_PRIVATE)
+        self.assertEqual(self.classify("{[(12a4)]}"), Connection.TP_OPEN)
+
+
+class PairTest(unittest.TestCase):
+    def start(self, remote, client_kwargs={}, server_kwargs={}, tunnel=True):
+        bind = ("127.0.0.1", free_port())
+        tunnel_addr = ("127.0.0.1", free_port()) if tunnel else None
+        run_loop(RRDServer(bind, tunnel_addr=tunnel_addr, **server_kwargs))
+        run_loop(RRDClient(tunnel_addr or bind, remote, **client_kwargs))
+        time.sleep(0.2)
+        return bind
+
+    def echo(self, bind, data="hello"):
+        sock = connect(bind)
+        sock.sendall(data)
+        received = recv_exact(sock, len(data))
+        sock.close()
+        return received
+
+    def test_echo(self):
+        for paired in (True, False):
+            bind = self.start(echo_server(), {"paired": paired}, tunnel=False)
+            self.assertEqual(self.echo(bind), "hello")
+
+    def test_adaptive_and_compressed(self):
+        bind = self.start(echo_server(), {"pool_min": 1, "pool_max": 8, "compress": 6}, {"compress": 6})
+        for i in xrange(3):
+            self.assertEqual(self.echo(bind, "abc" * 10000), "abc" * 10000)
+
+    def test_default_head_is_plain(self):
+        # 默认的RRDClient只发送旧版RRDServer认识的标识头, 可以先升级RRDServer
+        lsock = socket.socket()
+        lsock.bind(("127.0.0.1", 0))
+        lsock.listen(8)
+        run_loop(RRDClient(lsock.getsockname(), echo_server(), pool_min=1))
+        sock, addr = lsock.accept()
+        self.assertTrue(re.match(r"^\{\[\(\d{4}\)\]\}$", recv_exact(sock, 10)))
+        sock.close()
+        lsock.close()
+
+    def test_server_speaks_first(self):
+        bind = self.start(banner_server(), {"paired": True})
+        sock = connect(bind)
+        self.assertEqual(recv_exact(sock, 11), "220 ready\r\n")
+        sock.close()
+
+
+@unittest.skipUnless(find_python3(), "python3 is required for AsyncRedirection")
+class AsyncInteropTest(unittest.TestCase):
+    def setUp(self):
+        self.procs = []
+
+    def tearDown(self):
+        for proc in self.procs:
+            proc.terminate()
+            proc.wait()
+
+    def python3(self, code):
+        self.procs.append(run_python3(code))
+        time.sleep(0.5)
+
+    def test_async_server_sync_client(self):
+        for kwargs in ({}, {"pool_min": 1, "pool_max": 4}, {"compress": 6},
+                       {"compress": 6, "pool_min": 1, "pool_max": 4}, {"paired": True}):
+            bind = ("127.0.0.1", free_port())
+            self.python3("from AsyncRedirection import AsyncRRDServer\n"
+                         "AsyncRRDServer(%r).main_loop(use_uvloop=False)" % (bind,))
+            run_loop(RRDClient(bind, echo_server(), **kwargs))
+            time.sleep(0.3)
+            sock = connect(bind)
+            sock.sendall("hello")
+            self.assertEqual(recv_exact(sock, 5), "hello", kwargs)
+            sock.close()
+
+    def test_sync_server_async_client(self):
+        bind, tunnel = ("127.0.0.1", free_port()), ("127.0.0.1", free_port())
+        run_loop(RRDServer(bind, tunnel_addr=tunnel))
+        self.python3("from AsyncRedirection import AsyncRRDClient\n"
+                     "AsyncRRDClient(%r, %r, paired=True).main_loop(use_uvloop=False)" % (tunnel, banner_server()))
+        sock = connect(bind)
+        self.assertEqual(recv_exact(sock, 11), "220 ready\r\n")
+        sock.sendall("hello")
+        self.assertEqual(recv_exact(sock, 5), "hello")
+        sock.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
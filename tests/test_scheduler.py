@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# IOScheduler: 配额用完的socket在没有新事件(边沿触发)时下一轮继续处理
+#
+
+import time
+import socket
+import unittest
+
+from support import free_port, run_loop, echo_server, recv_exact, connect
+from Poller import create_poller
+from Scheduler import IOScheduler
+from TcpLocalRedirection import TcpLocalRedirection
+
+
+class DeferTest(unittest.TestCase):
+    def setUp(self):
+        self.poller = create_poller("epoll")
+        self.scheduler = IOScheduler(self.poller.r_list, quantum=4096)
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(0)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+        self.poller.close()
+
+    def loop_once(self, timeout=1):
+        """一轮循环: 每个可读的socket最多读quantum字节, 读到配额时推迟
+        @return: 本轮读到的数据
+        """
+        r_list, w_list, e_list = self.poller.poll(self.scheduler.timeout(timeout))
+        data = ""
+        for sock in self.scheduler.readable(r_list):
+            chunk = ""
+            try:
+                while len(chunk) < self.scheduler.quantum:
+                    received = sock.recv(self.scheduler.quantum - len(chunk))
+                    if not received:
+                        break
+                    chunk += received
+            except socket.error:
+                pass
+            if self.scheduler.exhausted(len(chunk)):
+                self.scheduler.defer(sock)
+            data += chunk
+        return data
+
+    def test_deferred_socket_served_without_new_event(self):
+        payload = "x" * 4096 * 5 + "tail"
+        self.peer.sendall(payload)
+        self.poller.r_list.add(self.sock)
+        received = self.loop_once()
+        self.assertEqual(len(received), 4096)
+        # 之后不再有新的数据, 边沿触发的epoll不会再通知; 剩余的数据由ready队列驱动读完
+        for i in xrange(5):
+            self.assertEqual(self.scheduler.timeout(1), 0)
+            received += self.loop_once()
+        self.assertEqual(received, payload)
+        self.assertEqual(self.scheduler.ready, {})
+        self.assertEqual(self.scheduler.timeout(1), 1)
+        self.assertEqual(self.scheduler.deferred, 5)
+
+    def test_new_events_first_and_dropped_interest(self):
+        other, other_peer = socket.socketpair()
+        self.scheduler.defer(self.sock)
+        self.scheduler.defer(other)
+        self.poller.r_list.add(other)   # self.sock已经不再关注读事件(例如缓冲满)
+        new = object()
+        self.assertEqual(self.scheduler.readable([new]), [new, other])
+        self.assertEqual(self.scheduler.readable([]), [])
+        other.close()
+        other_peer.close()
+
+
+class RedirectionTest(unittest.TestCase):
+    def test_large_transfer_with_small_quantum(self):
+        bind = ("127.0.0.1", free_port())
+        proxy = run_loop(TcpLocalRedirection(bind, echo_server(), poller="epoll", io_quantum=4096))
+        sock = connect(bind)
+        payload = "0123456789" * 100000
+        sock.sendall(payload)
+        self.assertEqual(recv_exact(sock, len(payload)), payload)
+        sock.close()
+        self.assertTrue(proxy.scheduler.deferred > 0)
+
+    def test_max_accepts(self):
+        bind = ("127.0.0.1", free_port())
+        proxy = TcpLocalRedirection(bind, echo_server(), poller="epoll", max_accepts=2)
+        clients = [socket.create_connection(bind) for i in xrange(5)]
+        time.sleep(0.1)
+        accepts = proxy.stats.accepts
+        proxy.accept()
+        self.assertEqual(accepts.values[()], 2)
+        # 剩下的连接在之后的轮次中accept, 不需要新的事件
+        self.assertEqual(proxy.scheduler.readable([]), [proxy.server])
+        proxy.accept()
+        self.assertEqual(accepts.values[()], 4)
+        self.assertEqual(proxy.scheduler.readable([]), [proxy.server])
+        proxy.accept()
+        self.assertEqual(accepts.values[()], 5)
+        self.assertEqual(proxy.scheduler.readable([]), [])
+        run_loop(proxy)
+        for client in clients:
+            client.sendall("hi")
+            self.assertEqual(recv_exact(client, 2), "hi")
+            client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+import support
+from Timers import TimerQueue
+
+
+class TimerQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.timers = TimerQueue()
+        self.fired = []
+
+    def test_order(self):
+        now = time.time()
+        for delay in (0.3, 0.1, 0.2):
+            self.timers.call_at(now - 1 + delay, self.fired.append, delay)
+        self.timers.call_at(now + 60, self.fired.append, "later")
+        self.timers.run()
+        self.assertEqual(self.fired, [0.1, 0.2, 0.3])
+        self.assertEqual(len(self.timers), 1)
+        self.assertTrue(59 < self.timers.timeout() <= 60)
+        self.assertEqual(self.timers.timeout(5), 5)
+
+    def test_cancel(self):
+        timer = self.timers.call_later(-1, self.fired.append, 1)
+        self.timers.call_later(-1, self.fired.append, 2)
+        self.timers.cancel(timer)
+        self.timers.cancel(timer)
+        self.timers.cancel(None)
+        self.assertEqual(len(self.timers), 1)
+        self.timers.run()
+        self.assertEqual(self.fired, [2])
+        self.assertEqual(len(self.timers), 0)
+        self.assertEqual(self.timers.timeout(), None)
+
+    def test_cancel_after_run(self):
+        timer = self.timers.call_later(-1, self.fired.append, 1)
+        self.timers.run()
+        self.timers.cancel(timer)   # 已执行的定时器不再计数
+        self.assertEqual(len(self.timers), 0)
+
+    def test_compaction(self):
+        timers = [self.timers.call_later(10 + i, self.fired.append, i) for i in xrange(200)]
+        for timer in timers[:150]:
+            self.timers.cancel(timer)
+        self.assertEqual(len(self.timers), 50)
+        self.assertTrue(len(self.timers._heap) < 200)
+
+    def test_mass_cancel_in_callback(self):
+        # 回调中取消大量定时器(例如批量关闭连接)触发重建, run()之后的状态仍然一致
+        later = [self.timers.call_later(-0.5, self.fired.append, i) for i in xrange(100)]
+        keep = [self.timers.call_later(-0.5, self.fired.append, "keep%d" % i) for i in xrange(4)]
+        pending = [self.timers.call_later(60, self.fired.append, "pending")]
+
+        def close_all():
+            for timer in later:
+                self.timers.cancel(timer)
+        self.timers.call_later(-1, close_all)
+        self.timers.run()
+        self.assertEqual(sorted(self.fired), ["keep%d" % i for i in xrange(4)])
+        self.assertEqual(len(self.timers), 1)
+        self.assertEqual(self.timers._cancelled, 0)
+        self.assertEqual(len(self.timers._heap), 1)
+        self.timers.cancel(pending[0])
+        self.assertEqual(len(self.timers), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
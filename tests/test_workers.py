@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import unittest
+
+import support
+from Workers import Handoff, create_handoff_ring
+
+
+class HandoffTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = create_handoff_ring(2)
+        self.lsock = socket.socket()
+        self.lsock.bind(("127.0.0.1", 0))
+        self.lsock.listen(64)
+        self.clients = []
+
+    def tearDown(self):
+        for handoff in self.ring:
+            handoff.inbox.close()
+            handoff.outbox.close()
+        for sock in self.clients:
+            sock.close()
+        self.lsock.close()
+
+    def accept(self):
+        client = socket.create_connection(self.lsock.getsockname())
+        self.clients.append(client)
+        sock, addr = self.lsock.accept()
+        return client, sock
+
+    def test_round_trip(self):
+        client, sock = self.accept()
+        self.assertTrue(self.ring[0].send(sock, "open-data", 1))
+        sock.close()
+        item = self.ring[1].recv()
+        self.assertNotEqual(item, None)
+        received, data, hops = item
+        self.assertEqual((data, hops), ("open-data", 1))
+        self.assertEqual(received.getpeername(), client.getsockname())
+        received.sendall("pong")
+        self.assertEqual(client.recv(4), "pong")
+        received.close()
+        self.assertEqual(self.ring[1].recv(), None)
+
+    def test_recv_does_not_block(self):
+        start = time.time()
+        self.assertEqual(self.ring[0].recv(), None)
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_full_outbox(self):
+        # 下一个worker来不及接收时send返回False, 已发出的数据与fd仍然一一对应
+        sent = []
+        while True:
+            client, sock = self.accept()
+            ok = self.ring[0].send(sock, str(len(sent)) * 1000, 0)
+            sock.close()
+            if not ok:
+                break
+            sent.append(client)
+            self.assertTrue(len(sent) < 10000)
+        for i, client in enumerate(sent):
+            received, data, hops = self.ring[1].recv()
+            self.assertEqual(data, str(i) * 1000)
+            self.assertEqual(received.getpeername(), client.getsockname())
+            received.close()
+        self.assertEqual(self.ring[1].recv(), None)
+
+    def test_drop_message_without_fd(self):
+        client, sock = self.accept()
+        self.ring[0].outbox.send("\0\0junk")
+        self.assertTrue(self.ring[0].send(sock, "x", 0))
+        sock.close()
+        received, data, hops = self.ring[1].recv()
+        self.assertEqual(data, "x")
+        received.close()
+
+    def test_too_much_data(self):
+        client, sock = self.accept()
+        self.assertFalse(self.ring[0].send(sock, "x" * (Handoff.MAX_DATA + 1), 0))
+        sock.close()
+        self.assertEqual(self.ring[1].recv(), None)
+
+
+if __name__ == "__main__":
+    unittest.main()